@@ -0,0 +1,239 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Acknowledgement and Retransmission           #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module decides which queued sms rows are due    #
+#                 for (re)transmission, records acknowledgements heard #
+#                 from other nodes and tracks the cumulative ack this  #
+#                 node owes to every originating location.             #
+#                                                                      #
+########################################################################
+
+import packet
+import random
+import sqlite3
+
+#retransmission backoff (milliseconds), doubles with every attempt
+retry_base = 30000
+retry_cap = 1800000
+#give up on a message after this many transmissions
+retry_limit = 8
+#spread acks over this window so one overheard ack can suppress the rest (simulator.py)
+ack_delay = 10000
+
+#function: delay before the next transmission of a row, jittered so nodes desync
+def retry_delay(rowid, tx_count):
+    delay = min(retry_base * 2 ** (tx_count - 1), retry_cap)
+    #cheap deterministic jitter between 0.75 and 1.25 (multiplicative hash of rowid and tx_count)
+    jitter = 0.75 + ((rowid * 2654435761 + tx_count * 40503) % 1000) / 2000
+    return int(delay * jitter)
+
+#function: longest a sender keeps retrying one message (every backoff at maximum jitter)
+def retry_span():
+    return sum(int(min(retry_base * 2 ** (tx_count - 1), retry_cap) * 1.25)
+               for tx_count in range(1, retry_limit))
+
+#skip a sequence gap once it has been open this long (sender gave up), one more
+#retry_cap of margin covers a sender that queued the message late or was busy
+gap_timeout = retry_span() + retry_cap
+
+#function: add the ack columns and arq indexes to an sms table created before they existed
+def ensure_schema(db):
+    columns = [row[1] for row in db.execute('PRAGMA table_info(sms)')]
+    if 'sequence' not in columns:
+        db.execute('ALTER TABLE sms ADD COLUMN sequence INTEGER')
+    if 'time_acked' not in columns:
+        db.execute('ALTER TABLE sms ADD COLUMN time_acked INTEGER')
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS sms_location_sequence
+            ON sms (location_id, sequence);''')
+    #rows queued before sequence numbers carry the old 1,<loc>,<message> payload, which every
+    #receiver discards as malformed, so number them and rebuild the payload
+    legacy = '''
+        SELECT rowid, location_id, message
+        FROM sms
+        WHERE sequence IS NULL AND time_received IS NULL
+        ORDER BY rowid;'''
+    if db.execute(legacy).fetchone():
+        if not db.in_transaction:
+            db.execute('BEGIN IMMEDIATE')
+        for rowid, location_id, message in db.execute(legacy).fetchall():
+            sequence = db.execute('''
+                SELECT IFNULL(MAX(sequence), 0) + 1 FROM sms WHERE location_id=?;''',
+                (location_id,)).fetchone()[0]
+            payload_raw = packet.encode_sms(location_id, sequence, message)
+            db.execute('''
+                UPDATE sms
+                SET sequence=?, payload_raw=?, payload_hex=?
+                WHERE rowid=?;''',
+                (sequence, payload_raw, payload_raw.encode('UTF-8').hex(), rowid))
+    #tx_candidates() runs every loop, keep it from scanning the whole history
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS sms_pending
+            ON sms (location_id, tx_count, time_queued)
+            WHERE time_received IS NULL AND time_acked IS NULL;''')
+    #cumulative acks need one row per sequence we originated (received copies may repeat)
+    try:
+        db.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS sms_origin_sequence
+                ON sms (location_id, sequence) WHERE time_received IS NULL;''')
+    except sqlite3.IntegrityError:
+        #rows queued before the index already repeat a sequence, new ones still
+        #get unique numbers from sms_queue.next_sequence()
+        pass
+    db.commit()
+
+#function: unacknowledged rows of our own location still within the retry limit
+#(a row without a sequence number could never be acked, see ensure_schema)
+def tx_candidates(db, my_location_id):
+    c = db.cursor()
+    c.execute('''
+        SELECT
+            rowid,
+            payload_hex,
+            tx_count,
+            time_sent
+        FROM
+            sms
+        WHERE
+            location_id=? AND time_received IS NULL AND time_acked IS NULL AND tx_count<?
+            AND sequence IS NOT NULL
+        ORDER BY
+            tx_count, time_queued;''',
+        (my_location_id, retry_limit))
+    rows = c.fetchall()
+    c.close()
+    return rows
+
+#function: next row due for transmission and when the next waiting row falls due
+#sent maps rowid to (tx_count, time_sent) of transmissions not yet committed by a db_worker
+def tx_plan(db, my_location_id, now, sent=None):
+    wake = None
+    for rowid, payload_hex, tx_count, time_sent in tx_candidates(db, my_location_id):
+        if sent and rowid in sent:
+            #the worker may commit (and drop the entry) while we look
+            tx_count, time_sent = sent.get(rowid, (tx_count, time_sent))
+            if tx_count >= retry_limit:
+                continue
+        if tx_count == 0 or time_sent is None:
+            return (rowid, payload_hex), now
+        due = time_sent + retry_delay(rowid, tx_count)
+        if now >= due:
+            return (rowid, payload_hex), now
+        if wake == None or due < wake:
+            wake = due
+    return None, wake
+
+#function: return rowid and payload hex of the next row due for transmission
+def tx_next(db, my_location_id, now, sent=None):
+    return tx_plan(db, my_location_id, now, sent)[0]
+
+#function: record a completed transmission (caller commits)
+def tx_complete(db, rowid, time_on_air, time_sent):
+    db.execute('''
+        UPDATE sms
+        SET time_on_air=?, time_sent=?, tx_count=tx_count+1
+        WHERE rowid=?;''',
+        (time_on_air, time_sent, rowid))
+
+#function: mark our own rows acknowledged up to and including cumulative (caller commits)
+def ack_received(db, my_location_id, cumulative, now):
+    c = db.cursor()
+    c.execute('''
+        UPDATE sms
+        SET time_acked=?
+        WHERE location_id=? AND time_received IS NULL AND time_acked IS NULL AND sequence<=?;''',
+        (now, my_location_id, cumulative))
+    count = c.rowcount
+    c.close()
+    return count
+
+#class: cumulative ack state for every origin this node has heard from
+class AckTracker:
+    def __init__(self):
+        self.cumulative = {}
+        self.pending = {}
+        self.dirty = set()
+        self.deadline = None
+
+    #function: seed tracker from sequences already stored in piers.db
+    #open gaps restart their timeout at now, skipping one early would ack a message never heard
+    def load(self, db, my_location_id, now):
+        c = db.cursor()
+        c.execute('''
+            SELECT DISTINCT location_id, sequence
+            FROM sms
+            WHERE location_id!=? AND time_received IS NOT NULL AND sequence IS NOT NULL
+            ORDER BY location_id, sequence;''',
+            (my_location_id,))
+        for origin, sequence in c.fetchall():
+            self.heard(origin, sequence, now)
+        c.close()
+        self.dirty.clear()
+        self.deadline = None
+
+    #function: note a received sequence, returns False if it was a duplicate
+    def heard(self, origin, sequence, now):
+        cumulative = self.cumulative.setdefault(origin, 0)
+        pending = self.pending.setdefault(origin, {})
+        duplicate = sequence <= cumulative or sequence in pending
+        if not duplicate:
+            pending[sequence] = now
+            self._advance(origin)
+        #always re-ack, a duplicate means the sender missed our last ack
+        self.dirty.add(origin)
+        if self.deadline is None:
+            self.deadline = now + random.randint(0, ack_delay)
+        return not duplicate
+
+    #function: another node acked an origin we owe, skip ours if it covers as much
+    def overheard(self, origin, cumulative):
+        if origin in self.dirty and cumulative >= self.cumulative.get(origin, 0):
+            self.dirty.discard(origin)
+            if not self.dirty:
+                self.deadline = None
+
+    #function: an ack frame from due() was never transmitted, owe its origins again
+    def refused(self, acks, now):
+        for origin, cumulative in acks:
+            self.dirty.add(origin)
+        if acks and self.deadline is None:
+            self.deadline = now
+
+    def _advance(self, origin):
+        pending = self.pending[origin]
+        while self.cumulative[origin] + 1 in pending:
+            self.cumulative[origin] += 1
+            del pending[self.cumulative[origin]]
+
+    #function: return (origin, cumulative) pairs to transmit now from location_id, if any
+    #only as many as encode to max_length bytes, the rest stay due for the next ack frame
+    def due(self, now, location_id, max_length=packet.max_length):
+        for origin, pending in self.pending.items():
+            if not pending:
+                continue
+            oldest = min(pending)
+            if now - pending[oldest] >= gap_timeout:
+                self.cumulative[origin] = oldest
+                del pending[oldest]
+                self._advance(origin)
+                self.dirty.add(origin)
+                if self.deadline is None:
+                    self.deadline = now
+        if self.deadline is None or now < self.deadline or not self.dirty:
+            return []
+        acks = []
+        for origin in sorted(self.dirty):
+            if self.cumulative[origin] == 0:
+                #nothing to acknowledge until the gap below the first sequence closes
+                self.dirty.discard(origin)
+                continue
+            if len(packet.encode_ack(location_id, acks + [(origin, self.cumulative[origin])])) \
+                    > max_length:
+                break
+            acks.append((origin, self.cumulative[origin]))
+            self.dirty.discard(origin)
+        if not self.dirty:
+            self.deadline = None
+        return acks
@@ -0,0 +1,340 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Database Benchmark                           #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module builds a synthetic piers.db at the scale #
+#                 of a long event (participants, locations, status     #
+#                 history and sms traffic), times the queries and      #
+#                 writes the PiERS modules really issue against it and #
+#                 reports the results as JSON, so schema and pragma    #
+#                 changes can be compared run against run.             #
+#                                                                      #
+########################################################################
+
+########################################################################
+# Bench Notes:  sms_view      the sms_view.py poll (new rows since the #
+#                             last marker, then MAX(rowid))            #
+#               sms_view_full the same query from rowid 0 (startup)    #
+#               sms_new       sms_new.database_entry(): connect,       #
+#                             sms_queue.insert(), commit, close        #
+#               tx_claim      lostik.py picking the next due row       #
+#                             (arq.tx_plan) and recording it sent      #
+#               rx_deposit    lostik.py storing one received sms with  #
+#                             its own commit                           #
+#               rx_group      the same through db_worker.py group      #
+#                             commit, per sms                          #
+#                                                                      #
+#               The benchmark database is created from scratch at      #
+#               --db (bench.db), never at piers.db.                    #
+########################################################################
+
+import argparse
+import arq
+import db_worker
+import json
+import os
+import platform
+import random
+import sms_queue
+import sql_create_db
+import sqlite3
+import sys
+import time
+
+#the sms_view.py poll query
+sms_view_query = '''
+    SELECT
+        location_id,
+        location_name,
+        message,
+        time_queued,
+        time_received,
+        rssi,
+        snr,
+        duplicate
+    FROM
+        locations
+    NATURAL JOIN
+        sms
+    WHERE
+        sms.rowid>? AND (duplicate='N' OR duplicate IS NULL);'''
+
+#the lostik.py received sms insert
+rx_insert = '''
+    INSERT INTO sms (
+        location_id,
+        sequence,
+        message,
+        payload_raw,
+        payload_hex,
+        time_received,
+        rssi,
+        snr,
+        duplicate)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);'''
+
+first_names = ['Kyle', 'Ava', 'Noah', 'Mia', 'Liam', 'Emma', 'Owen', 'Zoe', 'Eli', 'Ruby',
+               'Jack', 'Nora', 'Finn', 'Ivy', 'Cole', 'Lena', 'Gus', 'Tess', 'Hank', 'June']
+last_names = ['Smith', 'Clement', 'Garcia', 'Nguyen', 'Baker', 'Reyes', 'Olsen', 'Park',
+              'Hughes', 'Moreno', 'Price', 'Walsh', 'Kim', 'Ford', 'Lane', 'Stone']
+words = ['bib', 'through', 'at', 'aid', 'station', 'dropped', 'medical', 'water', 'low',
+         'need', 'ice', 'runner', 'ok', 'sweep', 'passed', 'cutoff', 'radio', 'check', 'eta']
+statuses = ['active', 'active', 'active', 'dnf', 'dns', 'finished']
+
+#event length the synthetic timestamps are spread over (milliseconds)
+event_ms = 36 * 3600000
+event_start = 1600000000000
+
+#function: random sms text that passes sms_queue.validate_message()
+def random_message(rng):
+    message = ' '.join(rng.choice(words) for _ in range(rng.randint(2, 8)))
+    if rng.random() < 0.5:
+        message = 'bib ' + str(rng.randint(1, 9999)) + ' ' + message
+    return message[:50].rstrip()
+
+#function: create and fill the benchmark database, returns seconds taken
+def generate(path, participants, locations, messages, status_events, pending, my_location_id,
+             pragmas, rng):
+    start_time = time.perf_counter()
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    db = connect(path, pragmas)
+    #the real piers.db schema, so the benchmark follows every table and index change
+    sql_create_db.ensure_schema(db)
+    with db:
+        db.executemany('INSERT INTO locations (location_id, location_name) VALUES (?, ?)',
+                       [(location_id, 'Aid Station ' + str(location_id))
+                        for location_id in range(1, locations + 1)])
+        db.executemany('''
+            INSERT INTO participants (
+                participant_id,
+                participant_first_name,
+                participant_last_name,
+                participant_gender,
+                participant_age,
+                participant_city,
+                participant_state,
+                participant_emergency_name,
+                participant_emergency_phone)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);''',
+            [(participant_id, rng.choice(first_names), rng.choice(last_names),
+              rng.choice('MF'), rng.randint(18, 75), 'Boise', 'ID',
+              rng.choice(first_names), '208555' + str(participant_id % 10000).zfill(4))
+             for participant_id in range(1, participants + 1)])
+    with db:
+        db.executemany('''
+            INSERT INTO status (participant_id, location_id, status, time_logged)
+            VALUES (?, ?, ?, ?);''',
+            sorted(((rng.randint(1, participants), rng.randint(1, locations), rng.choice(statuses),
+                     event_start + rng.randrange(event_ms)) for _ in range(status_events)),
+                   key=lambda row: row[3]))
+    #sms arrive in time order, every location counts its own sequence
+    sequences = {}
+    rows = []
+    times = sorted(rng.randrange(event_ms) for _ in range(messages))
+    for index, offset in enumerate(times):
+        location_id = rng.randint(1, locations)
+        sequence = sequences[location_id] = sequences.get(location_id, 0) + 1
+        message = random_message(rng)
+        payload_raw = ','.join(['1', str(location_id), str(sequence), message])
+        time_queued = event_start + offset
+        if location_id == my_location_id:
+            if index >= messages - pending:
+                #still waiting for an ack, some already tried
+                tx_count = rng.randint(0, 3)
+                time_sent = time_queued + 5000 if tx_count else None
+                time_acked = None
+            else:
+                tx_count = 1
+                time_sent = time_queued + 5000
+                time_acked = time_sent + 20000
+            rows.append((location_id, sequence, message, payload_raw, payload_raw.encode('ASCII').hex(),
+                         time_queued, time_sent, time_sent, time_acked, tx_count, None, None, None, None))
+        else:
+            duplicate = 'Y' if rng.random() < 0.05 else 'N'
+            rows.append((location_id, sequence, message, payload_raw, payload_raw.encode('ASCII').hex(),
+                         None, None, None, None, None, time_queued + 8000, rng.randint(-125, -60),
+                         rng.randint(-15, 10), duplicate))
+    with db:
+        db.executemany('''
+            INSERT INTO sms (
+                location_id,
+                sequence,
+                message,
+                payload_raw,
+                payload_hex,
+                time_queued,
+                time_on_air,
+                time_sent,
+                time_acked,
+                tx_count,
+                time_received,
+                rssi,
+                snr,
+                duplicate)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''', rows)
+    db.execute('ANALYZE')
+    db.close()
+    return time.perf_counter() - start_time
+
+#function: open a connection with foreign keys on and the pragmas under test
+def connect(path, pragmas):
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA foreign_keys = ON')
+    for pragma in pragmas:
+        db.execute('PRAGMA ' + pragma)
+    return db
+
+#function: summary of a list of millisecond timings
+def summarize(timings_ms):
+    timings_ms = sorted(timings_ms)
+    count = len(timings_ms)
+    def percentile(fraction):
+        return round(timings_ms[min(int(fraction * count), count - 1)], 4)
+    total = sum(timings_ms)
+    return {'count': count,
+            'mean_ms': round(total / count, 4),
+            'p50_ms': percentile(0.5),
+            'p90_ms': percentile(0.9),
+            'p99_ms': percentile(0.99),
+            'max_ms': round(timings_ms[-1], 4),
+            'ops_per_s': round(count / (total / 1000), 1) if total else None}
+
+#function: time function() repeat times, returns the summary
+def timed(function, repeat):
+    timings_ms = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        timings_ms.append((time.perf_counter() - start_time) * 1000)
+    return summarize(timings_ms)
+
+#function: run every benchmark against the generated database
+def run(path, pragmas, repeat, locations, my_location_id, rng):
+    results = {}
+    db = connect(path, pragmas)
+    max_rowid = db.execute('SELECT MAX(rowid) FROM sms').fetchone()[0]
+
+    #sms_view.py: a poll that finds the latest few rows, then its marker query
+    def sms_view():
+        db.execute(sms_view_query, (max_rowid - 5,)).fetchall()
+        db.execute('SELECT MAX(rowid) FROM sms').fetchone()
+    results['sms_view'] = timed(sms_view, repeat)
+    results['sms_view_full'] = timed(lambda: db.execute(sms_view_query, (0,)).fetchall(),
+                                     max(repeat // 50, 3))
+
+    #sms_new.py: one message per process, its own connection and commit
+    def sms_new():
+        new_db = connect(path, pragmas)
+        sms_queue.insert(new_db, my_location_id, random_message(rng), event_start + event_ms)
+        new_db.commit()
+        new_db.close()
+    results['sms_new'] = timed(sms_new, repeat)
+
+    #lostik.py: pick the next due row and record the transmission
+    now = [event_start + event_ms]
+    def tx_claim():
+        now[0] += 60000
+        next_tx = arq.tx_next(db, my_location_id, now[0])
+        if next_tx:
+            arq.tx_complete(db, next_tx[0], now[0], now[0] + 3000)
+            db.commit()
+    results['tx_claim'] = timed(tx_claim, repeat)
+
+    #lostik.py: one received sms per commit
+    sequence = [10**6]
+    def rx_row():
+        sequence[0] += 1
+        location_id = rng.choice([loc for loc in range(1, locations + 1) if loc != my_location_id]
+                                 or [my_location_id % 99 + 1])
+        message = random_message(rng)
+        payload_raw = ','.join(['1', str(location_id), str(sequence[0]), message])
+        return (location_id, sequence[0], message, payload_raw, payload_raw.encode('ASCII').hex(),
+                event_start + event_ms, -90, 5, 'N')
+    def rx_deposit():
+        db.execute(rx_insert, rx_row())
+        db.commit()
+    results['rx_deposit'] = timed(rx_deposit, repeat)
+    db.close()
+
+    #lostik.py since the group commit writer: submit every row, then wait for the last commit
+    writer = db_worker.DatabaseWorker(path)
+    writer.start()
+    rows = [rx_row() for _ in range(repeat)]
+    start_time = time.perf_counter()
+    for row in rows:
+        writer.submit(lambda wdb, values: wdb.execute(rx_insert, values), row)
+    writer.flush()
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    writer.close()
+    results['rx_group'] = {'count': repeat,
+                           'mean_ms': round(elapsed_ms / repeat, 4),
+                           'ops_per_s': round(repeat / (elapsed_ms / 1000), 1),
+                           'commits': writer.commits,
+                           'commit_ms_max': round(writer.commit_ms_max, 4)}
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PiERS Module - Database Benchmark',
+                                     epilog='Created by K7CTC. This module builds a synthetic '
+                                            'piers.db at event scale, times the queries and writes '
+                                            'the PiERS modules issue and reports JSON.')
+    parser.add_argument('--db', default='bench.db',
+                        help='benchmark database, recreated on every run (default: bench.db)')
+    parser.add_argument('--messages', type=int, default=100000,
+                        help='sms rows (default: 100000)')
+    parser.add_argument('--participants', type=int, default=10000,
+                        help='participants (default: 10000)')
+    parser.add_argument('--locations', type=int, choices=range(1, 100), metavar='{1..99}',
+                        default=20, help='locations (default: 20)')
+    parser.add_argument('--status', type=int, default=None,
+                        help='status events (default: 5 per participant)')
+    parser.add_argument('--pending', type=int, default=50,
+                        help='own sms still waiting for an ack (default: 50)')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='timed repetitions per benchmark (default: 200)')
+    parser.add_argument('--pragma', action='append', default=[], metavar='NAME=VALUE',
+                        help='pragma applied to every connection, repeatable '
+                             '(e.g. journal_mode=WAL, synchronous=NORMAL)')
+    parser.add_argument('--label', default=None,
+                        help='free text stored with the results (e.g. the change under test)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='random seed (default: 1)')
+    parser.add_argument('--output', default=None,
+                        help='write the JSON results to a file instead of stdout')
+    args = parser.parse_args()
+
+    if os.path.basename(args.db) == 'piers.db':
+        print('ERROR: The benchmark recreates its database, refusing to use piers.db')
+        sys.exit(1)
+    if args.status == None:
+        args.status = args.participants * 5
+    rng = random.Random(args.seed)
+    my_location_id = 1
+    generate_s = generate(args.db, args.participants, args.locations, args.messages, args.status,
+                          args.pending, my_location_id, args.pragma, rng)
+    results = run(args.db, args.pragma, args.repeat, args.locations, my_location_id, rng)
+    report = {'label': args.label,
+              'time': int(round(time.time()*1000)),
+              'python': platform.python_version(),
+              'sqlite': sqlite3.sqlite_version,
+              'platform': platform.platform(),
+              'scale': {'messages': args.messages,
+                        'participants': args.participants,
+                        'locations': args.locations,
+                        'status': args.status,
+                        'pending': args.pending},
+              'pragmas': args.pragma,
+              'repeat': args.repeat,
+              'seed': args.seed,
+              'generate_s': round(generate_s, 3),
+              'db_bytes': os.path.getsize(args.db),
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=1)
+            file.write('\n')
+    else:
+        print(json.dumps(report, indent=1))
@@ -0,0 +1,129 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Channel Access                               #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module decides when a node may transmit on the  #
+#                 shared PiERS channel.  It supports plain ALOHA       #
+#                 (transmit immediately), listen-before-talk with      #
+#                 randomized exponential backoff and TDMA, where each  #
+#                 location_id owns a transmit slot.  The same logic    #
+#                 drives both lostik.py and simulator.py.              #
+#                                                                      #
+########################################################################
+
+########################################################################
+# Channel Notes:  The RN2903 has no channel activity detection command #
+#                 so listen-before-talk sends radio rx with a window   #
+#                 of sense_symbols.  The radio gives up with radio_err #
+#                 when no preamble starts within that many symbols.    #
+#                 Once a preamble locks it keeps receiving until the   #
+#                 frame ends and reports the frame.  radio_err on time #
+#                 means the channel is idle.  Anything else (a frame,  #
+#                 a CRC error, silence past the window) counts as      #
+#                 busy, as does any packet received recently.  A busy  #
+#                 node backs off a random number of backoff units,     #
+#                 doubling the range each time the channel is busy.    #
+#                                                                      #
+#                 Only a preamble is detectable.  A frame already past #
+#                 its preamble when the window opens goes unheard and  #
+#                 the transmission collides with it.  sense_ms is 16   #
+#                 symbols (524 ms at SF12), longer than the 12.25      #
+#                 symbol preamble and sync word.                       #
+#                                                                      #
+#                 TDMA slots are taken from the network clock kept by  #
+#                 time sync beacons (see timesync.py).  guard_ms at    #
+#                 each end of the slot absorbs the remaining clock     #
+#                 error, lostik.py shrinks it as sync quality allows.  #
+########################################################################
+
+import math
+import random
+
+#channel access modes
+modes = ('aloha', 'lbt', 'tdma')
+
+#symbols in a listen-before-talk sense window (see Channel Notes)
+sense_symbols = 16
+
+#function: LoRa symbol time in milliseconds
+def symbol_ms(sf=12, bw=125000):
+    return (2 ** sf) / bw * 1000
+
+#function: LoRa time on air in milliseconds (Semtech AN1200.13)
+def airtime(payload_length, sf=12, bw=125000, cr=5, preamble=8, crc=True, header=True):
+    symbol = symbol_ms(sf, bw)
+    #low data rate optimization is mandatory when a symbol exceeds 16 ms
+    de = 1 if symbol > 16 else 0
+    h = 0 if header else 1
+    numerator = 8 * payload_length - 4 * sf + 28 + (16 if crc else 0) - 20 * h
+    payload_symbols = 8 + max(math.ceil(numerator / (4 * (sf - 2 * de))) * cr, 0)
+    return (preamble + 4.25) * symbol + payload_symbols * symbol
+
+#class: transmit permission for one node
+class ChannelAccess:
+    def __init__(self, mode, location_id, slots=4, slot_ms=10000, guard_ms=500,
+                 sense_ms=sense_symbols * symbol_ms(), backoff_ms=1000, max_exponent=6, max_attempts=10, rng=None):
+        self.mode = mode
+        self.location_id = location_id
+        self.slots = slots
+        self.slot_ms = slot_ms
+        self.guard_ms = guard_ms
+        self.sense_ms = sense_ms
+        self.backoff_ms = backoff_ms
+        self.max_exponent = max_exponent
+        self.max_attempts = max_attempts
+        self.rng = rng or random.Random()
+        self.attempts = 0
+        self.backoff_until = 0
+        #slots are not shared, two locations in one slot would collide inside it every frame
+        if mode == 'tdma' and not 1 <= location_id <= slots:
+            raise ValueError('location id ' + str(location_id) + ' has no TDMA slot, slots=' + str(slots))
+
+    #function: True if a transmission of airtime_ms can ever be made (TDMA: it fits inside a slot)
+    def fits(self, airtime_ms):
+        return self.mode != 'tdma' or airtime_ms <= self.slot_ms - 2 * self.guard_ms
+
+    #function: True if a sensing window should precede the transmission
+    def needs_sense(self):
+        return self.mode == 'lbt'
+
+    #function: milliseconds to wait before this node may transmit airtime_ms of data
+    #None if it never may, a frame longer than the slot would run into the next owner's slot
+    def wait_time(self, now, airtime_ms):
+        if self.mode == 'lbt':
+            return max(0, self.backoff_until - now)
+        if self.mode == 'tdma':
+            if not self.fits(airtime_ms):
+                return None
+            frame_ms = self.slots * self.slot_ms
+            slot_start = (self.location_id - 1) * self.slot_ms + self.guard_ms
+            #latest start that still ends a guard interval before the slot does
+            window_ms = self.slot_ms - 2 * self.guard_ms - airtime_ms
+            offset = (now - slot_start) % frame_ms
+            if offset <= window_ms:
+                return 0
+            return frame_ms - offset
+        return 0
+
+    #function: record the result of a sensing window, returns False to give up on the packet
+    def sensed(self, now, busy):
+        if not busy:
+            self.attempts = 0
+            return True
+        self.attempts += 1
+        if self.attempts > self.max_attempts:
+            self.attempts = 0
+            return False
+        self._backoff(now, self.attempts)
+        return True
+
+    #function: note a packet heard on the channel, others may answer it so hold off briefly
+    def heard(self, now):
+        if self.mode == 'lbt':
+            self._backoff(now, 1)
+
+    def _backoff(self, now, exponent):
+        slots = 2 ** min(exponent, self.max_exponent)
+        self.backoff_until = max(self.backoff_until,
+                                 now + self.rng.randint(1, slots) * self.backoff_ms)
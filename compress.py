@@ -0,0 +1,118 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Compression                                  #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module shrinks over the air packets using a     #
+#                 static deflate dictionary trained on the event       #
+#                 vocabulary (location names, participant names, bib   #
+#                 numbers and stock phrases).  The dictionary is built #
+#                 from piers.db before the event and copied to every   #
+#                 node as piers.dict.                                  #
+#                                                                      #
+########################################################################
+
+########################################################################
+# Compression Notes:  A compressed packet is framed as                 #
+#                                                                      #
+#                     5,<loc>,<version>,<raw deflate of inner packet>  #
+#                                                                      #
+#                     where version is the first four hex digits of    #
+#                     the SHA-1 of piers.dict.  A node holding a       #
+#                     different dictionary (or none) drops the packet  #
+#                     rather than decoding garbage, and the sender's   #
+#                     retransmission keeps it queued.  Packets are     #
+#                     only sent compressed when that is smaller.       #
+#                                                                      #
+#                     Deflate favours the end of the dictionary, so    #
+#                     the most frequent strings are placed last.       #
+########################################################################
+
+import collections
+import hashlib
+import packet
+import re
+import zlib
+from pathlib import Path
+
+#deflate can only reference the last 32 KiB of a preset dictionary
+max_dictionary_size = 32768
+
+#phrases common to status traffic regardless of event
+stock_phrases = ['arrived at', 'departed', 'checked in', 'checked out', 'did not start',
+                 'did not finish', 'dropped at', 'medical', 'needs transport', 'all clear',
+                 'on course', 'off course', 'water', 'supplies', 'copy that', 'please confirm',
+                 'how many', 'runners', 'bib', 'last seen', 'passed', 'cutoff', 'status',
+                 'roger', 'thanks', 'ok', 'yes', 'no', '?', '!', '.']
+
+#function: build dictionary bytes from the event tables and sms history of piers.db
+#before (optional) limits the history to rows with a lower rowid, leaving the rest to test on
+def build(db, before=None):
+    weights = collections.Counter()
+    for phrase in stock_phrases:
+        weights[phrase] += 1
+    for location_id, location_name in db.execute('SELECT location_id, location_name FROM locations'):
+        weights[location_name] += 2
+        #packet headers of every location compress down to a back reference
+        weights[str(packet.PACKET_SMS) + ',' + str(location_id) + ','] += 4
+    for participant_id, first_name, last_name in db.execute('''
+            SELECT participant_id, participant_first_name, participant_last_name
+            FROM participants;'''):
+        weights[str(participant_id)] += 1
+        weights[' '.join(name for name in (first_name, last_name) if name)] += 1
+    #words and word pairs that actually appear in earlier traffic
+    if before == None:
+        history = db.execute('SELECT message FROM sms')
+    else:
+        history = db.execute('SELECT message FROM sms WHERE rowid<?', (before,))
+    for (message,) in history:
+        words = re.findall('[A-Za-z0-9]+', message)
+        for word in words:
+            if len(word) > 2:
+                weights[word] += 1
+        for pair in zip(words, words[1:]):
+            weights[' '.join(pair)] += 1
+    ordered = sorted(weights, key=lambda text: (weights[text], len(text), text))
+    dictionary = ' '.join(ordered).encode('ASCII', 'ignore')
+    return dictionary[-max_dictionary_size:]
+
+#function: version tag of a dictionary
+def version(dictionary):
+    return hashlib.sha1(dictionary).hexdigest()[:4]
+
+#function: read piers.dict, returns (version, dictionary) or None
+def load(path='piers.dict'):
+    if Path(path).is_file() == False:
+        return None
+    dictionary = Path(path).read_bytes()
+    return version(dictionary), dictionary
+
+#function: compress a raw deflate stream against the dictionary
+def deflate(dictionary, data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    return compressor.compress(data) + compressor.flush()
+
+#function: reverse of deflate, returns None on corrupt data
+def inflate(dictionary, data):
+    try:
+        decompressor = zlib.decompressobj(-15, dictionary)
+        return decompressor.decompress(data) + decompressor.flush()
+    except zlib.error:
+        return None
+
+#function: frame packet bytes compressed if that saves space, otherwise return unchanged
+def wrap(loaded, location_id, payload):
+    if loaded == None:
+        return payload
+    tag, dictionary = loaded
+    header = ','.join([str(packet.PACKET_COMPRESSED), str(location_id), tag]).encode('ASCII')
+    framed = header + b',' + deflate(dictionary, payload)
+    if len(framed) < len(payload):
+        return framed
+    return payload
+
+#function: recover inner packet bytes, None if our dictionary does not match
+def unwrap(loaded, rx_packet):
+    if loaded == None or rx_packet['version'] != loaded[0]:
+        return None
+    return inflate(loaded[1], rx_packet['data'])
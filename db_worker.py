@@ -0,0 +1,244 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Database Worker                              #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.2                                                 #
+#   DESCRIPTION:  This module runs every piers.db write of lostik.py   #
+#                 on its own thread, fed by a bounded queue, so a slow #
+#                 microSD commit never holds up the serial port.  The  #
+#                 radio thread hands over small jobs and carries on;   #
+#                 when the queue is full it waits (backpressure)       #
+#                 rather than letting memory grow without bound.       #
+#                                                                      #
+########################################################################
+
+########################################################################
+# Commit Notes:  Jobs are group committed.  The first job of a batch   #
+#                opens a transaction and the worker keeps running the  #
+#                jobs that arrive until commit_ms have passed or       #
+#                commit_batch jobs have run, then commits once.  A     #
+#                burst of received packets and tx updates costs one    #
+#                fsync instead of one per packet.                      #
+#                                                                      #
+#                Durability bound: a job that has reached the worker   #
+#                is on disk within commit_ms plus the time the commit  #
+#                itself takes.  Only if the queue is backed up does a  #
+#                job also wait its turn.  The worst case seen (submit  #
+#                to commit) is exported as at_risk_ms_max.  Call       #
+#                flush() before telling another node something is safe #
+#                (lostik.py flushes before sending acks).  Each job    #
+#                runs in its own savepoint, so one failing job does    #
+#                not discard the rest of its batch.  A job may return  #
+#                a function to run once its batch is committed.        #
+#                commit_ms=0 commits every job on its own.  Other      #
+#                writers of piers.db (sms_service.py etc.) may wait up #
+#                to one window for the write lock.                     #
+#                                                                      #
+#                If the worker thread dies, submit() and flush() raise #
+#                WorkerStopped instead of waiting on a queue that      #
+#                nobody drains.                                        #
+########################################################################
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+#jobs waiting before submit() blocks the radio thread
+queue_size = 256
+#group commit window (milliseconds) and most jobs per commit
+commit_ms = 500
+commit_batch = 64
+#log a warning when submit() had to wait this long (milliseconds)
+stall_warning = 1000
+
+#marker job asking for an immediate commit
+FLUSH = object()
+
+#exception: raised to the radio thread once the worker is gone
+class WorkerStopped(Exception):
+    pass
+
+#class: writer thread owning its own piers.db connection
+class DatabaseWorker(threading.Thread):
+    def __init__(self, path, maxsize=queue_size, commit_ms=commit_ms, commit_batch=commit_batch):
+        super().__init__(name='db_worker', daemon=True)
+        self.path = path
+        self.commit_ms = commit_ms
+        self.commit_batch = max(commit_batch, 1)
+        self.jobs = queue.Queue(maxsize=maxsize)
+        #figures for metrics(), updated without locks (single writer each)
+        self.submitted = 0
+        self.completed = 0
+        self.committed = 0
+        self.failed = 0
+        self.commits = 0
+        self.high_water = 0
+        self.stalls = 0
+        self.stall_ms_max = 0
+        self.batch_max = 0
+        self.commit_ms_max = 0
+        self.at_risk_ms_max = 0
+        #functions returned by jobs of the open batch, run after its commit
+        self.after_commit = []
+        #the exception that ended the worker, if one did
+        self.error = None
+
+    #function: raise WorkerStopped if the worker thread has died
+    def check_alive(self):
+        if not self.is_alive():
+            raise WorkerStopped('database worker is not running' +
+                                ('' if self.error == None else ': ' + repr(self.error)))
+
+    #function: queue function(db, *args) to run on the worker, blocks while the queue is full
+    def submit(self, function, *args):
+        self.check_alive()
+        job = (function, args, time.perf_counter())
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            self.stalls += 1
+            stall_start = time.perf_counter()
+            #wake up now and then, a dead worker would leave us waiting forever
+            while True:
+                try:
+                    self.jobs.put(job, timeout=1)
+                    break
+                except queue.Full:
+                    self.check_alive()
+            stall_ms = (time.perf_counter() - stall_start) * 1000
+            self.stall_ms_max = max(self.stall_ms_max, stall_ms)
+            if stall_ms >= stall_warning:
+                logging.warning('Database queue full, radio waited %.0f ms', stall_ms)
+        if function is not FLUSH:
+            self.submitted += 1
+        self.high_water = max(self.high_water, self.jobs.qsize())
+
+    #function: wait until every job submitted so far is committed, returns False on timeout
+    def flush(self, timeout=10):
+        if self.committed + self.failed >= self.submitted:
+            return True
+        done = threading.Event()
+        self.submit(FLUSH, done)
+        deadline = time.perf_counter() + timeout
+        while not done.wait(min(1, max(deadline - time.perf_counter(), 0))):
+            if time.perf_counter() >= deadline:
+                return False
+            self.check_alive()
+        return True
+
+    #function: the worker thread, logs whatever ends it so submit() can report it
+    def run(self):
+        try:
+            self._run()
+        except BaseException as error:
+            self.error = error
+            logging.exception('Database worker stopped!')
+
+    #function: the worker loop, one commit per batch of jobs
+    def _run(self):
+        db = sqlite3.connect(self.path)
+        #transactions are opened and closed here, not implicitly by the sqlite3 module
+        db.isolation_level = None
+        db.execute('PRAGMA foreign_keys = ON')
+        stopping = False
+        while not stopping:
+            job = self.jobs.get()
+            batch_start = time.perf_counter()
+            oldest = None
+            count = 0
+            succeeded = 0
+            flushed = []
+            db.execute('BEGIN')
+            while True:
+                if job == None:
+                    stopping = True
+                    break
+                function, args, time_submitted = job
+                if function is FLUSH:
+                    flushed.append(args[0])
+                    break
+                if oldest == None:
+                    oldest = time_submitted
+                if self._run_job(db, function, args):
+                    succeeded += 1
+                count += 1
+                remaining = self.commit_ms / 1000 - (time.perf_counter() - batch_start)
+                if count >= self.commit_batch or remaining <= 0:
+                    break
+                try:
+                    job = self.jobs.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            commit_start = time.perf_counter()
+            try:
+                db.execute('COMMIT')
+            except sqlite3.Error as error:
+                #a failed COMMIT may already have ended the transaction
+                if db.in_transaction:
+                    try:
+                        db.execute('ROLLBACK')
+                    except sqlite3.Error:
+                        pass
+                logging.error('Database commit failure, %s job(s) lost! %s', succeeded, str(error))
+                self.failed += succeeded
+                succeeded = 0
+                self.after_commit.clear()
+            for function in self.after_commit:
+                function()
+            self.after_commit.clear()
+            commit_end = time.perf_counter()
+            self.committed += succeeded
+            if count:
+                self.commits += 1
+                self.batch_max = max(self.batch_max, count)
+                self.commit_ms_max = max(self.commit_ms_max, (commit_end - commit_start) * 1000)
+                self.at_risk_ms_max = max(self.at_risk_ms_max, (commit_end - oldest) * 1000)
+            for done in flushed:
+                done.set()
+        db.close()
+
+    #function: run one job inside a savepoint of the open batch, returns False if it failed
+    def _run_job(self, db, function, args):
+        db.execute('SAVEPOINT job')
+        succeeded = True
+        try:
+            result = function(db, *args)
+            if callable(result):
+                self.after_commit.append(result)
+        except Exception as error:
+            db.execute('ROLLBACK TO job')
+            self.failed += 1
+            succeeded = False
+            if isinstance(error, sqlite3.Error):
+                logging.error('Database entry failure! ' + str(error))
+            else:
+                logging.exception('Database job failure')
+        db.execute('RELEASE job')
+        self.completed += 1
+        return succeeded
+
+    #function: commit every queued job, then stop the worker
+    def close(self, timeout=30):
+        if self.is_alive():
+            self.jobs.put(None)
+            self.join(timeout)
+
+    #function: queue and commit health for metrics.export()
+    def metrics(self):
+        return {'depth': self.jobs.qsize(),
+                'capacity': self.jobs.maxsize,
+                'high_water': self.high_water,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'stalls': self.stalls,
+                'stall_ms_max': round(self.stall_ms_max, 1),
+                'commit_window_ms': self.commit_ms,
+                'commit_batch': self.commit_batch,
+                'commits': self.commits,
+                'jobs_per_commit': round(self.committed / self.commits, 2) if self.commits else None,
+                'batch_max': self.batch_max,
+                'commit_ms_max': round(self.commit_ms_max, 1),
+                'at_risk_ms_max': round(self.at_risk_ms_max, 1)}
@@ -0,0 +1,102 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Build Compression Dictionary                 #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This script trains piers.dict from the locations,    #
+#                 participants and sms tables of piers.db.  Copy the   #
+#                 resulting file to every node before the event.  It   #
+#                 can also benchmark compression, training on earlier  #
+#                 sms history and testing on the rows that follow.     #
+#                                                                      #
+########################################################################
+
+import argparse
+import compress
+import sqlite3
+import sys
+import zlib
+from pathlib import Path
+
+parser = argparse.ArgumentParser(description='PiERS - Build Compression Dictionary',
+                                 epilog='Created by K7CTC. This script trains piers.dict from the '
+                                        'locations, participants and sms tables of piers.db. Copy '
+                                        'the resulting file to every node before the event.')
+parser.add_argument('--db', default='piers.db',
+                    help='database to train from (default: piers.db)')
+parser.add_argument('--benchmark', action='store_true',
+                    help='train a dictionary on the earlier sms history and report its '
+                         'compression ratio on those rows and on the held out later rows, '
+                         'instead of building piers.dict')
+parser.add_argument('--train', type=float, default=0.8,
+                    help='fraction of sms history (oldest first) to train on in benchmark mode '
+                         '(default: 0.8)')
+args = parser.parse_args()
+
+if not 0 < args.train < 1:
+    print('ERROR: --train must be between 0 and 1!')
+    sys.exit(1)
+
+if Path(args.db).is_file() == False:
+    print('ERROR: File not found - ' + args.db)
+    sys.exit(1)
+
+db = sqlite3.connect(args.db)
+
+if not args.benchmark:
+    if Path('piers.dict').is_file():
+        print('ERROR: piers.dict already exists')
+        sys.exit(1)
+    dictionary = compress.build(db)
+    Path('piers.dict').write_bytes(dictionary)
+    db.close()
+    print('PASS! piers.dict version ' + compress.version(dictionary) +
+          ' (' + str(len(dictionary)) + ' bytes)')
+    sys.exit(0)
+
+#function: compare plain, generic deflate and dictionary deflate on a list of payloads
+def measure(loaded, payloads):
+    plain_bytes = 0
+    generic_bytes = 0
+    dictionary_bytes = 0
+    framed_bytes = 0
+    for payload in payloads:
+        plain_bytes += len(payload)
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        generic_bytes += len(compressor.compress(payload) + compressor.flush())
+        dictionary_bytes += len(compress.deflate(loaded[1], payload))
+        framed_bytes += len(compress.wrap(loaded, 1, payload))
+    return plain_bytes, generic_bytes, dictionary_bytes, framed_bytes
+
+#function: print one benchmark table
+def report(title, count, plain_bytes, generic_bytes, dictionary_bytes, framed_bytes):
+    print(title)
+    print(f'  packets:             {count}')
+    print(f'  plain:               {plain_bytes} bytes ({plain_bytes / count:.1f} per packet)')
+    print(f'  generic deflate:     {generic_bytes} bytes (ratio {plain_bytes / generic_bytes:.2f})')
+    print(f'  dictionary deflate:  {dictionary_bytes} bytes '
+          f'(ratio {plain_bytes / dictionary_bytes:.2f})')
+    print(f'  on air (framed):     {framed_bytes} bytes (ratio {plain_bytes / framed_bytes:.2f})')
+
+#split the real payloads by rowid, the dictionary only ever sees the earlier part
+rows = [(rowid, payload_raw.encode('ASCII', 'ignore')) for rowid, payload_raw in db.execute('''
+            SELECT rowid, payload_raw
+            FROM sms
+            WHERE duplicate IS NOT 'Y'
+            ORDER BY rowid;''')]
+split = int(len(rows) * args.train)
+if split == 0 or split == len(rows):
+    print('ERROR: Not enough sms history to split into training and test rows!')
+    sys.exit(1)
+cutoff = rows[split][0]
+dictionary = compress.build(db, before=cutoff)
+db.close()
+loaded = (compress.version(dictionary), dictionary)
+
+print(f'dictionary version:  {loaded[0]} ({len(dictionary)} bytes, '
+      f'trained on sms rowid < {cutoff})')
+report('training rows (in sample):', split,
+       *measure(loaded, [payload for _, payload in rows[:split]]))
+report('held out rows (out of sample):', len(rows) - split,
+       *measure(loaded, [payload for _, payload in rows[split:]]))
+sys.exit(0)
@@ -0,0 +1,69 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Duty Cycle                                   #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module holds the shared wake schedule of the    #
+#                 low power mode.  Every node is awake for the first   #
+#                 awake_ms of each cycle_ms of network time, receives  #
+#                 and transmits its batched traffic then, and sleeps   #
+#                 (RN2903 sys sleep) for the rest of the cycle.        #
+#                                                                      #
+########################################################################
+
+########################################################################
+# Cycle Notes:  The schedule is read from the network clock, so nodes  #
+#               in low power mode need time sync beacons from a        #
+#               --time-master (see timesync.py).  An unsynced node     #
+#               still wakes on schedule by its own clock and widens    #
+#               its window by wake_guard_ms at each end.  Retries and  #
+#               acks that fall due while asleep wait for the next      #
+#               window, so latency grows to about one cycle.           #
+########################################################################
+
+#shortest sleep worth sending to the RN2903 (sys sleep minimum is 100 ms)
+min_sleep_ms = 1000
+#extra awake time at each end of the window for an unsynced clock
+wake_guard_ms = 2000
+
+#class: wake schedule of one node
+class DutyCycle:
+    def __init__(self, cycle_ms, awake_ms):
+        if cycle_ms <= 0:
+            raise ValueError('cycle must be positive')
+        if not 0 < awake_ms <= cycle_ms:
+            raise ValueError('awake time must be positive and no longer than the cycle')
+        self.cycle_ms = cycle_ms
+        self.awake_ms = awake_ms
+        #statistics for metrics()
+        self.sleeps = 0
+        self.slept_ms = 0
+
+    #function: fraction of each cycle spent awake
+    def fraction(self):
+        return self.awake_ms / self.cycle_ms
+
+    #function: milliseconds left in the current awake window (0 when asleep), guard_ms widens it
+    def awake_remaining(self, now, guard_ms=0):
+        offset = (now + guard_ms) % self.cycle_ms
+        if offset < self.awake_ms + 2 * guard_ms:
+            return self.awake_ms + 2 * guard_ms - offset
+        return 0
+
+    #function: milliseconds until the next awake window opens, guard_ms opens it early
+    def sleep_time(self, now, guard_ms=0):
+        if self.awake_remaining(now, guard_ms) > 0:
+            return 0
+        return self.cycle_ms - (now + guard_ms) % self.cycle_ms
+
+    #function: note a completed sleep
+    def slept(self, sleep_ms):
+        self.sleeps += 1
+        self.slept_ms += sleep_ms
+
+    #function: schedule and sleep statistics for metrics.export()
+    def metrics(self):
+        return {'cycle_ms': self.cycle_ms,
+                'awake_ms': self.awake_ms,
+                'sleeps': self.sleeps,
+                'slept_ms': int(self.slept_ms)}
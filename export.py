@@ -0,0 +1,377 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Columnar Export                              #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module streams sms traffic, link quality and    #
+#                 participant status out of piers.db (or a master      #
+#                 database from sql_merge_db.py) into one NumPy .npy   #
+#                 file per column, ready to memory map into NumPy or   #
+#                 pandas for coverage and airtime analysis.  NumPy is  #
+#                 not needed to export, only to load.                  #
+#                                                                      #
+########################################################################
+
+########################################################################
+# Export Notes:  Rows are read in chunks (--chunk) and appended to     #
+#                each column file as they arrive, so memory stays      #
+#                bounded however large the history.  The .npy header   #
+#                is written last, once the row count is known.         #
+#                                                                      #
+#                Columns use the narrowest type that fits: u1 location #
+#                ids, i2 rssi, i1 snr, i8 millisecond timestamps.  A   #
+#                NULL is stored as the null value listed for it in     #
+#                manifest.json (the type's max for unsigned, min for   #
+#                signed, NaN for float).  duplicate is a u1 flag, 1    #
+#                for a duplicate copy and 0 for the first, whether     #
+#                piers.db holds Y/N or 1/0.  Repetitive text (status)  #
+#                is dictionary encoded: the column holds codes and     #
+#                manifest.json holds the strings.  Message text is     #
+#                UTF-8 bytes in <column>.data.npy with start offsets   #
+#                in <column>.offsets.npy and a boolean                 #
+#                <column>.valid.npy that is False for NULL, as in      #
+#                Arrow, so NULL and '' stay distinct.                  #
+#                                                                      #
+#                --npz also bundles every file into one deflate        #
+#                compressed .npz for copying off the node.  np.load()  #
+#                reads it directly but cannot memory map it, so keep   #
+#                the .npy directory for analysis.                      #
+########################################################################
+
+import argparse
+import array
+import channel
+import json
+import os
+import sqlite3
+import struct
+import sys
+import time
+import zipfile
+from pathlib import Path
+
+#bytes reserved for every .npy header (magic, version, length and the padded dict)
+npy_header_size = 128
+#typecode, numpy descr and null value of every plain column type
+column_types = {'u1': ('B', '|u1', 255),
+                'u2': ('H', '<u2', 65535),
+                'u4': ('I', '<u4', 4294967295),
+                'i1': ('b', '|i1', -128),
+                'i2': ('h', '<i2', -32768),
+                'i4': ('i', '<i4', -2147483648),
+                'i8': ('q', '<i8', -9223372036854775808),
+                'f4': ('f', '<f4', float('nan')),
+                'b1': ('B', '|b1', None)}
+
+#function: .npy format 1.0 header for a one dimensional array
+def npy_header(descr, count):
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, count)
+    header = header.ljust(npy_header_size - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+#class: one .npy file written in chunks, the header is filled in on close
+class NpyWriter:
+    def __init__(self, path, kind):
+        self.path = path
+        self.typecode, self.descr, self.null = column_types[kind]
+        self.count = 0
+        self.file = open(path, 'wb')
+        self.file.write(npy_header(self.descr, 0))
+
+    #function: append values (no NULLs), returns nothing
+    def extend(self, values):
+        values = array.array(self.typecode, values)
+        if values.itemsize != int(self.descr[2:]):
+            raise ValueError('platform has no ' + self.descr + ' array type')
+        if sys.byteorder == 'big' and values.itemsize > 1:
+            values.byteswap()
+        values.tofile(self.file)
+        self.count += len(values)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(npy_header(self.descr, self.count))
+        self.file.close()
+
+#class: a column of one exported dataset
+class ColumnWriter:
+    def __init__(self, directory, dataset, name, kind):
+        self.name = name
+        self.kind = kind
+        base = directory / (dataset + '.' + name)
+        self.files = []
+        if kind == 'utf8':
+            self.offsets = NpyWriter(str(base) + '.offsets.npy', 'i8')
+            self.data = NpyWriter(str(base) + '.data.npy', 'u1')
+            self.valid = NpyWriter(str(base) + '.valid.npy', 'b1')
+            self.offsets.extend([0])
+            self.position = 0
+            self.files = [self.offsets.path, self.data.path, self.valid.path]
+        elif kind.startswith('dict:'):
+            self.codes = NpyWriter(str(base) + '.npy', kind[5:])
+            self.dictionary = {}
+            self.files = [self.codes.path]
+        else:
+            self.values = NpyWriter(str(base) + '.npy', kind)
+            self.files = [self.values.path]
+
+    #function: append one chunk of column values, None is NULL
+    def extend(self, values):
+        if self.kind == 'utf8':
+            chunk = bytearray()
+            offsets = []
+            for value in values:
+                if value != None:
+                    chunk += str(value).encode('UTF-8')
+                offsets.append(self.position + len(chunk))
+            self.position += len(chunk)
+            self.data.extend(chunk)
+            self.offsets.extend(offsets)
+            self.valid.extend([value != None for value in values])
+        elif self.kind.startswith('dict:'):
+            dictionary = self.dictionary
+            null = self.codes.null
+            codes = []
+            for value in values:
+                if value == None:
+                    codes.append(null)
+                    continue
+                code = dictionary.get(value)
+                if code == None:
+                    code = dictionary[value] = len(dictionary)
+                    if code >= null:
+                        raise ValueError('too many distinct values for ' + self.name)
+                codes.append(code)
+            self.codes.extend(codes)
+        else:
+            null = self.values.null
+            self.values.extend([null if value == None else value for value in values])
+
+    def close(self):
+        for writer in ('offsets', 'data', 'valid', 'codes', 'values'):
+            if hasattr(self, writer):
+                getattr(self, writer).close()
+
+    #function: manifest entry describing the column files
+    def describe(self):
+        if self.kind == 'utf8':
+            return {'encoding': 'utf8', 'offsets': Path(self.offsets.path).name,
+                    'data': Path(self.data.path).name, 'valid': Path(self.valid.path).name}
+        if self.kind.startswith('dict:'):
+            return {'encoding': 'dictionary', 'file': Path(self.codes.path).name,
+                    'dtype': self.codes.descr, 'null': self.codes.null,
+                    'dictionary': [value for value, _ in
+                                   sorted(self.dictionary.items(), key=lambda item: item[1])]}
+        null = self.values.null
+        return {'encoding': 'plain', 'file': Path(self.values.path).name,
+                'dtype': self.values.descr, 'null': None if null != null else null}
+
+#function: True if the database has a table
+def has_table(db, table):
+    return db.execute("SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name=?",
+                      (table,)).fetchone() != None
+
+#function: column names of a table
+def table_columns(db, table):
+    return [row[1] for row in db.execute('PRAGMA table_info(' + table + ')')]
+
+#duplicate flag as 1/0, lostik.py stores Y/N
+duplicate_flag = "CASE WHEN duplicate IN ('Y', 1) THEN 1 WHEN duplicate IN ('N', 0) THEN 0 END"
+
+#function: datasets to export, each (name, [(column, kind, sql expression)], from clause)
+def datasets(db):
+    selected = []
+    if has_table(db, 'messages'):
+        #a master database from sql_merge_db.py
+        selected.append(('messages', [
+            ('message_id', 'u4', 'message_id'),
+            ('location_id', 'u1', 'location_id'),
+            ('sequence', 'u4', 'sequence'),
+            ('payload_bytes', 'u1', 'LENGTH(payload_hex) / 2'),
+            ('time_queued', 'i8', 'time_queued'),
+            ('time_sent', 'i8', 'time_sent'),
+            ('time_acked', 'i8', 'time_acked'),
+            ('tx_count', 'u1', 'tx_count'),
+            ('message', 'utf8', 'message')],
+            'messages ORDER BY message_id'))
+        selected.append(('links', [
+            ('message_id', 'u4', 'receptions.message_id'),
+            ('origin', 'u1', 'messages.location_id'),
+            ('station', 'u1', 'receptions.station_id'),
+            ('time_received', 'i8', 'receptions.time_received'),
+            ('delay_ms', 'i8', 'receptions.time_received - messages.time_queued'),
+            ('rssi', 'i2', 'CAST(receptions.rssi AS INTEGER)'),
+            ('snr', 'i1', 'CAST(receptions.snr AS INTEGER)'),
+            ('copies', 'u2', 'MIN(receptions.copies, 65534)')],
+            'receptions JOIN messages USING (message_id) ORDER BY receptions.station_id, '
+            'receptions.message_id'))
+    else:
+        #a piers.db no writer has opened since acks were added lacks these columns
+        sms_columns = table_columns(db, 'sms')
+        sequence = 'sequence' if 'sequence' in sms_columns else 'NULL'
+        time_acked = 'time_acked' if 'time_acked' in sms_columns else 'NULL'
+        selected.append(('sms', [
+            ('rowid', 'u4', 'sms.rowid'),
+            ('location_id', 'u1', 'location_id'),
+            ('sequence', 'u4', sequence),
+            ('payload_bytes', 'u1', 'LENGTH(payload_hex) / 2'),
+            ('time_queued', 'i8', 'time_queued'),
+            ('time_on_air', 'i8', 'time_on_air'),
+            ('time_sent', 'i8', 'time_sent'),
+            ('time_acked', 'i8', time_acked),
+            ('tx_count', 'u1', 'tx_count'),
+            ('time_received', 'i8', 'time_received'),
+            ('rssi', 'i2', 'CAST(rssi AS INTEGER)'),
+            ('snr', 'i1', 'CAST(snr AS INTEGER)'),
+            ('duplicate', 'u1', duplicate_flag),
+            ('message', 'utf8', 'message')],
+            'sms ORDER BY sms.rowid'))
+        selected.append(('links', [
+            ('origin', 'u1', 'location_id'),
+            ('time_received', 'i8', 'time_received'),
+            ('rssi', 'i2', 'CAST(rssi AS INTEGER)'),
+            ('snr', 'i1', 'CAST(snr AS INTEGER)'),
+            ('duplicate', 'u1', duplicate_flag)],
+            'sms WHERE time_received IS NOT NULL ORDER BY sms.rowid'))
+    if has_table(db, 'status'):
+        selected.append(('status', [
+            ('participant_id', 'u4', 'participant_id'),
+            ('location_id', 'u1', 'location_id'),
+            ('status', 'dict:u1', 'status'),
+            ('time_logged', 'i8', 'time_logged'),
+            ('time_received', 'i8', 'time_received')],
+            'status ORDER BY time_logged'))
+    if has_table(db, 'locations'):
+        selected.append(('locations', [
+            ('location_id', 'u1', 'location_id'),
+            ('location_name', 'utf8', 'location_name')],
+            'locations ORDER BY location_id'))
+    return selected
+
+#function: stream one dataset into its column files, returns (row count, manifest entry)
+def export_dataset(db, directory, name, columns, from_clause, chunk, sf):
+    writers = [ColumnWriter(directory, name, column, kind) for column, kind, _ in columns]
+    airtime = None
+    if 'payload_bytes' in [column for column, _, _ in columns]:
+        #time on air per packet for airtime analysis, computed once per payload length
+        airtime = ColumnWriter(directory, name, 'airtime_ms', 'f4')
+        airtime_index = [column for column, _, _ in columns].index('payload_bytes')
+        airtime_cache = {}
+    cursor = db.execute('SELECT ' + ', '.join(expression for _, _, expression in columns) +
+                        ' FROM ' + from_clause)
+    count = 0
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk)
+            if not rows:
+                break
+            count += len(rows)
+            values = list(zip(*rows))
+            for writer, column_values in zip(writers, values):
+                writer.extend(column_values)
+            if airtime:
+                times = []
+                for length in values[airtime_index]:
+                    if length not in airtime_cache:
+                        airtime_cache[length] = (None if length == None else
+                                                 channel.airtime(length, sf=sf))
+                    times.append(airtime_cache[length])
+                airtime.extend(times)
+    finally:
+        cursor.close()
+        for writer in writers + ([airtime] if airtime else []):
+            writer.close()
+    if airtime:
+        writers.append(airtime)
+    entry = {'rows': count,
+             'columns': {writer.name: writer.describe() for writer in writers}}
+    files = [file for writer in writers for file in writer.files]
+    return count, entry, files
+
+#function: load an exported dataset as NumPy arrays, memory mapped (needs numpy)
+def load(directory, dataset, decode=True):
+    import numpy
+    directory = Path(directory)
+    with open(directory / 'manifest.json') as file:
+        manifest = json.load(file)
+    arrays = {}
+    for name, column in manifest['datasets'][dataset]['columns'].items():
+        if column['encoding'] == 'utf8':
+            offsets = numpy.load(directory / column['offsets'], mmap_mode='r')
+            data = numpy.load(directory / column['data'], mmap_mode='r')
+            valid = numpy.load(directory / column['valid'], mmap_mode='r')
+            if decode:
+                raw = data.tobytes()
+                arrays[name] = numpy.array([raw[start:end].decode('UTF-8') if ok else None
+                                            for start, end, ok
+                                            in zip(offsets[:-1], offsets[1:], valid)], dtype=object)
+            else:
+                arrays[name] = (offsets, data, valid)
+        elif column['encoding'] == 'dictionary':
+            codes = numpy.load(directory / column['file'], mmap_mode='r')
+            if decode:
+                lookup = numpy.array(column['dictionary'] +
+                                     [None] * (column['null'] + 1 - len(column['dictionary'])),
+                                     dtype=object)
+                arrays[name] = lookup[codes]
+            else:
+                arrays[name] = codes
+        else:
+            arrays[name] = numpy.load(directory / column['file'], mmap_mode='r')
+    return arrays
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PiERS Module - Columnar Export',
+                                     epilog='Created by K7CTC. This module streams sms traffic, '
+                                            'link quality and participant status into one .npy '
+                                            'file per column for analysis in NumPy or pandas.')
+    parser.add_argument('--db', default='piers.db',
+                        help='database to export, piers.db or a sql_merge_db.py master '
+                             '(default: piers.db)')
+    parser.add_argument('-o', '--output', default='export',
+                        help='directory for the .npy files and manifest.json (default: export)')
+    parser.add_argument('--npz', action='store_true',
+                        help='also bundle everything into a compressed <output>.npz')
+    parser.add_argument('--chunk', type=int, default=65536,
+                        help='rows read per chunk, bounds memory use (default: 65536)')
+    parser.add_argument('--sf', type=int, choices=range(7, 13), default=12,
+                        help='spreading factor for the airtime_ms column (default: 12)')
+    args = parser.parse_args()
+
+    if Path(args.db).is_file() == False:
+        print('ERROR: File not found - ' + args.db)
+        sys.exit(1)
+
+    start_time = time.perf_counter()
+    directory = Path(args.output)
+    directory.mkdir(parents=True, exist_ok=True)
+    #read only, the export never holds a write lock on a live piers.db
+    db = sqlite3.connect('file:' + Path(args.db).resolve().as_posix() + '?mode=ro', uri=True)
+    manifest = {'source': str(Path(args.db).resolve()),
+                'time_exported': int(round(time.time()*1000)),
+                'sf': args.sf,
+                'datasets': {}}
+    files = []
+    for name, columns, from_clause in datasets(db):
+        dataset_start = time.perf_counter()
+        count, entry, dataset_files = export_dataset(db, directory, name, columns, from_clause,
+                                                     args.chunk, args.sf)
+        manifest['datasets'][name] = entry
+        files += dataset_files
+        print(f'{name}: {count} rows, {len(entry["columns"])} columns '
+              f'({time.perf_counter() - dataset_start:.2f} s)')
+    db.close()
+    with open(directory / 'manifest.json', 'w') as file:
+        json.dump(manifest, file, indent=1)
+    files.append(str(directory / 'manifest.json'))
+
+    size = sum(os.path.getsize(file) for file in files)
+    print(f'{len(files)} files, {size / 1048576:.1f} MiB in {directory}')
+    if args.npz:
+        bundle = str(directory) + '.npz'
+        with zipfile.ZipFile(bundle, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as npz:
+            for file in files:
+                npz.write(file, Path(file).name)
+        print(f'{bundle}: {os.path.getsize(bundle) / 1048576:.1f} MiB')
+    print(f'Exported in {time.perf_counter() - start_time:.2f} s')
+    sys.exit(0)
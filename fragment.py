@@ -0,0 +1,189 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Fragmentation                                #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module moves payloads larger than one LoStik    #
+#                 frame (roster corrections, status dumps) over the    #
+#                 air.  Payloads queued in the payloads table are      #
+#                 split into numbered fragments, receivers reassemble  #
+#                 them in a bounded buffer and request only the        #
+#                 fragments they are missing.                          #
+#                                                                      #
+########################################################################
+
+import packet
+
+#largest data portion of one fragment (RN2903 frames are 255 bytes max)
+fragment_size = 200
+#largest payload accepted for transmission or reassembly
+max_fragments = 64
+#reassembly buffer limits
+max_buffers = 8
+max_buffer_bytes = 32768
+#drop a partial payload after this long without completing (milliseconds)
+reassembly_timeout = 600000
+#wait this long after the last fragment before asking for missing ones
+nack_delay = 30000
+#stop asking after this many nacks for one payload
+nack_limit = 4
+#most indexes listed in one nack
+nack_max_indexes = 40
+
+#function: length of a full fragment frame, the longest frame a node builds
+def max_frame_length():
+    return len(packet.encode_fragment(99, 10**6, max_fragments - 1, max_fragments,
+                                      bytes(fragment_size)))
+
+#function: split payload bytes into fragment data chunks
+def split(data):
+    return [data[i:i + fragment_size] for i in range(0, len(data), fragment_size)] or [b'']
+
+#function: insert a payload into the payloads table for transmission
+def queue_payload(db, my_location_id, data, time_queued):
+    if len(split(data)) > max_fragments:
+        return None
+    c = db.cursor()
+    c.execute('SELECT IFNULL(MAX(payload_id), 0) + 1 FROM payloads WHERE location_id=?',
+              (my_location_id,))
+    payload_id = c.fetchone()[0]
+    c.execute('''
+        INSERT INTO payloads (
+            location_id,
+            payload_id,
+            payload,
+            time_queued)
+        VALUES (?, ?, ?, ?);''',
+        (my_location_id, payload_id, data, time_queued))
+    db.commit()
+    c.close()
+    return payload_id
+
+#class: hands out fragments of queued payloads plus requested repairs
+#write (optional) takes (sql, parameters) and applies the update elsewhere, e.g. a db_worker
+class FragmentSender:
+    def __init__(self, db, my_location_id, write=None):
+        self.db = db
+        self.my_location_id = my_location_id
+        self.write = write
+        self.current = None
+        self.repairs = {}
+        #payloads finish in payload_id order, never pick one at or below the last finished
+        self.last_finished = 0
+
+    #function: queue fragments a receiver reported missing
+    def nack_received(self, payload_id, missing):
+        c = self.db.cursor()
+        c.execute('SELECT payload FROM payloads WHERE location_id=? AND payload_id=?',
+                  (self.my_location_id, payload_id))
+        query_result = c.fetchone()
+        c.close()
+        if query_result == None:
+            return
+        chunks = split(query_result[0])
+        wanted = self.repairs.setdefault(payload_id, set())
+        for index in missing:
+            if 0 <= index < len(chunks):
+                wanted.add(index)
+
+    #function: return the next fragment packet to transmit, or None
+    def next_fragment(self, now):
+        #repairs first, they complete payloads someone is already holding
+        for payload_id in sorted(self.repairs):
+            wanted = self.repairs[payload_id]
+            if not wanted:
+                del self.repairs[payload_id]
+                continue
+            c = self.db.cursor()
+            c.execute('SELECT payload FROM payloads WHERE location_id=? AND payload_id=?',
+                      (self.my_location_id, payload_id))
+            chunks = split(c.fetchone()[0])
+            c.close()
+            index = min(wanted)
+            wanted.discard(index)
+            return packet.encode_fragment(self.my_location_id, payload_id, index,
+                                          len(chunks), chunks[index])
+        if self.current == None:
+            c = self.db.cursor()
+            c.execute('''
+                SELECT payload_id, payload
+                FROM payloads
+                WHERE location_id=? AND time_received IS NULL AND time_sent IS NULL AND payload_id>?
+                ORDER BY payload_id
+                LIMIT 1;''',
+                (self.my_location_id, self.last_finished))
+            query_result = c.fetchone()
+            c.close()
+            if query_result == None:
+                return None
+            self.current = [query_result[0], split(query_result[1]), 0]
+        payload_id, chunks, index = self.current
+        fragment = packet.encode_fragment(self.my_location_id, payload_id, index,
+                                          len(chunks), chunks[index])
+        self.current[2] += 1
+        if self.current[2] == len(chunks):
+            update = ('UPDATE payloads SET time_sent=? WHERE location_id=? AND payload_id=?',
+                      (now, self.my_location_id, payload_id))
+            if self.write:
+                self.write(*update)
+            else:
+                self.db.execute(*update)
+                self.db.commit()
+            self.last_finished = payload_id
+            self.current = None
+        return fragment
+
+#class: bounded reassembly buffer for payloads heard from other locations
+class Reassembler:
+    def __init__(self):
+        self.buffers = {}
+        self.buffer_bytes = 0
+
+    #function: store a fragment, returns the complete payload bytes once whole
+    def add(self, origin, payload_id, index, total, data, now):
+        if total > max_fragments or len(data) > fragment_size:
+            return None
+        key = (origin, payload_id)
+        buffer = self.buffers.get(key)
+        if buffer == None:
+            buffer = {'total': total, 'fragments': {}, 'first_seen': now,
+                      'last_seen': now, 'nacks': 0}
+            self.buffers[key] = buffer
+        if buffer['total'] != total or index in buffer['fragments']:
+            return None
+        buffer['fragments'][index] = data
+        buffer['last_seen'] = now
+        self.buffer_bytes += len(data)
+        if len(buffer['fragments']) == total:
+            self._drop(key)
+            return b''.join(buffer['fragments'][i] for i in range(total))
+        self._evict(key)
+        return None
+
+    def _drop(self, key):
+        buffer = self.buffers.pop(key)
+        self.buffer_bytes -= sum(len(data) for data in buffer['fragments'].values())
+
+    #function: evict least recently updated buffers until within limits
+    def _evict(self, keep):
+        while len(self.buffers) > max_buffers or self.buffer_bytes > max_buffer_bytes:
+            candidates = [key for key in self.buffers if key != keep]
+            if not candidates:
+                break
+            self._drop(min(candidates, key=lambda key: self.buffers[key]['last_seen']))
+
+    #function: expire stale buffers and return (origin, payload_id, missing) nacks due now
+    def due_nacks(self, now):
+        nacks = []
+        for key in list(self.buffers):
+            buffer = self.buffers[key]
+            if now - buffer['first_seen'] >= reassembly_timeout:
+                self._drop(key)
+                continue
+            if now - buffer['last_seen'] < nack_delay or buffer['nacks'] >= nack_limit:
+                continue
+            missing = [i for i in range(buffer['total']) if i not in buffer['fragments']]
+            buffer['nacks'] += 1
+            buffer['last_seen'] = now
+            nacks.append((key[0], key[1], missing[:nack_max_indexes]))
+        return nacks
@@ -15,13 +15,23 @@
 import logging
 import subprocess
 import argparse
+import arq
+import channel
+import compress
 import datetime
+import db_worker
+import duty_cycle
+import fragment
+import metrics
 import os
+import packet
 import serial
 import serial.tools.list_ports
 import sqlite3
 import sys
+import threading
 import time
+import timesync
 import atexit
 from pathlib import Path
 
@@ -52,6 +62,71 @@ parser.add_argument('--wdt',
                     help='LoStik watchdog timer time-out in seconds. '
                     '(range: 0 to 60, default: 5)',
                     default='5')
+parser.add_argument('--baud',
+                    choices=['auto', '57600', '115200', '230400', '460800'],
+                    help='LoStik serial baud rate, set via the RN2903 auto-baud sequence. auto '
+                    'uses the highest rate that verifies, any failure falls back to 57600. '
+                    '(default: auto)',
+                    default='auto')
+parser.add_argument('--compress',
+                    action='store_true',
+                    help='Transmit packets compressed against piers.dict when smaller. '
+                    'Every node must hold the same piers.dict.')
+parser.add_argument('--access',
+                    choices=channel.modes,
+                    help='Channel access mode: aloha (transmit immediately), lbt (listen before '
+                    'talk with random backoff) or tdma (one slot per location id). (default: lbt)',
+                    default='lbt')
+parser.add_argument('--slots',
+                    type=int,
+                    choices=range(1, 100),
+                    metavar='{1..99}',
+                    help='Number of TDMA slots, must match on every node and cover every '
+                    'location id. (default: highest location id in the locations table)',
+                    default=None)
+parser.add_argument('--slot-ms',
+                    type=int,
+                    help='TDMA slot length in milliseconds. (default: 10000, fits a full '
+                    'fragment frame at SF12)',
+                    default=10000)
+parser.add_argument('--guard-ms',
+                    type=int,
+                    help='TDMA guard interval at each end of a slot in milliseconds, the upper '
+                    'bound once time sync beacons shrink it. (default: 500)',
+                    default=500)
+parser.add_argument('--time-master',
+                    action='store_true',
+                    help='This node keeps the network clock (stratum 0) and beacons it. Use on '
+                    'the one node with a trusted clock (DS3231 RTC set via NTP).')
+parser.add_argument('--beacon',
+                    type=int,
+                    help='Time sync beacon interval in seconds. (default: 300)',
+                    default=300)
+parser.add_argument('--duty-cycle',
+                    type=int,
+                    nargs=2,
+                    metavar=('CYCLE', 'AWAKE'),
+                    help='Low power mode for battery stations: every CYCLE seconds of network '
+                    'time listen and transmit for AWAKE seconds, then put the LoStik to sleep. '
+                    'Every node in the event must use the same values and AWAKE must fit a full '
+                    'frame plus its ack (about 9 s at SF12). (e.g. 60 15, see power_budget.py)',
+                    default=None)
+parser.add_argument('--db-queue',
+                    type=int,
+                    help='Database writes that may wait for the database worker before the '
+                    'radio has to wait too. (default: 256)',
+                    default=256)
+parser.add_argument('--commit-ms',
+                    type=int,
+                    help='Group commit window in milliseconds: received packets and tx updates '
+                    'are committed together at most this long after the first of them reaches '
+                    'the database worker (the data at risk on power loss). 0 commits each one '
+                    'on its own. (default: 500)',
+                    default=500)
+parser.add_argument('--commit-batch',
+                    type=int,
+                    help='Most writes per group commit. (default: 64)',
+                    default=64)
 args = parser.parse_args()
 
 #convert wdt from seconds to milliseconds before proceeding
@@ -61,6 +136,20 @@ args.wdt = args.wdt * 1000
 version = 'v0.2'
 lostik = None
 lostik_port = None
+lostik_firmware = 'RN2903 1.0.5 Nov 06 2018 10:45:27'
+my_location_id = None
+db = None
+writer = None
+tx_time_on_air = None
+rx_time_local = None
+#rowid: (tx_count, time_sent) of transmissions the database worker has not committed yet
+#(written by the radio thread and the worker, always under tx_inflight_lock)
+tx_inflight = {}
+tx_inflight_lock = threading.Lock()
+#low power wake schedule, None unless --duty-cycle
+schedule = None
+#serial and USB latency allowed on the radio_err that ends an idle sense window (milliseconds)
+sense_slack_ms = 100
 
 logging.info('-------------------------------------------------------------------------------')
 logging.info('lostik.py %s started', version)
@@ -105,6 +194,26 @@ if Path('piers.db').is_file() == False:
     logging.error('File not found - piers.db')
     sys.exit(1)
 
+#verify existence of PiERS configuration before proceeding
+if Path('piers.conf').is_file() == False:
+    print('ERROR: File not found - piers.conf')
+    logging.error('File not found - piers.conf')
+    sys.exit(1)
+
+#attempt to read and validate the location id integer from piers.conf
+try:
+    file = open('piers.conf')
+    my_location_id = int(file.readline())
+    file.close()
+except:
+    print('ERROR: Failed to read location id from piers.conf!')
+    logging.error('Failed to read location id from piers.conf!')
+    sys.exit(1)
+if my_location_id < 1 or my_location_id > 99:
+    print('ERROR: Location identifier out of range!')
+    logging.error('Location identifier out of range!')
+    sys.exit(1)
+
 ########################################################################
 # LoStik Notes:  The Ronoth LoStik USB to serial device has a VID:PID  #
 #                equal to 1A86:7523.  Using pySerial we are able to    #
@@ -117,6 +226,15 @@ if Path('piers.db').is_file() == False:
 #                out.                                                  #
 ########################################################################
 
+#load the shared compression dictionary (always used to decode, only used to encode with --compress)
+dictionary = compress.load()
+if dictionary:
+    logging.info('Compression dictionary version %s loaded', dictionary[0])
+elif args.compress:
+    print('ERROR: File not found - piers.dict')
+    logging.error('File not found - piers.dict')
+    sys.exit(1)
+
 #attempt LoStik detection and port assignment
 lostik_port = None
 ports = serial.tools.list_ports.grep('1A86:7523')
@@ -145,14 +263,84 @@ else:
     
 #check LoStik firmware version
 lostik.write(b'sys get ver\r\n')
-if lostik.readline().decode('ASCII').rstrip() != 'RN2903 1.0.5 Nov 06 2018 10:45:27':
+if lostik.readline().decode('ASCII', 'replace').rstrip() != lostik_firmware:
     print('ERROR: LoStik failed to return expected firmware version!')
     logging.error('LoStik failed to return expected firmware version!')
     sys.exit(1)
 
+########################################################################
+# Baud Notes:  Every command and every payload (hex doubles it, a full #
+#              frame is 510 characters) crosses the 57600 baud UART,   #
+#              about 90 ms for a full radio tx command.  The RN2903    #
+#              detects a new rate from a break condition followed by   #
+#              0x55 sent at that rate.  Each candidate rate, highest   #
+#              first, must answer sys get ver correctly until a full   #
+#              frame's radio tx command worth of bytes has crossed     #
+#              each way.  Otherwise the radio is brought back to 57600 #
+#              the same way.  A power cycle also restores 57600.  A    #
+#              received frame garbled later is dropped, not fatal.     #
+########################################################################
+
+#bytes that must cross intact each way to accept a baud rate, one full frame's radio tx command
+baud_check_bytes = len('radio tx \r\n') + 2 * packet.max_length
+#rates tried by --baud auto, highest first
+baud_rates = [460800, 230400, 115200]
+
+#function: median sys get ver round trip in milliseconds at the current rate
+def lostik_round_trip(samples=5):
+    round_trips = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        lostik.write(b'sys get ver\r\n')
+        lostik.readline()
+        round_trips.append((time.perf_counter() - start) * 1000)
+    return sorted(round_trips)[len(round_trips) // 2]
+
+#function: switch the LoStik UART to baud via auto-baud, returns True if it verified
+def lostik_set_baud(baud):
+    lostik.send_break(duration=0.05)
+    lostik.baudrate = baud
+    lostik.write(b'\x55')
+    lostik.flush()
+    time.sleep(0.05)
+    #terminate whatever the radio made of the sync byte and discard its reply
+    lostik.write(b'\r\n')
+    lostik.readline()
+    lostik.reset_input_buffer()
+    sent = 0
+    received = 0
+    while sent < baud_check_bytes or received < baud_check_bytes:
+        sent += lostik.write(b'sys get ver\r\n')
+        reply = lostik.readline()
+        received += len(reply)
+        if reply.decode('ASCII', 'replace').rstrip() != lostik_firmware:
+            return False
+    return True
+
+#attempt to raise the baud rate, falling back to 57600
+serial_round_trip = {57600: lostik_round_trip()}
+if args.baud == 'auto':
+    candidates = baud_rates
+else:
+    candidates = [int(args.baud)] if args.baud != '57600' else []
+for baud in candidates:
+    if lostik_set_baud(baud):
+        serial_round_trip[baud] = lostik_round_trip()
+        logging.info('LoStik baud rate set to %s (sys get ver round trip %.1f ms, %.1f ms at 57600)',
+                     baud, serial_round_trip[baud], serial_round_trip[57600])
+        break
+    logging.warning('LoStik failed to verify at %s baud', baud)
+    if not lostik_set_baud(57600):
+        print('ERROR: LoStik did not return to 57600 baud! Power cycle the LoStik.')
+        logging.error('LoStik did not return to 57600 baud!')
+        sys.exit(1)
+else:
+    logging.info('LoStik baud rate 57600 (sys get ver round trip %.1f ms)',
+                 serial_round_trip[57600])
+
 #attempt to pause mac (LoRaWAN) as required to issue commands directly to the radio
 lostik.write(b'mac pause\r\n')
-if lostik.readline().decode('ASCII').rstrip() != '4294967245':
+if lostik.readline().decode('ASCII', 'replace').rstrip() != '4294967245':
     print('ERROR: Unable to pause LoRaWAN!')
     logging.error('Unable to pause LoRaWAN!')
     sys.exit(1)
@@ -162,26 +350,26 @@ def lostik_led_control(led, state): #values are rx/tx and on/off
     if led == 'rx':
         if state == 'off':
             lostik.write(b'sys set pindig GPIO10 0\r\n') #GPIO10 = blue rx led
-            if lostik.readline().decode('ASCII').rstrip() == 'ok':
+            if lostik.readline().decode('ASCII', 'replace').rstrip() == 'ok':
                 return True
             else:
                 return False
         elif state == 'on':
             lostik.write(b'sys set pindig GPIO10 1\r\n') #GPIO10 = blue rx led
-            if lostik.readline().decode('ASCII').rstrip() == 'ok':
+            if lostik.readline().decode('ASCII', 'replace').rstrip() == 'ok':
                 return True
             else:
                 return False
     elif led == 'tx':
         if state == 'off':
             lostik.write(b'sys set pindig GPIO11 0\r\n') #GPIO11 = red tx led
-            if lostik.readline().decode('ASCII').rstrip() == 'ok':
+            if lostik.readline().decode('ASCII', 'replace').rstrip() == 'ok':
                 return True
             else:
                 return False
         elif state == 'on':
             lostik.write(b'sys set pindig GPIO11 1\r\n') #GPIO11 = red tx led
-            if lostik.readline().decode('ASCII').rstrip() == 'ok':
+            if lostik.readline().decode('ASCII', 'replace').rstrip() == 'ok':
                 return True
             else:
                 return False
@@ -196,43 +384,43 @@ lostik_led_control('tx', 'on')
 #write "network" settings to LoStik
 #set frequency
 lostik.write(b''.join([b'radio set freq ', set_freq, b'\r\n']))
-if lostik.readline().decode('ASCII').rstrip() != 'ok':
+if lostik.readline().decode('ASCII', 'replace').rstrip() != 'ok':
     print('ERROR: Failed to set LoStik frequency to ' + set_freq.decode('UTF-8') + '!')
     logging.error('Failed to set LoStik frequency to ' + set_freq.decode('UTF-8') + '!')
     sys.exit(1)
 #set mode
 lostik.write(b''.join([b'radio set mod ', set_mod, b'\r\n']))
-if lostik.readline().decode('ASCII').rstrip() != 'ok':
+if lostik.readline().decode('ASCII', 'replace').rstrip() != 'ok':
     print('ERROR: Failed to set LoStik modulation mode to LoRa!')
     logging.error('Failed to set LoStik modulation mode to LoRa!')
     sys.exit(1)
 #set CRC header usage
 lostik.write(b''.join([b'radio set crc ', set_crc, b'\r\n']))
-if lostik.readline().decode('ASCII').rstrip() != 'ok':
+if lostik.readline().decode('ASCII', 'replace').rstrip() != 'ok':
     print('ERROR: Failed to enable LoStik CRC header setting!')
     logging.error('Failed to enable LoStik CRC header setting!')
     sys.exit(1)
 #set IQ inversion
 lostik.write(b''.join([b'radio set iqi ', set_iqi, b'\r\n']))
-if lostik.readline().decode('ASCII').rstrip() != 'ok':
+if lostik.readline().decode('ASCII', 'replace').rstrip() != 'ok':
     print('ERROR: Failed to disable LoStik IQ inversion setting!')
     logging.error('Failed to disable LoStik IQ inversion setting!')
     sys.exit(1)
 #set sync word
 lostik.write(b''.join([b'radio set sync ', set_sync, b'\r\n']))
-if lostik.readline().decode('ASCII').rstrip() != 'ok':
+if lostik.readline().decode('ASCII', 'replace').rstrip() != 'ok':
     print('ERROR: Failed to set LoStik sync word to ' + set_sync.decode('UTF-8') + '!')
     logging.error('Failed to set LoStik sync word to ' + set_sync.decode('UTF-8') + '!')
     sys.exit(1)
 #set spreading factor
 lostik.write(b''.join([b'radio set sf ', set_sf, b'\r\n']))
-if lostik.readline().decode('ASCII').rstrip() != 'ok':
+if lostik.readline().decode('ASCII', 'replace').rstrip() != 'ok':
     print('ERROR: Failed to set LoStik spreading factor to ' + set_sf.decode('UTF-8') + '!')
     logging.error('Failed to set LoStik spreading factor to ' + set_sf.decode('UTF-8') + '!')
     sys.exit(1)
 #set radio bandwidth
 lostik.write(b''.join([b'radio set bw ', set_bw, b'\r\n']))
-if lostik.readline().decode('ASCII').rstrip() != 'ok':
+if lostik.readline().decode('ASCII', 'replace').rstrip() != 'ok':
     print('ERROR: Failed to set LoStik radio bandwidth to ' + set_bw.decode('UTF-8') + '!')
     logging.error('Failed to set LoStik radio bandwidth to ' + set_bw.decode('UTF-8') + '!')
     sys.exit(1)
@@ -240,19 +428,19 @@ if lostik.readline().decode('ASCII').rstrip() != 'ok':
 #write "node" settings to LoStik
 #set power
 lostik.write(b''.join([b'radio set pwr ', set_pwr, b'\r\n']))
-if lostik.readline().decode('ASCII').rstrip() != 'ok':
+if lostik.readline().decode('ASCII', 'replace').rstrip() != 'ok':
     print('ERROR: Failed to set LoStik transmit power to ' + set_pwr.decode('UTF-8') + '!')
     logging.error('Failed to set LoStik transmit power to ' + set_pwr.decode('UTF-8') + '!')
     sys.exit(1)
 #set coding rate
 lostik.write(b''.join([b'radio set cr ', set_cr, b'\r\n']))
-if lostik.readline().decode('ASCII').rstrip() != 'ok':
+if lostik.readline().decode('ASCII', 'replace').rstrip() != 'ok':
     print('ERROR: Failed to set LoStik coding rate to ' + set_cr.decode('UTF-8') + '!')
     logging.error('Failed to set LoStik coding rate to ' + set_cr.decode('UTF-8') + '!')
     sys.exit(1)
 #set watchdog timer time-out
 lostik.write(b''.join([b'radio set wdt ', set_wdt, b'\r\n']))
-if lostik.readline().decode('ASCII').rstrip() != 'ok':
+if lostik.readline().decode('ASCII', 'replace').rstrip() != 'ok':
     print('ERROR: Failed to set LoStik watchdog timer time-out to ' + set_wdt.decode('UTF-8') + '!')
     logging.error('Failed to set LoStik watchdog timer time-out to ' + set_wdt.decode('UTF-8') + '!')
     sys.exit(1)
@@ -268,7 +456,7 @@ def lostik_rx_control(state): #state values are 'on' or 'off'
     if state == 'on':
         #place LoStik in continuous receive mode
         lostik.write(b'radio rx 0\r\n')
-        if lostik.readline().decode('ASCII').rstrip() == 'ok':
+        if lostik.readline().decode('ASCII', 'replace').rstrip() == 'ok':
             if lostik_led_control('rx', 'on'):
                 return True
             else:
@@ -278,7 +466,7 @@ def lostik_rx_control(state): #state values are 'on' or 'off'
     elif state == 'off':
         #halt LoStik continuous receive mode
         lostik.write(b'radio rxstop\r\n')
-        if lostik.readline().decode('ASCII').rstrip() == 'ok':
+        if lostik.readline().decode('ASCII', 'replace').rstrip() == 'ok':
             if lostik_led_control('rx', 'off'):
                 return True
             else:
@@ -289,22 +477,29 @@ def lostik_rx_control(state): #state values are 'on' or 'off'
 #function: obtain rssi of last received packet
 def lostik_get_rssi():
     lostik.write(b'radio get rssi\r\n')
-    rssi = lostik.readline().decode('ASCII').rstrip()
+    rssi = lostik.readline().decode('ASCII', 'replace').rstrip()
     return rssi
 
 #function: obtain snr of last received packet
 def lostik_get_snr():
     lostik.write(b'radio get snr\r\n')
-    snr = lostik.readline().decode('ASCII').rstrip()
+    snr = lostik.readline().decode('ASCII', 'replace').rstrip()
     return snr
 
 #function: tx cycle, accepts hex payload, attempts to transmit and returns boolean
-def lostik_tx_cycle(payload_hex):
+#compose (optional) builds the payload bytes at the last moment, used for timestamped beacons
+def lostik_tx_cycle(payload_hex, compose=None):
+    global tx_time_on_air
+    cycle_start = time.perf_counter()
     if lostik_rx_control('off'):
-        tx_command_elements = 'radio tx' + payload_hex + '\r\n'
+        if compose:
+            payload_hex = compose().hex()
+        tx_command_elements = 'radio tx ' + payload_hex + '\r\n'
         tx_command = tx_command_elements.encode('ASCII')
         lostik.write(tx_command)
-        if lostik.readline().decode('ASCII').rstrip() == 'ok':
+        if lostik.readline().decode('ASCII', 'replace').rstrip() == 'ok':
+            tx_time_on_air = time_sync.now()
+            tx_started = time.perf_counter()
             lostik_led_control('tx', 'on')
         else:
             print('ERROR: Transmit failure!')
@@ -312,10 +507,14 @@ def lostik_tx_cycle(payload_hex):
             sys.exit(1)
         response = ''
         while response == '':
-            response = lostik.readline().decode('ASCII').rstrip()
+            response = lostik.readline().decode('ASCII', 'replace').rstrip()
         else:
             if response == 'radio_tx_ok':
+                #serial overhead of the cycle: everything but the wait for radio_tx_ok
+                tx_ended = time.perf_counter()
                 lostik_led_control('tx', 'off')
+                serial_tx_cycle.add((tx_started - cycle_start) * 1000 +
+                                    (time.perf_counter() - tx_ended) * 1000)
                 return True
             elif response == 'radio_err':
                 lostik_led_control('tx', 'off')
@@ -327,15 +526,316 @@ def lostik_tx_cycle(payload_hex):
         logging.warning('Transmit failure! Unable to halt LoStik continuous receive mode.')
         return False
 
-#function: get next tx payload from piers.db
-
-
-
-
-##### THIS IS WHERE I AM CURRENTLY WORKING #####
-
+#function: time on air in milliseconds of a length byte frame with the radio settings in use
+#(cr is the 4/cr denominator, the same number the radio set cr command carries)
+def lostik_airtime(length):
+    return channel.airtime(length, sf=int(set_sf[2:]), bw=int(set_bw) * 1000, cr=args.cr)
+
+#function: transmit packet bytes, compressed when enabled and worthwhile, once the channel allows
+#a callable payload is composed again right before transmission (see lostik_tx_cycle)
+def lostik_tx_packet(payload):
+    compose = payload if callable(payload) else None
+    if compose:
+        payload = compose()
+    elif args.compress:
+        payload = compress.wrap(dictionary, my_location_id, payload)
+    payload_airtime = lostik_airtime(len(payload))
+    while True:
+        #keep listening (and depositing what we hear) until our turn comes
+        channel_access.guard_ms = time_sync.guard_ms(timesync.local_time(), args.guard_ms)
+        wait = channel_access.wait_time(time_sync.now(), payload_airtime)
+        if wait == None:
+            logging.warning('Transmit refused! Packet does not fit a TDMA slot.')
+            return False
+        #in low power mode a packet that would not finish inside this window waits for the next
+        if schedule and awake_remaining() < wait + payload_airtime:
+            return False
+        if wait > 0:
+            lostik_rx_handle(lostik_rx_window(int(wait)))
+            continue
+        if channel_access.needs_sense():
+            busy, rx_data = lostik_sense()
+            lostik_rx_handle(rx_data)
+            if not channel_access.sensed(time_sync.now(), busy):
+                logging.warning('Transmit deferred! Channel busy.')
+                return False
+            if busy:
+                continue
+        return lostik_tx_cycle(payload.hex(), compose)
+
+#function: listen-before-talk sense (see Channel Notes in channel.py)
+#returns (busy, raw LoStik response or None), a frame the radio locked onto is kept
+def lostik_sense():
+    global rx_time_local
+    lostik.write(b''.join([b'radio rx ', bytes(str(channel.sense_symbols), 'ASCII'), b'\r\n']))
+    if lostik.readline().decode('ASCII', 'replace').rstrip() != 'ok':
+        #could not listen, so do not claim the channel is clear
+        return True, None
+    lostik_led_control('rx', 'on')
+    sense_start = time.perf_counter()
+    #a locked frame may be the longest one, started just before the window closed
+    deadline = sense_start + (channel_access.sense_ms + largest_airtime + 1000) / 1000
+    rx_data = ''
+    while rx_data == '' and time.perf_counter() < deadline:
+        rx_data = lostik.readline()
+        rx_time_local = timesync.local_time() - timesync.serial_ms(len(rx_data), lostik.baudrate)
+        rx_data = rx_data.decode('ASCII', 'replace').rstrip()
+    if rx_data == '':
+        lostik_rx_control('off')
+        return True, None
+    lostik_led_control('rx', 'off')
+    #radio_err within the window is the symbol timeout, a later one ended a frame with a bad CRC
+    sense_elapsed = (time.perf_counter() - sense_start) * 1000
+    busy = rx_data != 'radio_err' or sense_elapsed > channel_access.sense_ms + sense_slack_ms
+    return busy, rx_data
+
+#function: listen for up to window_ms, returns raw LoStik response or None
+def lostik_rx_window(window_ms):
+    global rx_time_local
+    if lostik_rx_control('on'):
+        deadline = int(round(time.time()*1000)) + window_ms
+        while int(round(time.time()*1000)) < deadline:
+            rx_data = lostik.readline()
+            #the packet ended on air while its radio_rx line was still crossing the serial link
+            rx_time_local = timesync.local_time() - timesync.serial_ms(len(rx_data), lostik.baudrate)
+            rx_data = rx_data.decode('ASCII', 'replace').rstrip()
+            if rx_data != '':
+                #the radio leaves receive mode after a packet or watchdog timeout
+                lostik_led_control('rx', 'off')
+                return rx_data
+        lostik_rx_control('off')
+        return None
+    else:
+        lostik_rx_control('off')
+        return None
+
+#function: process a raw LoStik response from a receive window
+def lostik_rx_handle(rx_data):
+    if rx_data == None or rx_data == 'radio_err':
+        return
+    #a byte corrupted on the serial link, the sender retransmits anything we fail to ack
+    if '\ufffd' in rx_data:
+        logging.warning('Discarded garbled LoStik response: ' + ascii(rx_data))
+        return
+    rx_data_array = rx_data.split()
+    if rx_data_array[0] == 'radio_rx' and len(rx_data_array) == 2:
+        channel_access.heard(time_sync.now())
+        rx_local = rx_time_local
+        query_start = time.perf_counter()
+        rssi = lostik_get_rssi()
+        snr = lostik_get_snr()
+        #serial time per received frame: the radio_rx line plus the rssi and snr queries
+        serial_rx_frame.add(timesync.serial_ms(len(rx_data) + 2, lostik.baudrate) +
+                            (time.perf_counter() - query_start) * 1000)
+        database_rx(rx_data_array[1], rssi, snr, rx_local)
+
+#function: add received packet to database, rx_local is our local clock when it arrived
+def database_rx(payload_hex, rssi, snr, rx_local):
+    time_received = time_sync.now(rx_local)
+    try:
+        rx_packet = packet.decode(bytes.fromhex(payload_hex))
+    except ValueError:
+        rx_packet = None
+    if rx_packet and rx_packet['type'] == packet.PACKET_COMPRESSED:
+        payload = compress.unwrap(dictionary, rx_packet)
+        if payload == None:
+            logging.warning('Discarded compressed packet, dictionary version ' +
+                            rx_packet['version'] + ' does not match ours')
+            return
+        payload_hex = payload.hex()
+        rx_packet = packet.decode(payload)
+    if rx_packet == None:
+        logging.warning('Discarded malformed packet: ' + payload_hex)
+        return
+    if rx_packet['location_id'] == my_location_id:
+        logging.warning('Discarded packet claiming our own location id')
+        return
+    if rx_packet['type'] == packet.PACKET_TIME:
+        #stamped for the moment the sender's radio starts to transmit, add the air time
+        delay_ms = lostik_airtime(len(payload_hex) // 2)
+        if time_sync.heard_beacon(rx_packet['location_id'], rx_packet['stratum'],
+                                  rx_packet['time_ms'], rx_local, delay_ms):
+            sync_metrics = time_sync.metrics(rx_local)
+            logging.info('Time beacon from location %s (stratum %s): offset %s ms, drift %s ppm, '
+                         'error %s ms', rx_packet['location_id'], rx_packet['stratum'],
+                         sync_metrics['offset_ms'], sync_metrics['drift_ppm'],
+                         sync_metrics['error_ms'])
+            export_metrics(force=True)
+    elif rx_packet['type'] == packet.PACKET_SMS:
+        if ack_tracker.heard(rx_packet['location_id'], rx_packet['sequence'], time_received):
+            duplicate = 'N'
+        else:
+            duplicate = 'Y'
+        writer.submit(database_insert_sms,
+                      (rx_packet['location_id'], rx_packet['sequence'], rx_packet['message'],
+                       rx_packet['payload_raw'], payload_hex, time_received, rssi, snr, duplicate))
+    elif rx_packet['type'] == packet.PACKET_FRAG:
+        key = (rx_packet['location_id'], rx_packet['payload_id'])
+        if db.execute('SELECT 1 FROM payloads WHERE location_id=? AND payload_id=?', key).fetchone():
+            return
+        payload = reassembler.add(rx_packet['location_id'], rx_packet['payload_id'],
+                                  rx_packet['index'], rx_packet['total'], rx_packet['data'],
+                                  time_received)
+        if payload != None:
+            writer.submit(database_insert_payload,
+                          (rx_packet['location_id'], rx_packet['payload_id'], payload, time_received))
+    elif rx_packet['type'] == packet.PACKET_NACK:
+        if rx_packet['origin'] == my_location_id:
+            fragment_sender.nack_received(rx_packet['payload_id'], rx_packet['missing'])
+    elif rx_packet['type'] == packet.PACKET_ACK:
+        for origin, cumulative in rx_packet['acks']:
+            if origin == my_location_id:
+                writer.submit(database_ack_received, rx_packet['location_id'], cumulative,
+                              time_received)
+            else:
+                ack_tracker.overheard(origin, cumulative)
 
+########################################################################
+# Worker Notes:  Everything below named database_* that takes wdb as   #
+#                its first argument runs on the database worker thread #
+#                (see db_worker.py) with the worker's own connection.  #
+#                The radio thread only reads piers.db, through db in   #
+#                WAL mode so a commit in progress never blocks it.     #
+########################################################################
 
+#function: store a received sms (database worker)
+def database_insert_sms(wdb, values):
+    wdb.execute('''
+        INSERT INTO sms (
+            location_id,
+            sequence,
+            message,
+            payload_raw,
+            payload_hex,
+            time_received,
+            rssi,
+            snr,
+            duplicate)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);''',
+        values)
+
+#function: store a reassembled payload (database worker)
+def database_insert_payload(wdb, values):
+    wdb.execute('''
+        INSERT INTO payloads (
+            location_id,
+            payload_id,
+            payload,
+            time_received)
+        VALUES (?, ?, ?, ?);''',
+        values)
+    logging.info('Reassembled payload %s from location %s (%s bytes)',
+                 values[1], values[0], len(values[2]))
+
+#function: mark our own rows acknowledged (database worker)
+def database_ack_received(wdb, acked_by, cumulative, time_received):
+    count = arq.ack_received(wdb, my_location_id, cumulative, time_received)
+    if count > 0:
+        logging.info('Location %s acknowledged %s message(s) up to sequence %s',
+                     acked_by, count, cumulative)
+
+#function: record a completed transmission (database worker)
+def database_tx_complete(wdb, rowid, time_on_air, time_sent):
+    arq.tx_complete(wdb, rowid, time_on_air, time_sent)
+    #once committed the radio thread may trust piers.db for this row again
+    def committed():
+        with tx_inflight_lock:
+            if tx_inflight.get(rowid, (None, None))[1] == time_sent:
+                del tx_inflight[rowid]
+    return committed
+
+#function: run one update statement (database worker)
+def database_execute(wdb, sql, parameters):
+    wdb.execute(sql, parameters)
+
+#function: note a transmission and hand its bookkeeping to the database worker
+def database_sent(rowid, time_on_air, time_sent):
+    with tx_inflight_lock:
+        tx_count = tx_inflight.get(rowid, (None, None))[0]
+    if tx_count == None:
+        tx_count = db.execute('SELECT tx_count FROM sms WHERE rowid=?', (rowid,)).fetchone()[0]
+    with tx_inflight_lock:
+        tx_inflight[rowid] = (tx_count + 1, time_sent)
+    writer.submit(database_tx_complete, rowid, time_on_air, time_sent)
+
+#function: transmit owed acks/nacks, a due time beacon, then the next due sms, then the next fragment
+def database_tx():
+    now = time_sync.now()
+    export_metrics()
+    #pick the packet only once the channel allows it, acks overheard meanwhile may cancel ours
+    channel_access.guard_ms = time_sync.guard_ms(timesync.local_time(), args.guard_ms)
+    wait = channel_access.wait_time(now, ack_airtime)
+    if wait == None or wait > 0:
+        return False
+    #in low power mode leave the end of the window to listening, a full frame and an ack may not fit
+    if schedule and awake_remaining() < tx_reserve:
+        return False
+    #fill an ack frame no further than the largest frame, the one every TDMA slot was sized for
+    acks = ack_tracker.due(now, my_location_id, largest_frame)
+    if acks:
+        #never acknowledge an sms that is not yet on disk
+        if not writer.flush():
+            logging.warning('Database worker flush timed out before sending acks')
+        if not lostik_tx_packet(packet.encode_ack(my_location_id, acks).encode('ASCII')):
+            #refused or failed (channel busy, window too short), the senders still need it
+            ack_tracker.refused(acks, time_sync.now())
+        return True
+    if args.beacon > 0 and time_sync.beacon_due(timesync.local_time()):
+        lostik_tx_packet(lambda: time_sync.beacon(packet.encode_time, timesync.local_time() +
+                                                  beacon_serial_ms).encode('ASCII'))
+        return True
+    nacks = reassembler.due_nacks(now)
+    if nacks:
+        for origin, payload_id, missing in nacks:
+            lostik_tx_packet(packet.encode_nack(my_location_id, origin, payload_id,
+                                                missing).encode('ASCII'))
+        return True
+    with tx_inflight_lock:
+        sent = dict(tx_inflight)
+    next_tx = arq.tx_next(db, my_location_id, now, sent)
+    if next_tx:
+        rowid, payload_hex = next_tx
+        if lostik_tx_packet(bytes.fromhex(payload_hex)):
+            database_sent(rowid, tx_time_on_air, time_sync.now())
+        return True
+    next_fragment = fragment_sender.next_fragment(now)
+    if next_fragment:
+        lostik_tx_packet(next_fragment)
+        return True
+    return False
+
+#function: milliseconds left in the current low power awake window
+def awake_remaining():
+    if time_sync.synced(timesync.local_time()):
+        return schedule.awake_remaining(time_sync.now())
+    return schedule.awake_remaining(time_sync.now(), duty_cycle.wake_guard_ms)
+
+#function: put the LoStik to sleep for sleep_ms and wait for it, returns True once it answers
+def lostik_sleep(sleep_ms):
+    lostik.write(b''.join([b'sys sleep ', bytes(str(sleep_ms), 'ASCII'), b'\r\n']))
+    time.sleep(sleep_ms / 1000)
+    #the radio answers ok when it wakes up
+    for _ in range(3):
+        if lostik.readline().decode('ASCII', 'replace').rstrip() == 'ok':
+            return True
+    #a break and sync byte wakes it early (see Baud Notes)
+    logging.warning('LoStik did not wake from sleep on time')
+    return lostik_set_baud(lostik.baudrate)
+
+#function: publish daemon health to lostik_metrics.json (rate limited unless forced)
+def export_metrics(force=False):
+    metrics_exporter.update(timesync.local_time(),
+                            {'timesync': time_sync.metrics(),
+                             'channel': {'mode': channel_access.mode,
+                                         'guard_ms': channel_access.guard_ms},
+                             'db_queue': writer.metrics(),
+                             'serial': {'baud': lostik.baudrate,
+                                        'round_trip_ms': {str(baud): round(round_trip, 2) for
+                                                          baud, round_trip in serial_round_trip.items()},
+                                        'tx_cycle_ms': serial_tx_cycle.as_dict(),
+                                        'rx_frame_ms': serial_rx_frame.as_dict()},
+                             'duty_cycle': schedule.metrics() if schedule else None},
+                            force)
 
 #function: cleanup
 def at_exit():
@@ -343,6 +843,12 @@ def at_exit():
     lostik_led_control('rx', 'off')
     lostik_led_control('tx', 'off')
     lostik.close()
+    #let the database worker finish what the radio handed it
+    if writer:
+        writer.close()
+        export_metrics(force=True)
+    if db:
+        db.close()
     if Path('lostik.lock').is_file():
         os.remove('lostik.lock')
     logging.info('LoStik port closed')
@@ -351,6 +857,117 @@ def at_exit():
 
 atexit.register(at_exit)
 
+#network clock, beacons keep it aligned across nodes (see timesync.py)
+if args.beacon > 0:
+    timesync.beacon_interval = args.beacon * 1000
+time_sync = timesync.TimeSync(my_location_id, master=args.time_master)
+#a beacon is stamped for when the radio starts, after its 'radio tx <hex>' command crossed the UART
+beacon_length = len(packet.encode_time(99, 0, 10**12))
+beacon_serial_ms = timesync.serial_ms(len('radio tx \r\n') + 2 * beacon_length, lostik.baudrate)
+metrics_exporter = metrics.Exporter('lostik_metrics.json')
+serial_tx_cycle = metrics.Summary()
+serial_rx_frame = metrics.Summary()
+logging.info('Time sync: ' + ('master (stratum 0)' if args.time_master else 'follower'))
+
+#open piers.db for reading and recover the ack state owed to other locations
+db = sqlite3.connect('piers.db')
+#WAL lets the radio thread read while the database worker commits
+db.execute('PRAGMA journal_mode=WAL')
+arq.ensure_schema(db)
+ack_tracker = arq.AckTracker()
+ack_tracker.load(db, my_location_id, time_sync.now())
+reassembler = fragment.Reassembler()
+
+#every write goes through the database worker, group committed
+writer = db_worker.DatabaseWorker('piers.db', maxsize=max(args.db_queue, 1),
+                                  commit_ms=max(args.commit_ms, 0),
+                                  commit_batch=args.commit_batch)
+writer.start()
+fragment_sender = fragment.FragmentSender(db, my_location_id,
+                                          write=lambda sql, parameters:
+                                          writer.submit(database_execute, sql, parameters))
+
+#channel access, TDMA slot n belongs to location id n so slots default to the highest id
+if args.slots == None:
+    args.slots = max(db.execute('SELECT IFNULL(MAX(location_id), 1) FROM locations').fetchone()[0],
+                     my_location_id)
+if args.access == 'tdma' and my_location_id > args.slots:
+    print('ERROR: Location id ' + str(my_location_id) + ' has no TDMA slot, raise --slots!')
+    logging.error('Location id %s has no TDMA slot, raise --slots!', my_location_id)
+    sys.exit(1)
+channel_access = channel.ChannelAccess(args.access, my_location_id, slots=args.slots,
+                                       slot_ms=args.slot_ms, guard_ms=args.guard_ms,
+                                       sense_ms=channel.sense_symbols *
+                                       channel.symbol_ms(int(set_sf[2:]), int(set_bw) * 1000))
+logging.info('Channel access mode: ' + args.access)
+ack_airtime = lostik_airtime(len(packet.encode_ack(99, [(99, 999)])))
+#the longest frame we build is a full fragment, every frame must fit a TDMA slot
+largest_frame = fragment.max_frame_length()
+largest_airtime = lostik_airtime(largest_frame)
+if not channel_access.fits(largest_airtime):
+    print(f'ERROR: A {largest_frame} byte frame ({largest_airtime:.0f} ms on air) does not fit a '
+          f'TDMA slot, raise --slot-ms to at least {largest_airtime + 2 * args.guard_ms:.0f}!')
+    logging.error('A %s byte frame (%.0f ms on air) does not fit a TDMA slot of %s ms',
+                  largest_frame, largest_airtime, args.slot_ms)
+    sys.exit(1)
+
+#listen window (watchdog timer ends a window early, 0 disables it)
+if args.wdt > 0:
+    rx_window = args.wdt
+else:
+    rx_window = 5000
+
+#low power wake schedule (see duty_cycle.py)
+#time to send our longest frame and hear one ack for it (acks spread over arq.ack_delay may
+#still land in the next window)
+tx_reserve = largest_airtime + ack_airtime
+if args.duty_cycle:
+    try:
+        schedule = duty_cycle.DutyCycle(args.duty_cycle[0] * 1000, args.duty_cycle[1] * 1000)
+    except ValueError as error:
+        print('ERROR: Invalid --duty-cycle! ' + str(error))
+        logging.error('Invalid --duty-cycle! %s', error)
+        sys.exit(1)
+    if schedule.awake_ms < tx_reserve:
+        print(f'ERROR: --duty-cycle AWAKE must be at least {tx_reserve / 1000:.1f} s to send '
+              f'a full frame and hear its ack!')
+        logging.error('--duty-cycle AWAKE of %s s cannot fit a full frame and its ack (%.0f ms)',
+                      args.duty_cycle[1], tx_reserve)
+        sys.exit(1)
+    logging.info('Low power mode: awake %s s of every %s s', args.duty_cycle[1], args.duty_cycle[0])
+
+#the loop
+try:
+    while True:
+        if schedule == None:
+            database_tx()
+            lostik_rx_handle(lostik_rx_window(rx_window))
+            continue
+        remaining = awake_remaining()
+        if remaining > 0:
+            database_tx()
+            lostik_rx_handle(lostik_rx_window(int(min(rx_window, remaining))))
+            continue
+        if time_sync.synced(timesync.local_time()):
+            sleep_ms = int(schedule.sleep_time(time_sync.now()))
+        else:
+            sleep_ms = int(schedule.sleep_time(time_sync.now(), duty_cycle.wake_guard_ms))
+        #get everything onto the card and publish health before going quiet
+        writer.flush()
+        export_metrics(force=True)
+        if sleep_ms >= duty_cycle.min_sleep_ms:
+            lostik_sleep(sleep_ms)
+        else:
+            time.sleep(sleep_ms / 1000)
+        schedule.slept(sleep_ms)
+except KeyboardInterrupt:
+    print()
+    sys.exit(0)
+except db_worker.WorkerStopped as error:
+    print('ERROR: Database worker stopped! ' + str(error))
+    logging.error('Database worker stopped! %s', error)
+    sys.exit(1)
+
 
 
 
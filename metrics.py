@@ -0,0 +1,70 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Metrics Export                               #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module publishes daemon health figures (clock   #
+#                 sync quality and the like) as a small JSON file that #
+#                 other PiERS modules, a status page or a shell script #
+#                 can read without talking to the daemon.              #
+#                                                                      #
+########################################################################
+
+import json
+import os
+import time
+
+#function: atomically replace path with sections as JSON (readers never see a partial file)
+def export(path, sections):
+    document = dict(sections, time_exported=int(round(time.time()*1000)))
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(document, file, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
+
+#function: read an exported metrics file, returns {} if missing or unreadable
+def read(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+#class: rate limited exporter, callers hand it their sections as often as they like
+class Exporter:
+    def __init__(self, path, interval_ms=5000):
+        self.path = path
+        self.interval_ms = interval_ms
+        self.next_export = 0
+
+    #function: export if interval_ms has passed since the last export, returns True if written
+    def update(self, now, sections, force=False):
+        if not force and now < self.next_export:
+            return False
+        try:
+            export(self.path, sections)
+        except OSError:
+            return False
+        self.next_export = now + self.interval_ms
+        return True
+
+#class: running count, mean and max of a timing (milliseconds)
+class Summary:
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.last = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.last = value
+        if self.max == None or value > self.max:
+            self.max = value
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean': round(self.total / self.count, 2) if self.count else None,
+                'last': None if self.last == None else round(self.last, 2),
+                'max': None if self.max == None else round(self.max, 2)}
@@ -0,0 +1,166 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Packet                                       #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module composes and parses the over the air     #
+#                 packet formats shared by every PiERS node.  Each     #
+#                 packet begins with a packet type identifier followed #
+#                 by the location identifier of the sending node.      #
+#                                                                      #
+########################################################################
+
+########################################################################
+# Packet Notes:  Header fields are comma separated ASCII.              #
+#                                                                      #
+#                SMS  1,<loc>,<sequence>,<message>                     #
+#                ACK  2,<loc>,<origin>,<cumulative>[,...]              #
+#                FRAG 3,<loc>,<payload_id>,<index>,<total>,<data>      #
+#                NACK 4,<loc>,<origin>,<payload_id>,<index>[,...]      #
+#                ZIP  5,<loc>,<version>,<compressed packet>            #
+#                TIME 6,<loc>,<stratum>,<network time ms>              #
+#                                                                      #
+#                The SMS sequence number counts up from 1 for each     #
+#                originating location.  An ACK carries one or more     #
+#                origin/cumulative pairs, where cumulative is the      #
+#                highest sequence number received from that origin    #
+#                with no gaps below it.  FRAG data is raw bytes and    #
+#                may contain commas, it always runs to end of frame.   #
+#                A NACK lists the fragment indexes still missing.      #
+#                ZIP wraps any other packet, see compress.py.  TIME    #
+#                is a clock sync beacon, see timesync.py.              #
+########################################################################
+
+#largest frame the RN2903 transmits, in bytes
+max_length = 255
+
+#packet type identifiers
+PACKET_SMS = 1
+PACKET_ACK = 2
+PACKET_FRAG = 3
+PACKET_NACK = 4
+PACKET_COMPRESSED = 5
+PACKET_TIME = 6
+
+#function: compose raw sms packet
+def encode_sms(location_id, sequence, message):
+    return str(PACKET_SMS) + ',' + str(location_id) + ',' + str(sequence) + ',' + message
+
+#function: compose raw ack packet from a list of (origin, cumulative) pairs
+def encode_ack(location_id, acks):
+    fields = [str(PACKET_ACK), str(location_id)]
+    for origin, cumulative in acks:
+        fields.append(str(origin))
+        fields.append(str(cumulative))
+    return ','.join(fields)
+
+#function: compose fragment packet bytes (data is bytes)
+def encode_fragment(location_id, payload_id, index, total, data):
+    header = ','.join([str(PACKET_FRAG), str(location_id), str(payload_id), str(index), str(total)])
+    return header.encode('ASCII') + b',' + data
+
+#function: compose raw nack packet listing missing fragment indexes
+def encode_nack(location_id, origin, payload_id, missing):
+    fields = [str(PACKET_NACK), str(location_id), str(origin), str(payload_id)]
+    fields.extend(str(index) for index in missing)
+    return ','.join(fields)
+
+#function: compose raw time sync beacon
+def encode_time(location_id, stratum, time_ms):
+    return ','.join([str(PACKET_TIME), str(location_id), str(stratum), str(time_ms)])
+
+#function: parse received payload bytes, returns dict or None if malformed
+def decode(payload):
+    try:
+        fields = payload.split(b',', 2)
+        packet_type = int(fields[0])
+        location_id = int(fields[1])
+    except (ValueError, IndexError):
+        return None
+    if location_id < 1 or location_id > 99:
+        return None
+    if packet_type == PACKET_FRAG:
+        fields = payload.split(b',', 5)
+        if len(fields) != 6:
+            return None
+        try:
+            payload_id = int(fields[2])
+            index = int(fields[3])
+            total = int(fields[4])
+        except ValueError:
+            return None
+        if index < 0 or index >= total:
+            return None
+        return {'type': PACKET_FRAG,
+                'location_id': location_id,
+                'payload_id': payload_id,
+                'index': index,
+                'total': total,
+                'data': fields[5]}
+    if packet_type == PACKET_COMPRESSED:
+        fields = payload.split(b',', 3)
+        if len(fields) != 4:
+            return None
+        try:
+            version = fields[2].decode('ASCII')
+        except UnicodeDecodeError:
+            return None
+        return {'type': PACKET_COMPRESSED,
+                'location_id': location_id,
+                'version': version,
+                'data': fields[3]}
+    try:
+        payload_raw = payload.decode('ASCII')
+    except UnicodeDecodeError:
+        return None
+    fields = payload_raw.split(',', 3)
+    if packet_type == PACKET_SMS:
+        if len(fields) != 4:
+            return None
+        try:
+            sequence = int(fields[2])
+        except ValueError:
+            return None
+        return {'type': PACKET_SMS,
+                'location_id': location_id,
+                'sequence': sequence,
+                'message': fields[3],
+                'payload_raw': payload_raw}
+    if packet_type == PACKET_ACK:
+        fields = payload_raw.split(',')[2:]
+        if len(fields) == 0 or len(fields) % 2 != 0:
+            return None
+        try:
+            acks = [(int(fields[i]), int(fields[i + 1])) for i in range(0, len(fields), 2)]
+        except ValueError:
+            return None
+        return {'type': PACKET_ACK,
+                'location_id': location_id,
+                'acks': acks}
+    if packet_type == PACKET_TIME:
+        fields = payload_raw.split(',')
+        if len(fields) != 4:
+            return None
+        try:
+            stratum = int(fields[2])
+            time_ms = int(fields[3])
+        except ValueError:
+            return None
+        return {'type': PACKET_TIME,
+                'location_id': location_id,
+                'stratum': stratum,
+                'time_ms': time_ms}
+    if packet_type == PACKET_NACK:
+        fields = payload_raw.split(',')[2:]
+        if len(fields) < 3:
+            return None
+        try:
+            fields = [int(field) for field in fields]
+        except ValueError:
+            return None
+        return {'type': PACKET_NACK,
+                'location_id': location_id,
+                'origin': fields[0],
+                'payload_id': fields[1],
+                'missing': fields[2:]}
+    return None
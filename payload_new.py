@@ -0,0 +1,79 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - New Payload                                  #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module queues a payload too large for a single  #
+#                 SMS packet (roster corrections, batched status       #
+#                 dumps) into the payloads table of piers.db.  The     #
+#                 LoStik module fragments it for transmission.         #
+#                                                                      #
+########################################################################
+
+import argparse
+import fragment
+import sqlite3
+import sys
+import timesync
+from pathlib import Path
+
+my_location_id = None
+
+#establish and parse command line arguments
+parser = argparse.ArgumentParser(description='PiERS Module - New Payload',
+                                 epilog='Created by K7CTC. This module queues a payload too large '
+                                        'for a single SMS packet into the payloads table of '
+                                        'piers.db. The LoStik module fragments it for '
+                                        'transmission.')
+parser.add_argument('file', nargs='?', default='-',
+                    help='file to be queued for transmission (default: read from stdin)')
+args = parser.parse_args()
+
+if Path('piers.db').is_file() == False:
+    print('ERROR: File not found - piers.db')
+    sys.exit(1)
+
+if Path('piers.conf').is_file() == False:
+    print('ERROR: File not found - piers.conf')
+    sys.exit(1)
+
+#attempt to read and validate the location id integer from piers.conf
+try:
+    file = open('piers.conf')
+    my_location_id = int(file.readline())
+    file.close()
+except:
+    print('ERROR: Failed to read location id from piers.conf!')
+    sys.exit(1)
+if my_location_id < 1 or my_location_id > 99:
+    print('ERROR: Location identifier out of range!')
+    sys.exit(1)
+
+#read the payload
+try:
+    if args.file == '-':
+        data = sys.stdin.buffer.read()
+    else:
+        with open(args.file, 'rb') as file:
+            data = file.read()
+except OSError:
+    print('ERROR: Unable to read ' + args.file)
+    sys.exit(1)
+
+limit = fragment.fragment_size * fragment.max_fragments
+if len(data) == 0 or len(data) > limit:
+    print('ERROR: Payload must be between 1 and ' + str(limit) + ' bytes in length!')
+    sys.exit(1)
+
+try:
+    db = sqlite3.connect('piers.db')
+    db.execute('PRAGMA foreign_keys = ON')
+    payload_id = fragment.queue_payload(db, my_location_id, data, timesync.network_time())
+    db.close()
+except sqlite3.Error:
+    print('ERROR: Database entry failure!')
+    sys.exit(1)
+
+print('SUCCESS: Payload ' + str(payload_id) + ' (' + str(len(fragment.split(data))) +
+      ' fragments) has been queued for transmission.')
+sys.exit(0)
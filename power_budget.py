@@ -0,0 +1,126 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Power Budget                                 #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module estimates the average current of a node  #
+#                 and how long a given USB power bank will keep it     #
+#                 running, for continuous receive and for the low      #
+#                 power duty cycle mode of lostik.py.                  #
+#                                                                      #
+########################################################################
+
+########################################################################
+# Budget Notes:  Currents are typical datasheet and bench figures at   #
+#                the 5 V USB rail, not measurements of your node.  The #
+#                RN2903 runs from a regulator on the LoStik, so its    #
+#                3.3 V current is drawn from 5 V unchanged.  Measure   #
+#                a node with a USB power meter and pass --pi-ma to     #
+#                replace the largest (and least certain) figure.       #
+#                                                                      #
+#                Power bank capacity is rated at the cell voltage      #
+#                (3.7 V), the boost to 5 V loses --efficiency of it.   #
+########################################################################
+
+import argparse
+import channel
+import timesync
+
+#Raspberry Pi idle current at 5 V with the WiFi hotspot up (mA)
+pi_ma = {'zero-w': 120, '3b+': 450, '4': 600}
+#RN2903 currents (mA): receiving, awake but idle, sys sleep
+radio_rx_ma = 13.5
+radio_idle_ma = 2.8
+radio_sleep_ma = 0.002
+#RN2903 transmit current by radio set pwr (mA), interpolated in between
+radio_tx_ma = {2: 35, 5: 42, 10: 58, 14: 80, 17: 102, 20: 124}
+#LoStik USB serial bridge (always on) and one lit LED (mA)
+bridge_ma = 12
+led_ma = 2
+
+#function: transmit current at a power setting
+def tx_current(pwr):
+    levels = sorted(radio_tx_ma)
+    for low, high in zip(levels, levels[1:]):
+        if low <= pwr <= high:
+            return radio_tx_ma[low] + (radio_tx_ma[high] - radio_tx_ma[low]) * (pwr - low) / (high - low)
+    return radio_tx_ma[levels[-1]] if pwr > levels[-1] else radio_tx_ma[levels[0]]
+
+#function: average current breakdown (mA) and runtime (hours) of one node
+def estimate(battery_mah, cell_voltage=3.7, efficiency=0.85, pi='3b+', pi_override=None,
+             sent=10, heard=90, acks=None, retries=0.3, message_length=40, beacon_s=300,
+             sf=12, pwr=2, cycle_s=None, awake_s=None):
+    if acks == None:
+        #cumulative acks and ack suppression leave roughly one ack per few messages heard
+        acks = heard / 4
+    frame_ms = channel.airtime(message_length + 8, sf=sf)
+    ack_ms = channel.airtime(12, sf=sf)
+    beacon_ms = channel.airtime(20, sf=sf)
+    tx_ms_per_hour = (sent * (1 + retries) * frame_ms + acks * ack_ms +
+                      (3600 / beacon_s * beacon_ms if beacon_s else 0))
+    tx_fraction = tx_ms_per_hour / 3600000
+    awake_fraction = 1 if cycle_s == None else min(awake_s / cycle_s, 1)
+    rx_fraction = max(awake_fraction - tx_fraction, 0)
+    sleep_fraction = 1 - awake_fraction
+    breakdown = {'pi': pi_ma[pi] if pi_override == None else pi_override,
+                 'bridge': bridge_ma,
+                 'radio rx': rx_fraction * (radio_rx_ma + led_ma),
+                 'radio tx': tx_fraction * (tx_current(pwr) + led_ma),
+                 'radio sleep': sleep_fraction * radio_sleep_ma}
+    total_ma = sum(breakdown.values())
+    battery_wh = battery_mah / 1000 * cell_voltage * efficiency
+    runtime_h = battery_wh / (5 * total_ma / 1000)
+    return breakdown, total_ma, runtime_h
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PiERS Module - Power Budget',
+                                     epilog='Created by K7CTC. This module estimates the average '
+                                            'current of a node and how long a USB power bank will '
+                                            'keep it running, with and without the low power '
+                                            'duty cycle mode of lostik.py.')
+    parser.add_argument('--battery', type=float, default=10000,
+                        help='power bank capacity in mAh (default: 10000)')
+    parser.add_argument('--cell-voltage', type=float, default=3.7,
+                        help='voltage the capacity is rated at (default: 3.7)')
+    parser.add_argument('--efficiency', type=float, default=0.85,
+                        help='power bank boost converter efficiency (default: 0.85)')
+    parser.add_argument('--pi', choices=sorted(pi_ma), default='3b+',
+                        help='Raspberry Pi model (default: 3b+)')
+    parser.add_argument('--pi-ma', type=float, default=None,
+                        help='measured Pi current at 5 V in mA, replaces the --pi figure')
+    parser.add_argument('--sent', type=float, default=10,
+                        help='messages this station originates per hour (default: 10)')
+    parser.add_argument('--heard', type=float, default=90,
+                        help='messages heard from other stations per hour (default: 90)')
+    parser.add_argument('--retries', type=float, default=0.3,
+                        help='average retransmissions per message (default: 0.3)')
+    parser.add_argument('--length', type=int, default=40,
+                        help='average message length in characters (default: 40)')
+    parser.add_argument('--beacon', type=int, default=timesync.beacon_interval // 1000,
+                        help='time sync beacon interval in seconds, 0 for none (default: 300)')
+    parser.add_argument('--sf', type=int, choices=range(7, 13), default=12,
+                        help='spreading factor (default: 12)')
+    parser.add_argument('--pwr', type=int, choices=range(2, 21), default=2,
+                        help='LoStik transmit power (default: 2)')
+    parser.add_argument('--duty-cycle', type=int, nargs=2, metavar=('CYCLE', 'AWAKE'),
+                        default=(60, 15),
+                        help='lostik.py --duty-cycle values to compare with continuous receive '
+                             '(default: 60 15)')
+    args = parser.parse_args()
+
+    print(f'{args.battery:.0f} mAh at {args.cell_voltage} V, {args.efficiency:.0%} efficient, '
+          f'Pi {args.pi if args.pi_ma == None else str(args.pi_ma) + " mA (measured)"}, '
+          f'SF{args.sf} pwr {args.pwr}')
+    print(f'{"mode":<22}' + ''.join(f'{part:>12}' for part in
+                                    ('pi', 'bridge', 'radio rx', 'radio tx', 'radio sleep')) +
+          f'{"total mA":>10}{"runtime h":>11}')
+    modes = [('continuous rx', None, None),
+             (f'duty cycle {args.duty_cycle[1]}/{args.duty_cycle[0]} s',
+              args.duty_cycle[0], args.duty_cycle[1])]
+    for name, cycle_s, awake_s in modes:
+        breakdown, total_ma, runtime_h = estimate(args.battery, args.cell_voltage, args.efficiency,
+                                                  args.pi, args.pi_ma, args.sent, args.heard, None,
+                                                  args.retries, args.length, args.beacon, args.sf,
+                                                  args.pwr, cycle_s, awake_s)
+        print(f'{name:<22}' + ''.join(f'{value:>12.3f}' for value in breakdown.values()) +
+              f'{total_ma:>10.1f}{runtime_h:>11.1f}')
@@ -0,0 +1,441 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Network Simulator                            #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.1                                                 #
+#   DESCRIPTION:  Discrete event simulation of up to 99 PiERS nodes    #
+#                 sharing one LoRa channel.  Every virtual node runs   #
+#                 the real node logic (sms_queue inserts into its own  #
+#                 in-memory piers.db, arq retransmission and acks,     #
+#                 packet encoding and channel.py access control)       #
+#                 against virtual radios that model LoRa airtime, path #
+#                 loss, capture effect and collisions.                 #
+#                                                                      #
+########################################################################
+
+########################################################################
+# Radio Model Notes:  Nodes are scattered uniformly over a square area.#
+#                     Received power follows log-distance path loss    #
+#                     with log-normal shadowing, fixed per link.  A    #
+#                     frame is received when its SNR clears the        #
+#                     demodulation floor of the spreading factor and   #
+#                     it beats every overlapping audible frame by the  #
+#                     capture threshold.  Radios are half duplex.      #
+#                     There is no relaying, so delivery ratio only     #
+#                     counts receivers within range of the origin.     #
+#                                                                      #
+#                     Listen-before-talk hears only what lostik_sense  #
+#                     can: a preamble with at least detect_symbols in  #
+#                     the sense window.  The node then stays in        #
+#                     receive until that frame ends.  Frames already   #
+#                     past their preamble go unheard.                  #
+#                                                                      #
+#                     util is the fraction of time the channel carried #
+#                     at least one frame.  load adds up every node's   #
+#                     airtime, so it passes 1 when frames pile up.     #
+########################################################################
+
+########################################################################
+# Speed Notes:  Every node runs real SQLite queries against the full   #
+#               piers.db schema (sql_create_db.ensure_schema, indexes  #
+#               included), which costs speed.  At 10 nodes and 30      #
+#               messages per node per hour one run covers roughly 300  #
+#               (lbt) to 850 (tdma) simulated hours per minute on a    #
+#               desktop CPU.  At 99 nodes it drops to roughly 15       #
+#               (aloha) to 90 (tdma).  Run time grows with the number  #
+#               of frames sent, so light traffic runs faster.          #
+########################################################################
+
+import argparse
+import arq
+import channel
+import fragment
+import heapq
+import math
+import packet
+import random
+import sms_queue
+import sql_create_db
+import sqlite3
+import sys
+import time
+
+#demodulation SNR floor per spreading factor (Semtech SX1276 datasheet)
+snr_floor = {7: -7.5, 8: -10, 9: -12.5, 10: -15, 11: -17.5, 12: -20}
+#receiver noise floor for 125 kHz bandwidth (thermal -123 dBm plus 6 dB noise figure)
+noise_floor = -117
+#stronger frame survives an overlap when it leads by this many dB
+capture_db = 6
+#preamble symbols a receiver needs inside its sense window to lock onto a frame (assumed)
+detect_symbols = 4
+
+#class: the shared channel, transmissions in progress and everything they overlapped
+class VirtualChannel:
+    def __init__(self, simulation, preamble_ms, detect_ms):
+        self.simulation = simulation
+        self.preamble_ms = preamble_ms
+        self.detect_ms = detect_ms
+        self.active = []
+
+    #function: begin a transmission, returns the record describing it
+    def start(self, sender, start, end, payload):
+        transmission = {'sender': sender, 'start': start, 'end': end, 'payload': payload,
+                        'overlaps': []}
+        for other in self.active:
+            other['overlaps'].append(transmission)
+            transmission['overlaps'].append(other)
+        self.active.append(transmission)
+        return transmission
+
+    #function: transmission ended
+    def finish(self, transmission):
+        self.active.remove(transmission)
+
+    #function: end of the frame whose preamble the listener locks onto in the sense window
+    #[start, end], None if it hears none (a frame past its preamble is invisible to the RN2903)
+    def preamble_detected(self, listener, start, end):
+        locked = None
+        for other in self.active:
+            if other['sender'] != listener and \
+                    min(other['start'] + self.preamble_ms, end) - max(other['start'], start) \
+                    >= self.detect_ms and self.simulation.audible(other['sender'], listener):
+                if locked == None or other['start'] < locked['start']:
+                    locked = other
+        return locked['end'] if locked else None
+
+    #function: True if the receiver decodes the transmission despite any overlaps
+    def received(self, transmission, receiver):
+        if not self.simulation.audible(transmission['sender'], receiver):
+            return False
+        signal = self.simulation.rssi[transmission['sender']][receiver]
+        for other in transmission['overlaps']:
+            if other['sender'] == receiver:
+                return False
+            if self.simulation.audible(other['sender'], receiver) and \
+                    signal - self.simulation.rssi[other['sender']][receiver] < capture_db:
+                return False
+        return True
+
+#class: one station running the real queueing, ack and channel access logic
+class VirtualNode:
+    def __init__(self, simulation, location_id, access):
+        self.simulation = simulation
+        self.location_id = location_id
+        self.access = access
+        #the piers.db schema lostik.py runs against, indexes included
+        self.db = sqlite3.connect(':memory:')
+        sql_create_db.ensure_schema(self.db)
+        self.ack_tracker = arq.AckTracker()
+        self.busy = False
+        self.wake_at = None
+
+    #function: a message was typed at this station
+    def arrival(self, now, message):
+        sequence = sms_queue.insert(self.db, self.location_id, message, now)
+        self.db.commit()
+        self.simulation.message_queued(self.location_id, sequence, len(message), now)
+        self.wake(now)
+
+    #function: start servicing the transmit queue unless already doing so
+    def wake(self, now):
+        if self.wake_at != None and now >= self.wake_at:
+            self.wake_at = None
+        if not self.busy:
+            self.busy = True
+            self.service(now)
+
+    #function: the lostik.py transmit order, owed acks first then the next due sms
+    def service(self, now):
+        next_tx, tx_wake = arq.tx_plan(self.db, self.location_id, now)
+        ack_ready = self.ack_tracker.deadline != None and now >= self.ack_tracker.deadline
+        #pick the packet only once the channel allows it, acks overheard meanwhile may cancel ours
+        if next_tx or ack_ready:
+            wait = self.access.wait_time(now, self.simulation.ack_airtime)
+            if wait > 0:
+                self.simulation.schedule(now + wait, self.service)
+                return
+        acks = self.ack_tracker.due(now, self.location_id, self.simulation.max_frame)
+        if acks:
+            self.send(now, packet.encode_ack(self.location_id, acks).encode('ASCII'), None, acks)
+            return
+        if next_tx:
+            self.send(now, bytes.fromhex(next_tx[1]), next_tx[0])
+            return
+        self.busy = False
+        #sleep until the next ack deadline or retransmission, whichever is first
+        wakes = [wake for wake in (self.ack_tracker.deadline, tx_wake) if wake != None]
+        if wakes:
+            wake = max(min(wakes), now + 1)
+            if self.wake_at == None or wake < self.wake_at:
+                self.wake_at = wake
+                self.simulation.schedule(wake, self.wake)
+
+    #function: channel access for one packet, same steps as lostik_tx_packet
+    #acks (optional) are the pairs an ack payload carries, owed again if it is refused
+    def send(self, now, payload, rowid, acks=None):
+        airtime = self.simulation.airtime(len(payload))
+        wait = self.access.wait_time(now, airtime)
+        if wait > 0:
+            self.simulation.schedule(now + wait, self.send, payload, rowid, acks)
+        elif self.access.needs_sense():
+            self.simulation.schedule(now + self.access.sense_ms, self.sense_done, payload, rowid,
+                                    acks, now)
+        else:
+            self.transmit(now, payload, rowid)
+
+    #function: end of a listen-before-talk sensing window, same outcome as lostik_sense
+    def sense_done(self, now, payload, rowid, acks, sense_start):
+        frame_end = self.simulation.channel.preamble_detected(self.location_id, sense_start, now)
+        if frame_end != None and frame_end > now:
+            #the radio stays in receive until the frame it locked onto ends
+            self.simulation.schedule(frame_end, self.sense_result, payload, rowid, acks, True)
+        else:
+            self.sense_result(now, payload, rowid, acks, frame_end != None)
+
+    #function: act on a sensing result as lostik_tx_packet does
+    def sense_result(self, now, payload, rowid, acks, busy):
+        if not self.access.sensed(now, busy):
+            self.simulation.stats['deferred'] += 1
+            if acks:
+                self.ack_tracker.refused(acks, now)
+            self.service(now)
+        elif busy:
+            self.send(now, payload, rowid, acks)
+        else:
+            self.transmit(now, payload, rowid)
+
+    #function: put a packet on the air
+    def transmit(self, now, payload, rowid):
+        #the RN2903 rejects a longer radio tx and lostik.py exits on that
+        if len(payload) > packet.max_length:
+            raise ValueError(f'location {self.location_id} built a {len(payload)} byte frame, '
+                             f'the radio limit is {packet.max_length}')
+        end = now + self.simulation.airtime(len(payload))
+        transmission = self.simulation.channel.start(self.location_id, now, end, payload)
+        self.simulation.stats['frames'] += 1
+        self.simulation.stats['airtime'] += end - now
+        #channel busy time is the union of transmissions, overlapping frames count once
+        #(events run in time order, so no later frame can start before this one)
+        self.simulation.stats['busy'] += max(end - max(now, self.simulation.busy_until), 0)
+        self.simulation.busy_until = max(self.simulation.busy_until, end)
+        self.simulation.schedule(end, self.transmit_done, transmission, rowid)
+
+    #function: transmission finished, record it and deliver it wherever it survived
+    def transmit_done(self, now, transmission, rowid):
+        self.simulation.channel.finish(transmission)
+        if rowid != None:
+            arq.tx_complete(self.db, rowid, transmission['start'], now)
+            self.db.commit()
+        #every receiver would decode the same bytes, so decode them once
+        rx_packet = None
+        for node in self.simulation.nodes:
+            if node is not self and self.simulation.channel.received(transmission, node.location_id):
+                if rx_packet == None:
+                    rx_packet = packet.decode(transmission['payload'])
+                node.receive(now, rx_packet)
+        self.service(now)
+
+    #function: the lostik.py database_rx path for sms and ack packets
+    def receive(self, now, rx_packet):
+        self.access.heard(now)
+        if rx_packet == None:
+            return
+        if rx_packet['type'] == packet.PACKET_SMS:
+            self.ack_tracker.heard(rx_packet['location_id'], rx_packet['sequence'], now)
+            self.simulation.message_received(rx_packet['location_id'], rx_packet['sequence'],
+                                             self.location_id, now)
+            self.wake(now)
+        elif rx_packet['type'] == packet.PACKET_ACK:
+            for origin, cumulative in rx_packet['acks']:
+                if origin == self.location_id:
+                    arq.ack_received(self.db, self.location_id, cumulative, now)
+                    self.db.commit()
+                else:
+                    self.ack_tracker.overheard(origin, cumulative)
+
+#class: event queue, nodes, radio links and statistics for one run
+class Simulation:
+    def __init__(self, mode, nodes, rate, sf, area_km, exponent, shadowing_db, tx_dbm,
+                 slot_ms, guard_ms, seed):
+        self.rng = random.Random(seed)
+        #the ack delay in arq draws from the module level generator
+        random.seed(seed)
+        self.sf = sf
+        self.rate = rate
+        self.events = []
+        self.sequence = 0
+        self.channel = VirtualChannel(self, channel.airtime(0, sf=sf) -
+                                      channel.airtime(0, sf=sf, preamble=0),
+                                      detect_symbols * channel.symbol_ms(sf))
+        self.stats = {'frames': 0, 'deferred': 0, 'airtime': 0, 'busy': 0}
+        self.busy_until = 0
+        self.messages = {}
+        self.nodes = [VirtualNode(self, location_id,
+                                  channel.ChannelAccess(mode, location_id, slots=nodes,
+                                                        slot_ms=slot_ms, guard_ms=guard_ms,
+                                                        sense_ms=channel.sense_symbols *
+                                                        channel.symbol_ms(sf),
+                                                        rng=random.Random(self.rng.random())))
+                      for location_id in range(1, nodes + 1)]
+        #per link received power in dBm, index 0 unused so location ids index directly
+        positions = [None] + [(self.rng.uniform(0, area_km * 1000), self.rng.uniform(0, area_km * 1000))
+                              for _ in range(nodes)]
+        self.rssi = [[None] * (nodes + 1) for _ in range(nodes + 1)]
+        for a in range(1, nodes + 1):
+            for b in range(a + 1, nodes + 1):
+                distance = max(math.dist(positions[a], positions[b]), 1)
+                #free space loss at 1 m for 915 MHz is about 31.7 dB
+                loss = 31.7 + 10 * exponent * math.log10(distance) + self.rng.gauss(0, shadowing_db)
+                self.rssi[a][b] = self.rssi[b][a] = tx_dbm - loss
+        self.threshold = noise_floor + snr_floor[sf]
+        self.ack_airtime = self.airtime(len(packet.encode_ack(99, [(99, 999)])))
+        #acks are filled up to the longest frame lostik.py builds, as there
+        self.max_frame = fragment.max_frame_length()
+
+    def airtime(self, size):
+        return channel.airtime(size, sf=self.sf)
+
+    #function: True if b can demodulate a lone frame from a
+    def audible(self, a, b):
+        return self.rssi[a][b] >= self.threshold
+
+    #function: schedule callback(time, *callback_args) at a simulated time in milliseconds
+    def schedule(self, time, callback, *callback_args):
+        self.sequence += 1
+        heapq.heappush(self.events, (time, self.sequence, callback, callback_args))
+
+    #function: Poisson message arrivals at one node
+    def next_arrival(self, now, node):
+        if now > self.arrivals_until:
+            return
+        node.arrival(now, 'bib ' + str(self.rng.randint(1, 999)) + ' status check')
+        self.schedule(now + self.rng.expovariate(self.rate / 3600000), self.next_arrival, node)
+
+    def message_queued(self, origin, sequence, size, now):
+        self.messages[(origin, sequence)] = {'queued': now, 'size': size, 'received': {}}
+
+    def message_received(self, origin, sequence, receiver, now):
+        message = self.messages.get((origin, sequence))
+        if message != None and receiver not in message['received']:
+            message['received'][receiver] = now - message['queued']
+
+    #function: generate traffic for duration_ms, then let queues drain for drain_ms
+    def run(self, duration_ms, drain_ms):
+        self.arrivals_until = duration_ms
+        for node in self.nodes:
+            self.schedule(self.rng.expovariate(self.rate / 3600000), self.next_arrival, node)
+        while self.events and self.events[0][0] <= duration_ms + drain_ms:
+            event_time, _, callback, callback_args = heapq.heappop(self.events)
+            callback(event_time, *callback_args)
+        pairs = 0
+        delivered = 0
+        latencies = []
+        for (origin, sequence), message in self.messages.items():
+            for node in self.nodes:
+                if node.location_id != origin and self.audible(origin, node.location_id):
+                    pairs += 1
+                    if node.location_id in message['received']:
+                        delivered += 1
+                        latencies.append(message['received'][node.location_id])
+        latencies.sort()
+        return {'messages': len(self.messages),
+                'frames': self.stats['frames'],
+                'deferred': self.stats['deferred'],
+                'delivery_ratio': delivered / pairs if pairs else 0,
+                #message bytes delivered per receiver per second
+                'goodput_bps': sum(message['size'] * len(message['received'])
+                                   for message in self.messages.values()) * 8
+                               / max(len(self.nodes) - 1, 1) / ((duration_ms + drain_ms) / 1000),
+                'latency_ms': {'p50': percentile(latencies, 50),
+                               'p90': percentile(latencies, 90),
+                               'p99': percentile(latencies, 99)},
+                #fraction of time at least one node was transmitting
+                'utilization': self.stats['busy'] / (duration_ms + drain_ms),
+                #airtime summed over every node per unit time, above 1 once frames overlap a lot
+                'offered_load': self.stats['airtime'] / (duration_ms + drain_ms)}
+
+#function: nearest rank percentile of a sorted list
+def percentile(values, percent):
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(percent / 100 * len(values)) - 1))]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PiERS - Network Simulator',
+                                     epilog='Created by K7CTC. Discrete event simulation of PiERS '
+                                            'nodes sharing one LoRa channel.')
+    parser.add_argument('--nodes', default='10',
+                        help='number of stations, or a comma separated list to sweep (2 to 99, '
+                             'default: 10)')
+    parser.add_argument('--rate', default='30',
+                        help='messages per node per hour, or a comma separated list to sweep '
+                             '(default: 30)')
+    parser.add_argument('--sf', type=int, choices=range(7, 13), default=12,
+                        help='spreading factor (default: 12)')
+    parser.add_argument('--area', type=float, default=5,
+                        help='side of the square event area in km (default: 5)')
+    parser.add_argument('--exponent', type=float, default=3.0,
+                        help='path loss exponent (default: 3.0)')
+    parser.add_argument('--shadowing', type=float, default=6,
+                        help='log-normal shadowing standard deviation in dB (default: 6)')
+    parser.add_argument('--pwr', type=float, default=14,
+                        help='transmit power in dBm (default: 14)')
+    parser.add_argument('--hours', type=float, default=24,
+                        help='simulated hours of traffic (default: 24)')
+    parser.add_argument('--drain', type=float, default=2,
+                        help='simulated hours without new traffic afterwards (default: 2)')
+    parser.add_argument('--slot-ms', type=int, default=10000,
+                        help='TDMA slot length in milliseconds (default: 10000)')
+    parser.add_argument('--guard-ms', type=int, default=500,
+                        help='TDMA guard interval in milliseconds (default: 500)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='random seed (default: 1)')
+    parser.add_argument('--mode', choices=channel.modes + ('compare',), default='compare',
+                        help='channel access mode to simulate (default: compare all)')
+    args = parser.parse_args()
+
+    try:
+        node_counts = [int(value) for value in args.nodes.split(',')]
+        rates = [float(value) for value in args.rate.split(',')]
+    except ValueError:
+        print('ERROR: --nodes and --rate take numbers or comma separated lists of numbers!')
+        sys.exit(1)
+    if any(count < 2 or count > 99 for count in node_counts):
+        print('ERROR: Node count out of range!')
+        sys.exit(1)
+    if args.mode == 'compare':
+        run_modes = channel.modes
+    else:
+        run_modes = (args.mode,)
+    #the longest frame (a full ack) must fit a TDMA slot, channel.py refuses frames that would
+    #overrun it
+    frame_airtime = channel.airtime(fragment.max_frame_length(), sf=args.sf)
+    if 'tdma' in run_modes and not channel.ChannelAccess('tdma', 1, slot_ms=args.slot_ms,
+                                                         guard_ms=args.guard_ms).fits(frame_airtime):
+        print(f'ERROR: --slot-ms must be at least {frame_airtime + 2 * args.guard_ms:.0f} '
+              f'to fit a full frame at SF{args.sf}!')
+        sys.exit(1)
+
+    print(f'SF{args.sf}, {args.area:g} km area, {args.hours:g}+{args.drain:g} simulated hours, '
+          f'seed {args.seed}')
+    print(f'{"nodes":>5}{"rate":>6} {"mode":<6}{"msgs":>7}{"frames":>8}{"delivery":>9}'
+          f'{"goodput":>12}{"p50 s":>8}{"p90 s":>8}{"p99 s":>8}{"util":>7}{"load":>7}'
+          f'{"sim h/min":>11}')
+    for node_count in node_counts:
+        for rate in rates:
+            for mode in run_modes:
+                simulation = Simulation(mode, node_count, rate, args.sf, args.area, args.exponent,
+                                        args.shadowing, args.pwr, args.slot_ms, args.guard_ms,
+                                        args.seed)
+                start_time = time.perf_counter()
+                result = simulation.run(args.hours * 3600000, args.drain * 3600000)
+                elapsed = time.perf_counter() - start_time
+                latency = [value / 1000 if value != None else float('nan')
+                           for value in result['latency_ms'].values()]
+                print(f'{node_count:>5}{rate:>6g} {mode:<6}{result["messages"]:>7}'
+                      f'{result["frames"]:>8}{result["delivery_ratio"]:>9.3f}'
+                      f'{result["goodput_bps"]:>8.2f} bps{latency[0]:>8.1f}{latency[1]:>8.1f}'
+                      f'{latency[2]:>8.1f}{result["utilization"]:>7.3f}'
+                      f'{result["offered_load"]:>7.3f}'
+                      f'{(args.hours + args.drain) / elapsed * 60:>11.0f}')
+    sys.exit(0)
@@ -0,0 +1,56 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - SMS Client                                   #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  Thin client for the SMS submission service.  Queues  #
+#                 the message given on the command line, or every line #
+#                 read from stdin, through piers.sock.  Imports are    #
+#                 kept to the minimum so startup stays fast.           #
+#                                                                      #
+########################################################################
+
+import sys
+
+#usage: sms_client.py [message words ...]   (no message reads lines from stdin)
+if len(sys.argv) > 1 and sys.argv[1] in ('-h', '--help'):
+    print('usage: sms_client.py [message]')
+    print('Queue a message through the PiERS SMS submission service (piers.sock).')
+    print('With no message, every line read from stdin is queued.')
+    sys.exit(0)
+
+import socket
+
+try:
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect('piers.sock')
+except OSError:
+    print('ERROR: SMS submission service is not running (piers.sock)')
+    sys.exit(1)
+
+if len(sys.argv) > 1:
+    messages = [' '.join(sys.argv[1:])]
+else:
+    messages = [line.rstrip('\r\n') for line in sys.stdin]
+
+#pipeline in windows so neither side blocks on a full socket buffer
+replies = client.makefile('r', encoding='UTF-8')
+failures = 0
+window = 256
+for start in range(0, len(messages), window):
+    batch = messages[start:start + window]
+    client.sendall(''.join(message + '\n' for message in batch).encode('UTF-8'))
+    for message in batch:
+        reply = replies.readline().rstrip('\n')
+        if not reply.startswith('OK'):
+            failures += 1
+            print(reply + ': ' + message)
+client.close()
+
+if failures:
+    sys.exit(1)
+if len(messages) == 1:
+    print('SUCCESS: Message has been queued for transmission.')
+else:
+    print('SUCCESS: ' + str(len(messages)) + ' messages have been queued for transmission.')
+sys.exit(0)
@@ -12,11 +12,13 @@
 ########################################################################
 
 import argparse
+import arq
 import os
-import re
+import sms_queue
 import sqlite3
 import sys
 import time
+import timesync
 from pathlib import Path
 
 my_location_id = None
@@ -30,8 +32,14 @@ parser = argparse.ArgumentParser(description='PiERS Module - New SMS',
                                         'identifier is appended and the resulting data is '
                                         'inserted into a new row within the sms table of '
                                         'piers.db.')
-parser.add_argument('-m', '--message', nargs='?', default=None,
+#a single message and a bulk file cannot be queued by the same run
+source = parser.add_mutually_exclusive_group()
+source.add_argument('-m', '--message', nargs='?', default=None,
                     help='message of up to 50 characters in length to be queued for transmission')
+source.add_argument('-b', '--bulk', metavar='FILE', default=None,
+                    help='queue one message per line from FILE (use - for stdin)')
+parser.add_argument('--chunk', type=int, default=500,
+                    help='messages per transaction in bulk mode (default: 500)')
 args = parser.parse_args()
 
 if Path('piers.db').is_file() == False:
@@ -57,60 +65,35 @@ if my_location_id < 1 or my_location_id > 99:
 #use location id to obtain corresponding location name from the database
 try:
     db = sqlite3.connect('piers.db')
-    c = db.cursor()
-    c.execute('SELECT location_name FROM locations WHERE location_id=?',(my_location_id,))
-    query_result = c.fetchone()
-    if query_result:
-        my_location_name = query_result[0]
-    else:
-        print('ERROR: Invalid location identifier!')
-        c.close()
-        db.close()
-        sys.exit(1)
-except:
-    print('ERROR: Unable to connect to piers.db') 
-    c.close()
+    #piers.db files from before acks get the sequence columns
+    arq.ensure_schema(db)
+    my_location_name = sms_queue.location_name(db, my_location_id)
     db.close()
+except:
+    print('ERROR: Unable to connect to piers.db')
+    sys.exit(1)
+if my_location_name == None:
+    print('ERROR: Invalid location identifier!')
     sys.exit(1)
 
 #function: message validation
 def validate_message(message_to_be_validated):
-    #only contain A-Z a-z 0-9 . ? ! and between 1 and 50 chars in length
-    if re.fullmatch('^[a-zA-Z0-9!?. ]{1,50}$', message_to_be_validated):
-        return True
-    else:
-        return False
+    return sms_queue.validate_message(message_to_be_validated)
 
 #function: insert message into database      
 def database_entry(message):
-    #compose raw packet to be sent over the air
-    payload_raw = str(1) + ',' + str(my_location_id) + ',' + message
-    #compose hex encoded version of raw packet to be sent over the air
-    payload_hex = payload_raw.encode('UTF-8').hex()
     #attempt database entry
     try:
         db = sqlite3.connect('piers.db')
-        c = db.cursor()
         #enable foreign key constraints
-        c.execute('PRAGMA foreign_keys = ON')
-        time_queued = int(round(time.time()*1000))
-        c.execute('''
-            INSERT INTO sms (
-                location_id,
-                message,
-                payload_raw,
-                payload_hex,
-                time_queued,
-                tx_count)
-            VALUES (?, ?, ?, ?, ?, ?);''',
-            (my_location_id, message, payload_raw, payload_hex, time_queued, 0))
+        db.execute('PRAGMA foreign_keys = ON')
+        time_queued = timesync.network_time()
+        sms_queue.insert(db, my_location_id, message, time_queued)
     except:
-        c.close()
         db.close()
         return False
     else:
         db.commit()
-        c.close()
         db.close()
         return True
 
@@ -128,6 +111,61 @@ if args.message != None:
         print('ERROR: Your message contained invalid characters or is of invalid length!')
         sys.exit(1)
 
+#function: stream messages from a file object, inserting them in chunked transactions
+def database_bulk_entry(source):
+    db = sqlite3.connect('piers.db')
+    db.execute('PRAGMA foreign_keys = ON')
+    queued = 0
+    rejected = 0
+    chunk = []
+    start_time = time.perf_counter()
+    for line_number, line in enumerate(source, 1):
+        message = line.rstrip('\r\n')
+        if message == '':
+            continue
+        if validate_message(message):
+            chunk.append(message)
+        else:
+            rejected += 1
+            print('REJECTED (line ' + str(line_number) + '): ' + message)
+        if len(chunk) >= args.chunk:
+            with db:
+                queued += sms_queue.insert_many(db, my_location_id, chunk,
+                                                timesync.network_time())
+            chunk = []
+    if chunk:
+        with db:
+            queued += sms_queue.insert_many(db, my_location_id, chunk,
+                                            timesync.network_time())
+    elapsed = time.perf_counter() - start_time
+    db.close()
+    return queued, rejected, elapsed
+
+#if bulk file provided, queue every valid line then quit
+if args.bulk != None:
+    if args.chunk < 1:
+        print('ERROR: --chunk must be at least 1!')
+        sys.exit(1)
+    try:
+        if args.bulk == '-':
+            queued, rejected, elapsed = database_bulk_entry(sys.stdin)
+        else:
+            with open(args.bulk) as source:
+                queued, rejected, elapsed = database_bulk_entry(source)
+    except OSError:
+        print('ERROR: Unable to read ' + args.bulk)
+        sys.exit(1)
+    except sqlite3.Error:
+        print('ERROR: Database entry failure!')
+        sys.exit(1)
+    rate = queued / elapsed if elapsed > 0 else 0
+    if rejected:
+        print(f'WARNING: Only {queued} messages queued for transmission, {rejected} rejected '
+              f'({rate:.0f} rows/sec).')
+        sys.exit(1)
+    print(f'SUCCESS: {queued} messages queued for transmission ({rate:.0f} rows/sec).')
+    sys.exit(0)
+
 #new sms loop
 if args.message == None:
     while True:
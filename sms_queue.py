@@ -0,0 +1,89 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - SMS Queue                                    #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module validates user provided messages and     #
+#                 inserts them into the sms table of piers.db for      #
+#                 transmission.  It is shared by the New SMS module    #
+#                 and the SMS submission service.                      #
+#                                                                      #
+########################################################################
+
+import packet
+import re
+
+#function: message validation
+def validate_message(message_to_be_validated):
+    #only contain A-Z a-z 0-9 . ? ! and between 1 and 50 chars in length
+    if re.fullmatch('^[a-zA-Z0-9!?. ]{1,50}$', message_to_be_validated):
+        return True
+    else:
+        return False
+
+#function: look up the location name for a location id, None if unknown
+def location_name(db, location_id):
+    c = db.cursor()
+    c.execute('SELECT location_name FROM locations WHERE location_id=?', (location_id,))
+    query_result = c.fetchone()
+    c.close()
+    if query_result:
+        return query_result[0]
+    return None
+
+#function: next free sequence number of a location, taking the write lock first
+#sms_service.py, sms_new.py and web_api.py may all queue at once, without the lock two
+#of them could read the same MAX(sequence) and send two messages under one number
+def next_sequence(db, c, location_id):
+    if not db.in_transaction:
+        c.execute('BEGIN IMMEDIATE')
+    c.execute('SELECT IFNULL(MAX(sequence), 0) + 1 FROM sms WHERE location_id=?',
+              (location_id,))
+    return c.fetchone()[0]
+
+#function: insert message into database (caller commits), returns its sequence number
+def insert(db, location_id, message, time_queued):
+    c = db.cursor()
+    #next sequence number for messages originating at this location
+    sequence = next_sequence(db, c, location_id)
+    #compose raw packet to be sent over the air
+    payload_raw = packet.encode_sms(location_id, sequence, message)
+    #compose hex encoded version of raw packet to be sent over the air
+    payload_hex = payload_raw.encode('UTF-8').hex()
+    c.execute('''
+        INSERT INTO sms (
+            location_id,
+            sequence,
+            message,
+            payload_raw,
+            payload_hex,
+            time_queued,
+            tx_count)
+        VALUES (?, ?, ?, ?, ?, ?, ?);''',
+        (location_id, sequence, message, payload_raw, payload_hex, time_queued, 0))
+    c.close()
+    return sequence
+
+#function: insert a list of messages with one executemany (caller commits), returns count
+def insert_many(db, location_id, messages, time_queued):
+    c = db.cursor()
+    sequence = next_sequence(db, c, location_id)
+    rows = []
+    for message in messages:
+        payload_raw = packet.encode_sms(location_id, sequence, message)
+        rows.append((location_id, sequence, message, payload_raw,
+                     payload_raw.encode('UTF-8').hex(), time_queued, 0))
+        sequence += 1
+    c.executemany('''
+        INSERT INTO sms (
+            location_id,
+            sequence,
+            message,
+            payload_raw,
+            payload_hex,
+            time_queued,
+            tx_count)
+        VALUES (?, ?, ?, ?, ?, ?, ?);''',
+        rows)
+    c.close()
+    return len(rows)
@@ -0,0 +1,120 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - SMS Submission Service                       #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This long running module keeps piers.conf, the       #
+#                 location name and a piers.db connection warm and     #
+#                 accepts messages over a local socket, one per line.  #
+#                 Each line is validated and queued exactly as New SMS #
+#                 would, without paying Python startup per message.    #
+#                                                                      #
+########################################################################
+
+########################################################################
+# Protocol Notes:  Connect to the unix socket piers.sock and write one #
+#                  message per line.  Each line is answered in order   #
+#                  with "OK <sequence>" or "ERROR <reason>".  Many     #
+#                  lines may be written before reading the replies.    #
+########################################################################
+
+import argparse
+import arq
+import logging
+import os
+import socketserver
+import sms_queue
+import sqlite3
+import sys
+import threading
+import timesync
+from pathlib import Path
+
+logging.basicConfig(filename='sms_service.log',
+                    format='%(asctime)s %(levelname)s: %(message)s',
+                    datefmt='%Y-%m-%d %I:%M:%S %p',
+                    level=logging.INFO)
+
+parser = argparse.ArgumentParser(description='PiERS Module - SMS Submission Service',
+                                 epilog='Created by K7CTC. This long running module keeps '
+                                        'piers.conf, the location name and a piers.db connection '
+                                        'warm and accepts messages over a local socket, one per '
+                                        'line.')
+parser.add_argument('--socket', default='piers.sock',
+                    help='unix socket path to listen on (default: piers.sock)')
+args = parser.parse_args()
+
+my_location_id = None
+my_location_name = None
+
+if Path('piers.db').is_file() == False:
+    print('ERROR: File not found - piers.db')
+    sys.exit(1)
+
+if Path('piers.conf').is_file() == False:
+    print('ERROR: File not found - piers.conf')
+    sys.exit(1)
+
+#attempt to read and validate the location id integer from piers.conf
+try:
+    file = open('piers.conf')
+    my_location_id = int(file.readline())
+    file.close()
+except:
+    print('ERROR: Failed to read location id from piers.conf!')
+    sys.exit(1)
+if my_location_id < 1 or my_location_id > 99:
+    print('ERROR: Location identifier out of range!')
+    sys.exit(1)
+
+#one connection shared by every client, writes are serialized by db_lock
+db = sqlite3.connect('piers.db', check_same_thread=False)
+db.execute('PRAGMA foreign_keys = ON')
+arq.ensure_schema(db)
+db_lock = threading.Lock()
+
+my_location_name = sms_queue.location_name(db, my_location_id)
+if my_location_name == None:
+    print('ERROR: Invalid location identifier!')
+    sys.exit(1)
+
+#function: validate and queue one message, returns the reply line
+def submit(message):
+    if not sms_queue.validate_message(message):
+        return 'ERROR invalid characters or length'
+    with db_lock:
+        try:
+            sequence = sms_queue.insert(db, my_location_id, message, timesync.network_time())
+            db.commit()
+        except sqlite3.Error as error:
+            #still holding the lock, no other client shares this transaction
+            db.rollback()
+            logging.error('Database entry failure! ' + str(error))
+            return 'ERROR database entry failure'
+    return 'OK ' + str(sequence)
+
+#class: one client connection, answers every line it sends
+class SubmissionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            message = line.decode('UTF-8', 'replace').rstrip('\r\n')
+            self.wfile.write((submit(message) + '\n').encode('UTF-8'))
+
+#a stale socket file from an earlier run would block bind()
+if Path(args.socket).exists():
+    os.remove(args.socket)
+
+server = socketserver.ThreadingUnixStreamServer(args.socket, SubmissionHandler)
+server.daemon_threads = True
+logging.info('sms_service.py listening on %s as %s', args.socket, my_location_name)
+print('PiERS SMS submission service listening on ' + args.socket + ' (CTRL+C to quit)')
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    print()
+server.server_close()
+if Path(args.socket).exists():
+    os.remove(args.socket)
+db.close()
+logging.info('sms_service.py stopped')
+sys.exit(0)
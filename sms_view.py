@@ -5,9 +5,13 @@
 #       VERSION:  v1.0                                                 #
 #   DESCRIPTION:  This module reads the sms table from piers.db once   #
 #                 per second and displays the output to the console.   #
+#                 The table is only read when another connection has  #
+#                 committed (PRAGMA data_version), and --interval can  #
+#                 stretch the poll on battery powered stations.        #
 #                                                                      #
 ########################################################################
 
+import argparse
 import datetime
 import sqlite3
 import sys
@@ -16,6 +20,13 @@ from pathlib import Path
 
 my_location_id = None
 
+parser = argparse.ArgumentParser(description='PiERS Module - View SMS',
+                                 epilog='Created by K7CTC. This module reads the sms table from '
+                                        'piers.db and displays the output to the console.')
+parser.add_argument('--interval', type=float, default=1,
+                    help='seconds between database checks (default: 1)')
+args = parser.parse_args()
+
 if Path('piers.db').is_file() == False:
     print('ERROR: File not found - piers.db')
     sys.exit(1)
@@ -37,11 +48,19 @@ if my_location_id < 1 or my_location_id > 99:
     sys.exit(1)
 
 rowid_marker = 0
+data_version = None
 
 db = sqlite3.connect('piers.db')
 c = db.cursor()
 while True:
     try:    
+        #data_version only changes when another connection commits, skip the query otherwise
+        c.execute('PRAGMA data_version')
+        new_data_version = c.fetchone()[0]
+        if new_data_version == data_version:
+            time.sleep(args.interval)
+            continue
+        data_version = new_data_version
         #get all rows with rowid greater than rowid_marker
         c.execute('''
             SELECT
@@ -100,9 +119,9 @@ while True:
         #already printed to the console
         c.execute('SELECT MAX(rowid) FROM sms')
         query_result = c.fetchone()
-        if query_result:
+        if query_result and query_result[0] != None:
             rowid_marker = query_result[0]
-        time.sleep(1)
+        time.sleep(args.interval)
     except KeyboardInterrupt:
         print()
         break
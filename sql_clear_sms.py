@@ -8,6 +8,7 @@
 #                                                                      #
 ########################################################################
 
+import arq
 import sqlite3
 import sys
 from pathlib import Path
@@ -20,12 +21,14 @@ if Path('piers.db').is_file():
         db.execute('''
             CREATE TABLE IF NOT EXISTS sms (
                 location_id     INTEGER NOT NULL,
+                sequence        INTEGER,
                 message	        TEXT NOT NULL,
                 payload_raw     TEXT NOT NULL,
                 payload_hex     TEXT NOT NULL,
                 time_queued	    INTEGER,
                 time_on_air	    INTEGER,
                 time_sent	    INTEGER,
+                time_acked      INTEGER,
                 tx_count        INTEGER,
                 time_received	INTEGER,
                 rssi            INTEGER,
@@ -33,6 +36,7 @@ if Path('piers.db').is_file():
                 duplicate	    INTEGER,
                 FOREIGN KEY (location_id) REFERENCES locations (location_id));''')
         db.commit()
+        arq.ensure_schema(db)
         db.close()
     except:
         print('FAIL!')
@@ -8,25 +8,15 @@
 #                                                                      #
 ########################################################################
 
+import arq
 import sys
 import sqlite3
 import csv
+import status_db
 from pathlib import Path
 
-if Path('piers.db').is_file():
-    print('ERROR: piers.db already exists')
-    sys.exit(1)
-
-if Path('participants.csv').is_file() == False:
-    print('ERROR: File not found - participants.csv')
-    sys.exit(1)
-
-if Path('locations.csv').is_file() == False:
-    print('ERROR: File not found - locations.csv')
-    sys.exit(1)
-
-try:
-    db = sqlite3.connect('piers.db')
+#function: create the piers.db tables and indexes if they do not exist yet
+def ensure_schema(db):
     db.execute('''
         CREATE TABLE IF NOT EXISTS participants (
             participant_id                  INTEGER NOT NULL UNIQUE,
@@ -47,59 +37,90 @@ try:
     db.execute('''
         CREATE TABLE IF NOT EXISTS sms (
             location_id                     INTEGER NOT NULL,
+            sequence                        INTEGER,
             message	                        TEXT NOT NULL,
             payload_raw                     TEXT NOT NULL,
             payload_hex                     TEXT NOT NULL,
             time_queued	                    INTEGER,
             time_on_air	                    INTEGER,
             time_sent	                    INTEGER,
+            time_acked                      INTEGER,
             tx_count                        INTEGER,
             time_received	                INTEGER,
             rssi                            INTEGER,
             snr                             INTEGER,
             duplicate	                    INTEGER,
             FOREIGN KEY (location_id) REFERENCES locations (location_id));''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS payloads (
+            location_id                     INTEGER NOT NULL,
+            payload_id                      INTEGER NOT NULL,
+            payload                         BLOB NOT NULL,
+            time_queued                     INTEGER,
+            time_sent                       INTEGER,
+            time_received                   INTEGER,
+            UNIQUE (location_id, payload_id),
+            FOREIGN KEY (location_id) REFERENCES locations (location_id));''')
     db.commit()
-    with open('participants.csv') as csvfile:
-        participants = csv.DictReader(csvfile)
-        to_db = [(i['participant_id'],
-                  i['participant_first_name'],
-                  i['participant_last_name'],
-                  i['participant_gender'],
-                  i['participant_age'],
-                  i['participant_city'],
-                  i['participant_state'],
-                  i['participant_emergency_name'],
-                  i['participant_emergency_phone'])
-                  for i in participants]
-    db.executemany('''
-        INSERT INTO participants (
-            participant_id,
-            participant_first_name,
-            participant_last_name,
-            participant_gender,
-            participant_age,
-            participant_city,
-            participant_state,
-            participant_emergency_name,
-            participant_emergency_phone)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);''', to_db)
-    db.commit()
-    with open('locations.csv') as csvfile:
-        locations = csv.DictReader(csvfile)
-        to_db = [(i['location_id'],
-                  i['location_name'])
-                 for i in locations]
-    db.executemany('''
-        INSERT INTO locations (
-            location_id,
-            location_name)
-        VALUES (?, ?);''', to_db)
-    db.commit()
-    db.close()
-except:
-    print('FAIL!')
-    sys.exit(1)
-else:
-    print('PASS!')
-    sys.exit(0)
\ No newline at end of file
+    arq.ensure_schema(db)
+    status_db.ensure_schema(db)
+
+if __name__ == '__main__':
+    if Path('piers.db').is_file():
+        print('ERROR: piers.db already exists')
+        sys.exit(1)
+
+    if Path('participants.csv').is_file() == False:
+        print('ERROR: File not found - participants.csv')
+        sys.exit(1)
+
+    if Path('locations.csv').is_file() == False:
+        print('ERROR: File not found - locations.csv')
+        sys.exit(1)
+
+    try:
+        db = sqlite3.connect('piers.db')
+        ensure_schema(db)
+        with open('participants.csv') as csvfile:
+            participants = csv.DictReader(csvfile)
+            to_db = [(i['participant_id'],
+                      i['participant_first_name'],
+                      i['participant_last_name'],
+                      i['participant_gender'],
+                      i['participant_age'],
+                      i['participant_city'],
+                      i['participant_state'],
+                      i['participant_emergency_name'],
+                      i['participant_emergency_phone'])
+                      for i in participants]
+        db.executemany('''
+            INSERT INTO participants (
+                participant_id,
+                participant_first_name,
+                participant_last_name,
+                participant_gender,
+                participant_age,
+                participant_city,
+                participant_state,
+                participant_emergency_name,
+                participant_emergency_phone)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);''', to_db)
+        db.commit()
+        with open('locations.csv') as csvfile:
+            locations = csv.DictReader(csvfile)
+            to_db = [(i['location_id'],
+                      i['location_name'])
+                     for i in locations]
+        db.executemany('''
+            INSERT INTO locations (
+                location_id,
+                location_name)
+            VALUES (?, ?);''', to_db)
+        db.commit()
+        db.close()
+    except:
+        print('FAIL!')
+        sys.exit(1)
+    else:
+        print('PASS!')
+        sys.exit(0)
\ No newline at end of file
@@ -0,0 +1,333 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Merge Station Databases                      #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This script merges the piers.db collected from every #
+#                 station after an event into one master database.     #
+#                 Each message is stored once, every station that      #
+#                 heard it keeps its own time_received, rssi and snr,  #
+#                 and a reception matrix (who heard whom) is printed.  #
+#                                                                      #
+########################################################################
+
+########################################################################
+# Merge Notes:  Station files are ATTACHed one at a time and copied    #
+#               with INSERT ... SELECT, so rows never pass through     #
+#               Python.  A message is identified by its origin         #
+#               location_id and sequence (payload_hex for rows from    #
+#               before sequence numbers existed, and for station files #
+#               whose sms table has no sequence column yet).  The      #
+#               origin's own row supplies time_queued, time_sent,      #
+#               time_acked and tx_count.  Every other station adds one #
+#               row to receptions holding its first copy (earliest     #
+#               time_received, with that copy's rssi and snr) and how  #
+#               many copies it heard.                                  #
+#                                                                      #
+#               A station is recognised by the rows it originated      #
+#               (time_received IS NULL).  A station that sent nothing  #
+#               must be named with --station FILE=ID.  Merging a       #
+#               station again replaces its receptions, so the master   #
+#               can be rebuilt one file at a time.                     #
+########################################################################
+
+import argparse
+import csv
+import sqlite3
+import status_db
+import sys
+import time
+from pathlib import Path
+
+parser = argparse.ArgumentParser(description='PiERS Module - Merge Station Databases',
+                                 epilog='Created by K7CTC. This script merges the piers.db files '
+                                        'collected from every station into one master database '
+                                        'and prints a reception matrix.')
+parser.add_argument('databases', nargs='+', metavar='DB',
+                    help='station databases to merge')
+parser.add_argument('-o', '--output', default='piers_master.db',
+                    help='master database, created or added to (default: piers_master.db)')
+parser.add_argument('--station', action='append', default=[], metavar='FILE=ID',
+                    help='location id of the station a file came from, for files whose station '
+                         'cannot be inferred (repeatable)')
+parser.add_argument('--matrix', default=None, metavar='CSV',
+                    help='also write the reception matrix to a CSV file')
+args = parser.parse_args()
+
+#station overrides from the command line
+station_overrides = {}
+for override in args.station:
+    file_name, _, location_id = override.rpartition('=')
+    try:
+        station_overrides[str(Path(file_name).resolve())] = int(location_id)
+    except ValueError:
+        print('ERROR: --station expects FILE=ID, got ' + override)
+        sys.exit(1)
+
+for database in args.databases:
+    if Path(database).is_file() == False:
+        print('ERROR: File not found - ' + database)
+        sys.exit(1)
+    if Path(database).resolve() == Path(args.output).resolve():
+        print('ERROR: The master database cannot also be a station database')
+        sys.exit(1)
+
+master = sqlite3.connect(args.output)
+#the master can always be rebuilt from the station files, trade durability for speed
+master.execute('PRAGMA journal_mode=MEMORY')
+master.execute('PRAGMA synchronous=OFF')
+master.executescript('''
+    CREATE TABLE IF NOT EXISTS participants (
+        participant_id                  INTEGER NOT NULL UNIQUE,
+        participant_first_name          TEXT,
+        participant_last_name           TEXT,
+        participant_gender              TEXT,
+        participant_age                 INTEGER,
+        participant_city                TEXT,
+        participant_state               TEXT,
+        participant_emergency_name      TEXT,
+        participant_emergency_phone     TEXT,
+        PRIMARY KEY (participant_id));
+    CREATE TABLE IF NOT EXISTS locations (
+        location_id                     INTEGER NOT NULL UNIQUE,
+        location_name                   TEXT NOT NULL,
+        PRIMARY KEY(location_id));
+    CREATE TABLE IF NOT EXISTS stations (
+        station_id                      INTEGER NOT NULL,
+        file_name                       TEXT NOT NULL,
+        originated                      INTEGER,
+        received                        INTEGER,
+        time_merged                     INTEGER,
+        PRIMARY KEY (station_id));
+    CREATE TABLE IF NOT EXISTS messages (
+        message_id                      INTEGER PRIMARY KEY,
+        location_id                     INTEGER NOT NULL,
+        sequence                        INTEGER,
+        identity                        NOT NULL,
+        message                         TEXT NOT NULL,
+        payload_raw                     TEXT NOT NULL,
+        payload_hex                     TEXT NOT NULL,
+        time_queued                     INTEGER,
+        time_on_air                     INTEGER,
+        time_sent                       INTEGER,
+        time_acked                      INTEGER,
+        tx_count                        INTEGER,
+        UNIQUE (location_id, identity));
+    CREATE TABLE IF NOT EXISTS receptions (
+        message_id                      INTEGER NOT NULL,
+        station_id                      INTEGER NOT NULL,
+        time_received                   INTEGER,
+        rssi                            INTEGER,
+        snr                             INTEGER,
+        copies                          INTEGER,
+        PRIMARY KEY (message_id, station_id)) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS receptions_station
+        ON receptions (station_id);
+    CREATE VIEW IF NOT EXISTS reception_matrix AS
+        SELECT
+            messages.location_id AS origin,
+            receptions.station_id AS station,
+            COUNT(*) AS heard
+        FROM
+            receptions
+        JOIN
+            messages USING (message_id)
+        GROUP BY
+            origin, station;''')
+status_db.ensure_schema(master)
+#status events from several stations may repeat, keep each once
+master.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS status_event
+        ON status (participant_id, location_id, status, time_logged);''')
+master.commit()
+
+#function: True if the attached station database has a table
+def station_has_table(table):
+    return master.execute("SELECT 1 FROM station.sqlite_master WHERE type='table' AND name=?",
+                          (table,)).fetchone() != None
+
+#function: column names of a table in the attached station database
+def station_columns(table):
+    return [row[1] for row in master.execute('PRAGMA station.table_info(' + table + ')')]
+
+#function: location id of the attached station, None if it cannot be inferred
+def station_id(database):
+    if str(Path(database).resolve()) in station_overrides:
+        return station_overrides[str(Path(database).resolve())]
+    origins = master.execute('''
+        SELECT location_id, COUNT(*)
+        FROM station.sms
+        WHERE time_received IS NULL
+        GROUP BY location_id
+        ORDER BY 2 DESC;''').fetchall()
+    if not origins:
+        return None
+    if len(origins) > 1:
+        print('WARNING: ' + database + ' originated rows for several locations, using ' +
+              str(origins[0][0]))
+    return origins[0][0]
+
+#function: copy one attached station into the master
+def merge_station(database, location_id):
+    #station files from before acks have no sequence or time_acked column
+    columns = station_columns('sms')
+    sequence = 'sequence' if 'sequence' in columns else 'NULL'
+    heard_sequence = 'heard.sequence' if 'sequence' in columns else 'NULL'
+    time_acked = 'time_acked' if 'time_acked' in columns else 'NULL'
+    master.execute('INSERT OR IGNORE INTO locations SELECT location_id, location_name FROM station.locations')
+    master.execute('''
+        INSERT OR IGNORE INTO participants
+        SELECT
+            participant_id,
+            participant_first_name,
+            participant_last_name,
+            participant_gender,
+            participant_age,
+            participant_city,
+            participant_state,
+            participant_emergency_name,
+            participant_emergency_phone
+        FROM station.participants;''')
+    #the originating station knows the transmit history
+    originated = master.execute(f'''
+        INSERT INTO messages (
+            location_id,
+            sequence,
+            identity,
+            message,
+            payload_raw,
+            payload_hex,
+            time_queued,
+            time_on_air,
+            time_sent,
+            time_acked,
+            tx_count)
+        SELECT
+            location_id,
+            {sequence},
+            COALESCE({sequence}, payload_hex),
+            message,
+            payload_raw,
+            payload_hex,
+            time_queued,
+            time_on_air,
+            time_sent,
+            {time_acked},
+            tx_count
+        FROM station.sms
+        WHERE time_received IS NULL AND location_id=?
+        ON CONFLICT (location_id, identity) DO UPDATE SET
+            time_queued=excluded.time_queued,
+            time_on_air=excluded.time_on_air,
+            time_sent=excluded.time_sent,
+            time_acked=excluded.time_acked,
+            tx_count=excluded.tx_count;''',
+        (location_id,)).rowcount
+    #everything heard over the air
+    master.execute(f'''
+        INSERT INTO messages (
+            location_id,
+            sequence,
+            identity,
+            message,
+            payload_raw,
+            payload_hex)
+        SELECT
+            location_id,
+            {sequence},
+            COALESCE({sequence}, payload_hex),
+            message,
+            payload_raw,
+            payload_hex
+        FROM station.sms
+        WHERE time_received IS NOT NULL
+        ON CONFLICT (location_id, identity) DO NOTHING;''')
+    master.execute('DELETE FROM receptions WHERE station_id=?', (location_id,))
+    #MIN() makes sqlite take rssi and snr from the earliest copy, CROSS JOIN keeps the
+    #station rows outermost so each one is a single lookup in the messages unique index
+    received = master.execute(f'''
+        INSERT INTO receptions (
+            message_id,
+            station_id,
+            time_received,
+            rssi,
+            snr,
+            copies)
+        SELECT
+            messages.message_id,
+            ?,
+            MIN(heard.time_received),
+            heard.rssi,
+            heard.snr,
+            COUNT(*)
+        FROM
+            station.sms AS heard
+        CROSS JOIN
+            messages ON messages.location_id=heard.location_id
+                AND messages.identity=COALESCE({heard_sequence}, heard.payload_hex)
+        WHERE
+            heard.time_received IS NOT NULL
+        GROUP BY
+            messages.message_id;''',
+        (location_id,)).rowcount
+    if station_has_table('status'):
+        master.execute('''
+            INSERT OR IGNORE INTO status (participant_id, location_id, status, time_logged, time_received)
+            SELECT participant_id, location_id, status, time_logged, time_received
+            FROM station.status;''')
+    master.execute('''
+        INSERT OR REPLACE INTO stations (station_id, file_name, originated, received, time_merged)
+        VALUES (?, ?, ?, ?, ?);''',
+        (location_id, str(Path(database).resolve()), originated, received,
+         int(round(time.time()*1000))))
+    return originated, received
+
+start_time = time.perf_counter()
+skipped = 0
+for database in args.databases:
+    file_start = time.perf_counter()
+    master.execute('ATTACH DATABASE ? AS station', (database,))
+    try:
+        location_id = station_id(database)
+        if location_id == None:
+            print('WARNING: Skipped ' + database + ', it originated nothing, name its station '
+                  'with --station ' + database + '=ID')
+            skipped += 1
+            continue
+        with master:
+            originated, received = merge_station(database, location_id)
+        print(f'{database}: station {location_id}, {originated} originated, '
+              f'{received} received ({time.perf_counter() - file_start:.2f} s)')
+    except sqlite3.Error as error:
+        print('ERROR: Failed to merge ' + database + ' - ' + str(error))
+        skipped += 1
+    finally:
+        master.execute('DETACH DATABASE station')
+elapsed = time.perf_counter() - start_time
+
+#the reception matrix, origins down, listening stations across
+stations = [row[0] for row in master.execute('SELECT station_id FROM stations ORDER BY station_id')]
+sent = dict(master.execute('SELECT location_id, COUNT(*) FROM messages GROUP BY location_id'))
+heard = {(origin, station): count for origin, station, count in
+         master.execute('SELECT origin, station, heard FROM reception_matrix')}
+print()
+print('Reception matrix (messages from each origin heard by each station)')
+print(f'{"origin":>6}{"sent":>8}' + ''.join(f'{station:>7}' for station in stations))
+for origin in sorted(sent):
+    cells = ''.join(f'{"-" if station == origin else heard.get((origin, station), 0):>7}'
+                    for station in stations)
+    print(f'{origin:>6}{sent[origin]:>8}' + cells)
+if args.matrix:
+    with open(args.matrix, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['origin', 'sent'] + stations)
+        for origin in sorted(sent):
+            writer.writerow([origin, sent[origin]] +
+                            [heard.get((origin, station), 0) for station in stations])
+
+total = master.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+master.close()
+print()
+print(f'{len(args.databases) - skipped} of {len(args.databases)} databases merged into '
+      f'{args.output}, {total} messages, {elapsed:.2f} s')
+sys.exit(1 if skipped else 0)
@@ -0,0 +1,163 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Participant Status Database                  #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module owns the participant status tables of    #
+#                 piers.db.  Every status event is appended to the     #
+#                 status table and a trigger keeps latest_status (one  #
+#                 row per participant) current, so "where was bib 123  #
+#                 last seen?" never rescans history.  Participant      #
+#                 names are indexed with FTS5 for fast name lookup.    #
+#                                                                      #
+########################################################################
+
+import re
+
+#function: create status tables, triggers and indexes if they do not exist yet
+def ensure_schema(db):
+    db.executescript('''
+        CREATE TABLE IF NOT EXISTS status (
+            participant_id                  INTEGER NOT NULL,
+            location_id                     INTEGER NOT NULL,
+            status                          TEXT NOT NULL,
+            time_logged                     INTEGER NOT NULL,
+            time_received                   INTEGER,
+            FOREIGN KEY (participant_id) REFERENCES participants (participant_id),
+            FOREIGN KEY (location_id) REFERENCES locations (location_id));
+        CREATE INDEX IF NOT EXISTS status_participant
+            ON status (participant_id, time_logged);
+        CREATE TABLE IF NOT EXISTS latest_status (
+            participant_id                  INTEGER NOT NULL,
+            location_id                     INTEGER NOT NULL,
+            status                          TEXT NOT NULL,
+            time_logged                     INTEGER NOT NULL,
+            PRIMARY KEY (participant_id)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS latest_status_location
+            ON latest_status (location_id, time_logged);
+        CREATE TRIGGER IF NOT EXISTS status_latest AFTER INSERT ON status
+        BEGIN
+            INSERT INTO latest_status (participant_id, location_id, status, time_logged)
+            VALUES (NEW.participant_id, NEW.location_id, NEW.status, NEW.time_logged)
+            ON CONFLICT (participant_id) DO UPDATE SET
+                location_id=excluded.location_id,
+                status=excluded.status,
+                time_logged=excluded.time_logged
+            WHERE excluded.time_logged>=latest_status.time_logged;
+        END;''')
+    #name index, external content so names are stored once
+    exists = db.execute('''
+        SELECT 1 FROM sqlite_master WHERE type='table' AND name='participants_fts';''').fetchone()
+    if not exists:
+        db.executescript('''
+            CREATE VIRTUAL TABLE participants_fts USING fts5 (
+                participant_first_name,
+                participant_last_name,
+                content='participants',
+                content_rowid='participant_id');
+            CREATE TRIGGER participants_fts_insert AFTER INSERT ON participants
+            BEGIN
+                INSERT INTO participants_fts (rowid, participant_first_name, participant_last_name)
+                VALUES (NEW.participant_id, NEW.participant_first_name, NEW.participant_last_name);
+            END;
+            CREATE TRIGGER participants_fts_delete AFTER DELETE ON participants
+            BEGIN
+                INSERT INTO participants_fts (participants_fts, rowid, participant_first_name, participant_last_name)
+                VALUES ('delete', OLD.participant_id, OLD.participant_first_name, OLD.participant_last_name);
+            END;
+            CREATE TRIGGER participants_fts_update AFTER UPDATE ON participants
+            BEGIN
+                INSERT INTO participants_fts (participants_fts, rowid, participant_first_name, participant_last_name)
+                VALUES ('delete', OLD.participant_id, OLD.participant_first_name, OLD.participant_last_name);
+                INSERT INTO participants_fts (rowid, participant_first_name, participant_last_name)
+                VALUES (NEW.participant_id, NEW.participant_first_name, NEW.participant_last_name);
+            END;
+            INSERT INTO participants_fts (participants_fts) VALUES ('rebuild');''')
+    db.commit()
+
+#function: append a status event (caller commits), latest_status follows via trigger
+def log_status(db, participant_id, location_id, status, time_logged, time_received=None):
+    db.execute('''
+        INSERT INTO status (
+            participant_id,
+            location_id,
+            status,
+            time_logged,
+            time_received)
+        VALUES (?, ?, ?, ?, ?);''',
+        (participant_id, location_id, status, time_logged, time_received))
+
+#function: latest status of one bib number, returns row tuple or None
+def last_seen(db, participant_id):
+    return db.execute('''
+        SELECT
+            participant_id,
+            participant_first_name,
+            participant_last_name,
+            location_id,
+            location_name,
+            status,
+            time_logged
+        FROM
+            participants
+        LEFT JOIN
+            latest_status USING (participant_id)
+        LEFT JOIN
+            locations USING (location_id)
+        WHERE
+            participant_id=?;''',
+        (participant_id,)).fetchone()
+
+#function: participants whose names start with every word given, with latest status
+def search_name(db, text, limit=20):
+    words = re.findall('[A-Za-z0-9]+', text)
+    if not words:
+        return []
+    match = ' '.join('"' + word + '"*' for word in words)
+    return db.execute('''
+        SELECT
+            participant_id,
+            participants.participant_first_name,
+            participants.participant_last_name,
+            location_id,
+            location_name,
+            status,
+            time_logged
+        FROM
+            participants_fts
+        JOIN
+            participants ON participants.participant_id=participants_fts.rowid
+        LEFT JOIN
+            latest_status USING (participant_id)
+        LEFT JOIN
+            locations USING (location_id)
+        WHERE
+            participants_fts MATCH ?
+        ORDER BY
+            rank
+        LIMIT ?;''',
+        (match, limit)).fetchall()
+
+#function: participants whose latest status was logged at a location
+def at_location(db, location_id, limit=100):
+    return db.execute('''
+        SELECT
+            participant_id,
+            participant_first_name,
+            participant_last_name,
+            location_id,
+            location_name,
+            status,
+            time_logged
+        FROM
+            latest_status
+        JOIN
+            participants USING (participant_id)
+        JOIN
+            locations USING (location_id)
+        WHERE
+            location_id=?
+        ORDER BY
+            time_logged DESC
+        LIMIT ?;''',
+        (location_id, limit)).fetchall()
@@ -0,0 +1,102 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Participant Status Query                     #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module answers the questions event staff ask of #
+#                 piers.db ("where was bib 123 last seen?", "who has   #
+#                 come through here?", "which bib is Kyle?") from the  #
+#                 latest_status table and participant name index, and  #
+#                 logs new status events for this location.            #
+#                                                                      #
+########################################################################
+
+import argparse
+import datetime
+import re
+import sqlite3
+import status_db
+import sys
+import time
+import timesync
+from pathlib import Path
+
+my_location_id = None
+
+parser = argparse.ArgumentParser(description='PiERS Module - Participant Status Query',
+                                 epilog='Created by K7CTC. This module answers participant status '
+                                        'questions from the latest_status table and participant '
+                                        'name index of piers.db, and logs new status events for '
+                                        'this location.')
+group = parser.add_mutually_exclusive_group(required=True)
+group.add_argument('-b', '--bib', type=int,
+                   help='show where a bib number was last seen')
+group.add_argument('-n', '--name',
+                   help='find participants by (partial) first and/or last name')
+group.add_argument('-l', '--location', type=int,
+                   help='list participants last seen at a location id')
+group.add_argument('--log', nargs=2, metavar=('BIB', 'STATUS'),
+                   help='log a status event (e.g. active, dns, dnf, finished) for this location')
+parser.add_argument('--timing', action='store_true',
+                    help='report query time')
+args = parser.parse_args()
+
+if Path('piers.db').is_file() == False:
+    print('ERROR: File not found - piers.db')
+    sys.exit(1)
+
+db = sqlite3.connect('piers.db')
+db.execute('PRAGMA foreign_keys = ON')
+#creates the status tables and name index on databases that predate them
+status_db.ensure_schema(db)
+
+#function: print result rows in a fixed layout
+def print_rows(rows):
+    if not rows:
+        print('No matching participants.')
+    for row in rows:
+        name = ' '.join(part for part in (row[1], row[2]) if part)
+        if row[5] == None:
+            print(f'{row[0]:>5}  {name:<30}  (no status logged)')
+        else:
+            friendly_ts = datetime.datetime.fromtimestamp(row[6] / 1000).strftime('%I:%M:%S %p')
+            print(f'{row[0]:>5}  {name:<30}  {row[5]:<10}  {row[4]} at {friendly_ts}')
+
+start_time = time.perf_counter()
+if args.bib != None:
+    row = status_db.last_seen(db, args.bib)
+    rows = [row] if row else []
+elif args.name != None:
+    rows = status_db.search_name(db, args.name)
+elif args.location != None:
+    rows = status_db.at_location(db, args.location)
+else:
+    if Path('piers.conf').is_file() == False:
+        print('ERROR: File not found - piers.conf')
+        sys.exit(1)
+    try:
+        file = open('piers.conf')
+        my_location_id = int(file.readline())
+        file.close()
+        participant_id = int(args.log[0])
+    except:
+        print('ERROR: Failed to read location id from piers.conf or invalid bib number!')
+        sys.exit(1)
+    if not re.fullmatch('[a-zA-Z ]{1,20}', args.log[1]):
+        print('ERROR: Status may only contain letters and spaces (20 characters max)!')
+        sys.exit(1)
+    try:
+        with db:
+            status_db.log_status(db, participant_id, my_location_id, args.log[1].lower(),
+                                 timesync.network_time())
+    except sqlite3.Error:
+        print('ERROR: Database entry failure! (unknown bib number?)')
+        sys.exit(1)
+    rows = [status_db.last_seen(db, participant_id)]
+elapsed = time.perf_counter() - start_time
+
+print_rows(rows)
+if args.timing:
+    print(f'({elapsed * 1000:.2f} ms)')
+db.close()
+sys.exit(0)
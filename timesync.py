@@ -0,0 +1,225 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Time Synchronization                         #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module keeps a shared network clock across      #
+#                 PiERS nodes that have no internet access.  Nodes     #
+#                 exchange small time beacons over the air, estimate   #
+#                 the offset and drift of their own clock against the  #
+#                 best source they hear and report how good that       #
+#                 estimate is, so TDMA guard intervals can shrink and  #
+#                 timestamps from different stations can be compared. #
+#                                                                      #
+########################################################################
+
+########################################################################
+# Sync Notes:  One node (normally the one with a working DS3231 RTC,   #
+#              see clock_setup.sh) runs lostik.py --time-master and    #
+#              is stratum 0.  A node synced to a stratum n source is   #
+#              stratum n+1 and beacons in turn, so the network clock   #
+#              reaches stations that cannot hear the master.  A beacon #
+#              carries the sender's network time for the moment its    #
+#              radio starts to transmit (the radio tx command still    #
+#              has to cross the UART).  The receiver adds the air time #
+#              and compares the result with its own clock when the     #
+#              radio_rx line arrived, less that line's serial time.    #
+#                                                                      #
+#              The last few offsets are fitted with a straight line,   #
+#              whose slope is the drift of our crystal (a few tens of  #
+#              ppm, i.e. a few ms per minute) and whose residual is    #
+#              the sync error.  Nothing touches the system clock:      #
+#              lostik.py stores network time in piers.db and exports   #
+#              the fit so other modules can use network_time().        #
+#                                                                      #
+#              The air time must use the radio's real settings.  A     #
+#              wrong delay_ms shifts every offset by the same amount,  #
+#              so the drift fit stays right and error_ms cannot see    #
+#              it, but network time is off by the whole difference.    #
+########################################################################
+
+import metrics
+import random
+import time
+
+#beacon period in milliseconds (jittered, skipped when a node of the same stratum beacons)
+beacon_interval = 300000
+#forget a source that has not beaconed for this many intervals
+source_timeout = 3
+#deepest stratum that still beacons
+max_stratum = 4
+#offset samples used for the drift fit
+samples_kept = 8
+#an offset this far from the fit means a clock step, start the fit again
+step_threshold = 1000
+#serial and radio scheduling jitter no estimate can remove (milliseconds)
+guard_floor = 50
+#a fit with fewer samples has no residual yet, assume this error
+unfitted_error = 25
+#exported state older than this is ignored by network_time()
+state_timeout = 3600000
+
+#function: local wall clock in milliseconds
+def local_time():
+    return time.time() * 1000
+
+#function: milliseconds to move length bytes over a serial link (8N1)
+def serial_ms(length, baud=57600):
+    return length * 10 / baud * 1000
+
+#class: offset and drift estimate of our clock against the network clock
+class TimeSync:
+    def __init__(self, location_id, master=False, rng=None):
+        self.location_id = location_id
+        self.master = master
+        self.rng = rng or random.Random()
+        #current source location id and stratum
+        self.source = None
+        self.source_stratum = None
+        self.source_heard = None
+        #(local time, offset) pairs from the current source
+        self.samples = []
+        #fit: offset = intercept + drift * (local - reference)
+        self.reference = 0
+        self.intercept = 0
+        self.drift = 0
+        self.residual = None
+        self.steps = 0
+        self.next_beacon = None
+        self.suppressed = 0
+
+    #function: True if our clock is the network clock or follows a live source
+    def synced(self, local):
+        if self.master:
+            return True
+        return self.source != None and local - self.source_heard < source_timeout * beacon_interval
+
+    #function: our stratum, None when unsynced
+    def stratum(self, local):
+        if self.master:
+            return 0
+        if self.synced(local):
+            return self.source_stratum + 1
+        return None
+
+    #function: network time in milliseconds at a local time
+    def now(self, local=None):
+        if local == None:
+            local = local_time()
+        if self.master or not self.samples:
+            return int(round(local))
+        return int(round(local + self.intercept + self.drift * (local - self.reference)))
+
+    #function: estimated error of now() in milliseconds, None when unsynced
+    def error_ms(self, local):
+        if self.master:
+            return 0
+        if not self.synced(local):
+            return None
+        residual = unfitted_error if self.residual == None else self.residual
+        #the drift fit degrades as the last sample ages, count a 10 ppm slope error per ms of age
+        age = local - self.samples[-1][0]
+        return residual + age * 10e-6
+
+    #function: tdma guard interval for our current sync quality, never above default_ms
+    def guard_ms(self, local, default_ms):
+        error = self.error_ms(local)
+        if error == None:
+            return default_ms
+        #both ends of a slot boundary may be off by our error and the neighbour's
+        return int(min(default_ms, guard_floor + 2 * 2 * error))
+
+    #function: True if this node should send a beacon now
+    def beacon_due(self, local):
+        stratum = self.stratum(local)
+        if stratum == None or stratum > max_stratum:
+            return False
+        if self.next_beacon == None:
+            self._schedule(local)
+        return local >= self.next_beacon
+
+    #function: compose the beacon at the moment of transmission, then schedule the next one
+    def beacon(self, encoder, local=None):
+        if local == None:
+            local = local_time()
+        self._schedule(local)
+        return encoder(self.location_id, self.stratum(local), self.now(local))
+
+    def _schedule(self, local):
+        self.next_beacon = local + beacon_interval * (0.75 + self.rng.random() / 2)
+
+    #function: feed a received beacon, delay_ms is the time from stamp to arrival (air time)
+    def heard_beacon(self, origin, stratum, time_ms, local_rx, delay_ms):
+        own_stratum = self.stratum(local_rx)
+        #a beacon of our own stratum serves much the same neighbours, skip our next one
+        if own_stratum != None and stratum == own_stratum:
+            self._schedule(local_rx)
+            self.suppressed += 1
+        if self.master:
+            return False
+        if origin != self.source:
+            if self.synced(local_rx) and stratum >= self.source_stratum:
+                return False
+            self.source = origin
+            self.samples = []
+        self.source_stratum = stratum
+        self.source_heard = local_rx
+        offset = time_ms + delay_ms - local_rx
+        if self.samples and abs(offset - (self.now(local_rx) - local_rx)) > step_threshold:
+            self.samples = []
+            self.steps += 1
+        self.samples.append((local_rx, offset))
+        del self.samples[:-samples_kept]
+        self._fit()
+        return True
+
+    #function: least squares line through the offset samples
+    def _fit(self):
+        count = len(self.samples)
+        self.reference = sum(t for t, _ in self.samples) / count
+        mean_offset = sum(o for _, o in self.samples) / count
+        spread = sum((t - self.reference) ** 2 for t, _ in self.samples)
+        if count < 2 or spread == 0:
+            self.drift = 0
+        else:
+            self.drift = sum((t - self.reference) * (o - mean_offset)
+                             for t, o in self.samples) / spread
+        self.intercept = mean_offset
+        if count < 3:
+            self.residual = None
+        else:
+            squares = sum((o - self.intercept - self.drift * (t - self.reference)) ** 2
+                          for t, o in self.samples)
+            self.residual = (squares / (count - 2)) ** 0.5
+
+    #function: sync state for metrics.export(), also read back by network_time()
+    def metrics(self, local=None):
+        if local == None:
+            local = local_time()
+        error = self.error_ms(local)
+        return {'synced': self.synced(local),
+                'master': self.master,
+                'stratum': self.stratum(local),
+                'source': self.source,
+                'source_age_ms': None if self.source_heard == None else int(local - self.source_heard),
+                'offset_ms': round(self.now(local) - local, 1),
+                'drift_ppm': round(self.drift * 1e6, 2),
+                'error_ms': None if error == None else round(error, 1),
+                'samples': len(self.samples),
+                'steps': self.steps,
+                'beacons_suppressed': self.suppressed,
+                'local_time': int(local)}
+
+#exported state cache for network_time(), the file changes every few seconds at most
+state_cache = {'path': None, 'read': 0, 'state': None}
+
+#function: network time for modules outside lostik.py, from the state it exports
+def network_time(path='lostik_metrics.json'):
+    local = local_time()
+    if state_cache['path'] != path or local - state_cache['read'] > 1000:
+        state_cache.update(path=path, read=local, state=metrics.read(path).get('timesync'))
+    state = state_cache['state']
+    if not state or not state.get('synced') or local - state['local_time'] > state_timeout:
+        return int(round(local))
+    offset = state['offset_ms'] + state['drift_ppm'] * 1e-6 * (local - state['local_time'])
+    return int(round(local + offset))
@@ -0,0 +1,369 @@
+########################################################################
+#                                                                      #
+#          NAME:  PiERS - Web API                                      #
+#  DEVELOPED BY:  Chris Clement (K7CTC)                                #
+#       VERSION:  v1.0                                                 #
+#   DESCRIPTION:  This module serves piers.db to browsers on the node  #
+#                 hotspot.  It accepts new messages, pages through     #
+#                 message history and pushes live traffic to every     #
+#                 connected browser as Server-Sent Events.  A single   #
+#                 watcher polls the database for all clients, so ten   #
+#                 phones cost the same database load as one.           #
+#                                                                      #
+########################################################################
+
+########################################################################
+# API Notes:  GET  /sms?before=<id>&limit=<n>   history, newest first  #
+#             POST /sms   (form or JSON field "message")  queue a msg  #
+#             GET  /events                      live sms (SSE stream)  #
+#             GET  /locations                   location names         #
+#             GET  /participants/<bib>          name and last status   #
+#                                                                      #
+#             All database work runs on one worker thread that owns    #
+#             the only connection.  The watcher checks PRAGMA          #
+#             data_version (plus our own total_changes), which costs   #
+#             no disk read when nothing has changed, and only then     #
+#             fetches the new rows.  With no browser subscribed it     #
+#             stops polling altogether.                                #
+########################################################################
+
+import argparse
+import arq
+import asyncio
+import concurrent.futures
+import json
+import logging
+import sms_queue
+import sqlite3
+import status_db
+import sys
+import timesync
+import urllib.parse
+from pathlib import Path
+
+logging.basicConfig(filename='web_api.log',
+                    format='%(asctime)s %(levelname)s: %(message)s',
+                    datefmt='%Y-%m-%d %I:%M:%S %p',
+                    level=logging.INFO)
+
+parser = argparse.ArgumentParser(description='PiERS Module - Web API',
+                                 epilog='Created by K7CTC. This module serves piers.db to browsers '
+                                        'on the node hotspot: message submission, paginated '
+                                        'history and live Server-Sent Events.')
+parser.add_argument('--host', default='0.0.0.0',
+                    help='address to listen on (default: 0.0.0.0)')
+parser.add_argument('--port', type=int, default=8080,
+                    help='port to listen on (default: 8080)')
+parser.add_argument('--poll', type=float, default=0.5,
+                    help='database watcher interval in seconds (default: 0.5)')
+args = parser.parse_args()
+
+my_location_id = None
+
+if Path('piers.db').is_file() == False:
+    print('ERROR: File not found - piers.db')
+    sys.exit(1)
+
+if Path('piers.conf').is_file() == False:
+    print('ERROR: File not found - piers.conf')
+    sys.exit(1)
+
+#attempt to read and validate the location id integer from piers.conf
+try:
+    file = open('piers.conf')
+    my_location_id = int(file.readline())
+    file.close()
+except:
+    print('ERROR: Failed to read location id from piers.conf!')
+    sys.exit(1)
+if my_location_id < 1 or my_location_id > 99:
+    print('ERROR: Location identifier out of range!')
+    sys.exit(1)
+
+#history page size limits
+page_default = 50
+page_max = 200
+#per client backlog of undelivered events before the client is dropped
+subscriber_backlog = 256
+#comment line sent to idle event streams so proxies and phones keep them open
+heartbeat_seconds = 15
+
+#the database worker thread and its connection
+db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+db = None
+#lookups that do not change during an event
+locations_cache = {}
+participants_cache = {}
+#live event subscribers, one asyncio.Queue per connected browser
+subscribers = set()
+#set while anyone is subscribed, the watcher sleeps without polling otherwise
+subscribed = None
+
+#function: open the connection and fill the caches (runs on the database worker)
+def database_open():
+    global db
+    db = sqlite3.connect('piers.db')
+    db.execute('PRAGMA foreign_keys = ON')
+    arq.ensure_schema(db)
+    status_db.ensure_schema(db)
+    for location_id, location_name in db.execute('SELECT location_id, location_name FROM locations'):
+        locations_cache[location_id] = location_name
+    for participant_id, first_name, last_name in db.execute('''
+            SELECT participant_id, participant_first_name, participant_last_name
+            FROM participants;'''):
+        participants_cache[participant_id] = {'first_name': first_name, 'last_name': last_name}
+    return db.execute('SELECT IFNULL(MAX(rowid), 0) FROM sms').fetchone()[0]
+
+#function: convert an sms row to a JSON friendly dict
+def sms_row(row):
+    return {'id': row[0],
+            'location_id': row[1],
+            'location_name': locations_cache.get(row[1]),
+            'message': row[2],
+            'time_queued': row[3],
+            'time_received': row[4],
+            'rssi': row[5],
+            'snr': row[6]}
+
+#function: highest sms rowid
+def database_max_rowid():
+    return db.execute('SELECT IFNULL(MAX(rowid), 0) FROM sms').fetchone()[0]
+
+#function: history page, newest first, keyset paginated on rowid
+def database_history(before, limit):
+    rows = db.execute('''
+        SELECT rowid, location_id, message, time_queued, time_received, rssi, snr
+        FROM sms
+        WHERE rowid<? AND (duplicate='N' OR duplicate IS NULL)
+        ORDER BY rowid DESC
+        LIMIT ?;''',
+        (before, limit)).fetchall()
+    return [sms_row(row) for row in rows]
+
+#function: rows added after a rowid, oldest first
+def database_since(rowid):
+    rows = db.execute('''
+        SELECT rowid, location_id, message, time_queued, time_received, rssi, snr
+        FROM sms
+        WHERE rowid>? AND (duplicate='N' OR duplicate IS NULL)
+        ORDER BY rowid;''',
+        (rowid,)).fetchall()
+    return [sms_row(row) for row in rows]
+
+#function: data_version changes when another connection commits, total_changes when we do
+def database_version():
+    return db.execute('PRAGMA data_version').fetchone()[0], db.total_changes
+
+#function: validate and queue one message, returns (status, body)
+def database_submit(message):
+    if not sms_queue.validate_message(message):
+        return 400, {'error': 'message contained invalid characters or is of invalid length'}
+    try:
+        with db:
+            sequence = sms_queue.insert(db, my_location_id, message, timesync.network_time())
+    except sqlite3.Error as error:
+        logging.error('Database entry failure! ' + str(error))
+        return 500, {'error': 'database entry failure'}
+    return 201, {'sequence': sequence}
+
+#function: participant name from cache plus latest status
+def database_participant(participant_id):
+    if participant_id not in participants_cache:
+        return None
+    row = status_db.last_seen(db, participant_id)
+    result = dict(participants_cache[participant_id], participant_id=participant_id)
+    result.update({'location_id': row[3], 'location_name': row[4],
+                   'status': row[5], 'time_logged': row[6]})
+    return result
+
+#function: run a database function on the database worker thread
+def run_db(function, *function_args):
+    return asyncio.get_event_loop().run_in_executor(db_executor, function, *function_args)
+
+#function: the single watcher, fans new rows out to every subscriber
+async def watcher(rowid_marker):
+    version = None
+    while True:
+        await asyncio.sleep(args.poll)
+        #a database error must not end live updates for good, log it and poll again
+        try:
+            if not subscribers:
+                #nobody is listening, stop waking up until someone is (reconnects resume via Last-Event-ID)
+                subscribed.clear()
+                await subscribed.wait()
+                rowid_marker = await run_db(database_max_rowid)
+                version = await run_db(database_version)
+                continue
+            new_version = await run_db(database_version)
+            if new_version == version:
+                continue
+            rows = await run_db(database_since, rowid_marker)
+            version = new_version
+        except Exception:
+            logging.exception('Watcher failure, retrying')
+            continue
+        if not rows:
+            continue
+        rowid_marker = rows[-1]['id']
+        for queue in list(subscribers):
+            for row in rows:
+                try:
+                    queue.put_nowait(row)
+                except asyncio.QueueFull:
+                    #a stalled client, drop it rather than buffer without bound,
+                    #it resumes from Last-Event-ID when it reconnects
+                    subscribers.discard(queue)
+                    break
+
+#function: write a complete HTTP response
+async def respond(writer, status, body, content_type='application/json'):
+    reasons = {200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found',
+               405: 'Method Not Allowed', 500: 'Internal Server Error'}
+    if content_type == 'application/json':
+        body = json.dumps(body)
+    body = body.encode('UTF-8')
+    writer.write((f'HTTP/1.1 {status} {reasons[status]}\r\n'
+                  f'Content-Type: {content_type}\r\n'
+                  f'Content-Length: {len(body)}\r\n'
+                  'Access-Control-Allow-Origin: *\r\n'
+                  'Connection: close\r\n\r\n').encode('ASCII') + body)
+    await writer.drain()
+
+#function: stream live sms to one browser until it disconnects
+async def event_stream(writer, last_event_id):
+    queue = asyncio.Queue(maxsize=subscriber_backlog)
+    subscribers.add(queue)
+    subscribed.set()
+    try:
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/event-stream\r\n'
+                     b'Cache-Control: no-cache\r\n'
+                     b'Access-Control-Allow-Origin: *\r\n'
+                     b'Connection: keep-alive\r\n\r\n')
+        #a reconnecting browser resumes from the last event it saw
+        if last_event_id != None:
+            for row in await run_db(database_since, last_event_id):
+                writer.write(f'id: {row["id"]}\ndata: {json.dumps(row)}\n\n'.encode('UTF-8'))
+                #the watcher may queue the same rows, only send what comes after
+                last_event_id = row['id']
+        await writer.drain()
+        while True:
+            try:
+                row = await asyncio.wait_for(queue.get(), heartbeat_seconds)
+            except asyncio.TimeoutError:
+                writer.write(b': heartbeat\n\n')
+            else:
+                if last_event_id != None and row['id'] <= last_event_id:
+                    continue
+                writer.write(f'id: {row["id"]}\ndata: {json.dumps(row)}\n\n'.encode('UTF-8'))
+                last_event_id = row['id']
+            await writer.drain()
+            if queue not in subscribers:
+                break
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        subscribers.discard(queue)
+
+#function: parse one request and route it
+async def handle(reader, writer):
+    try:
+        request_line = (await reader.readline()).decode('ASCII', 'replace').split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('ASCII', 'replace').rstrip('\r\n')
+            if line == '':
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if len(request_line) < 2:
+            return
+        method = request_line[0]
+        url = urllib.parse.urlsplit(request_line[1])
+        query = urllib.parse.parse_qs(url.query)
+        path = url.path.rstrip('/')
+        if path == '/sms' and method == 'GET':
+            try:
+                before = int(query.get('before', ['9223372036854775807'])[0])
+                limit = min(max(int(query.get('limit', [page_default])[0]), 1), page_max)
+            except ValueError:
+                await respond(writer, 400, {'error': 'before and limit must be integers'})
+                return
+            rows = await run_db(database_history, before, limit)
+            next_before = rows[-1]['id'] if len(rows) == limit else None
+            await respond(writer, 200, {'sms': rows, 'next_before': next_before})
+        elif path == '/sms' and method == 'POST':
+            try:
+                length = int(headers.get('content-length', '0') or 0)
+            except ValueError:
+                length = -1
+            if length < 0:
+                await respond(writer, 400, {'error': 'Content-Length must be a non-negative integer'})
+                return
+            length = min(length, 4096)
+            body = (await reader.readexactly(length)).decode('UTF-8', 'replace')
+            if headers.get('content-type', '').startswith('application/json'):
+                try:
+                    message = str(json.loads(body).get('message', ''))
+                except (ValueError, AttributeError):
+                    message = ''
+            else:
+                message = urllib.parse.parse_qs(body).get('message', [''])[0]
+            status, result = await run_db(database_submit, message)
+            await respond(writer, status, result)
+        elif path == '/events' and method == 'GET':
+            last_event_id = headers.get('last-event-id') or query.get('since', [None])[0]
+            try:
+                last_event_id = int(last_event_id) if last_event_id != None else None
+            except ValueError:
+                last_event_id = None
+            await event_stream(writer, last_event_id)
+        elif path == '/locations' and method == 'GET':
+            await respond(writer, 200, {'locations': [{'location_id': location_id,
+                                                       'location_name': location_name}
+                                                      for location_id, location_name
+                                                      in sorted(locations_cache.items())]})
+        elif path.startswith('/participants/') and method == 'GET':
+            try:
+                participant_id = int(path.split('/')[2])
+            except ValueError:
+                participant_id = None
+            result = await run_db(database_participant, participant_id)
+            if result == None:
+                await respond(writer, 404, {'error': 'unknown bib number'})
+            else:
+                await respond(writer, 200, result)
+        elif path in ('/sms', '/events', '/locations') or path.startswith('/participants/'):
+            await respond(writer, 405, {'error': 'method not allowed'})
+        else:
+            await respond(writer, 404, {'error': 'not found'})
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    except Exception:
+        logging.exception('Request failure')
+    finally:
+        writer.close()
+
+#function: log a watcher that stopped, live updates end with it
+def watcher_done(task):
+    if not task.cancelled() and task.exception() != None:
+        logging.error('Watcher stopped, no more live updates', exc_info=task.exception())
+
+#function: start the watcher and the server
+async def main():
+    global subscribed
+    subscribed = asyncio.Event()
+    rowid_marker = await run_db(database_open)
+    asyncio.ensure_future(watcher(rowid_marker)).add_done_callback(watcher_done)
+    server = await asyncio.start_server(handle, args.host, args.port)
+    logging.info('web_api.py listening on %s:%s', args.host, args.port)
+    print(f'PiERS Web API listening on {args.host}:{args.port} (CTRL+C to quit)')
+    async with server:
+        await server.serve_forever()
+
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    print()
+logging.info('web_api.py stopped')
+sys.exit(0)